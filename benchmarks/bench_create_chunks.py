@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Compare the streaming chunker with the former two-pass Biopython chunker
+#
+# Usage: python3 benchmarks/bench_create_chunks.py [genome_size_mb] [nb_contigs] [threads]
+from Bio import SeqIO
+
+import glob
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from hapog import pipeline
+
+
+def write_genome(path, genome_size, nb_contigs):
+    random.seed(42)
+    # A few large scaffolds followed by many small contigs
+    sizes = [random.randint(1, 1000) ** 2 for _ in range(nb_contigs)]
+    scale = genome_size / sum(sizes)
+    block = "".join(random.choice("ACGT") for _ in range(1_000_003))
+    with open(path, "w") as out:
+        for i, size in enumerate(sizes):
+            size = max(1, int(size * scale))
+            out.write(f">contig_{i}\n")
+            start = random.randint(0, len(block) - 1)
+            line = []
+            for j in range(size):
+                line.append(block[(start + j) % len(block)])
+                if len(line) == 60:
+                    out.write("".join(line) + "\n")
+                    line = []
+            if line:
+                out.write("".join(line) + "\n")
+
+
+def legacy_create_chunks(genome, threads):
+    # Former implementation: one Biopython pass to get the genome size and a
+    # second one to write the chunks
+    cumul_size = 0
+    with open(genome) as genome_file:
+        for record in SeqIO.parse(genome_file, "fasta"):
+            cumul_size += len(record.seq)
+
+    chunk_size = cumul_size / int(threads)
+    os.mkdir("chunks")
+
+    current_chunk = 1
+    current_chunk_size = 0
+    current_chunk_file = open("chunks/chunks_1.fasta", "w")
+    current_bed_file = open("chunks/chunks_1.bed", "w")
+    for record in SeqIO.parse(open(genome), "fasta"):
+        if current_chunk_size >= chunk_size and current_chunk != int(threads):
+            current_chunk_file.close()
+            current_bed_file.close()
+            current_chunk_file = open(f"chunks/chunks_{current_chunk + 1}.fasta", "w")
+            current_bed_file = open(f"chunks/chunks_{current_chunk + 1}.bed", "w")
+            current_chunk += 1
+            current_chunk_size = 0
+
+        current_chunk_file.write(record.format("fasta"))
+        current_bed_file.write(f"{record.id}\t0\t{len(record.seq)}\n")
+        current_chunk_size += len(record.seq)
+    current_chunk_file.close()
+    current_bed_file.close()
+
+
+def bed_regions(workdir):
+    regions = []
+    for bed in glob.glob(f"{workdir}/chunks/*.bed"):
+        with open(bed) as bed_file:
+            regions += bed_file.readlines()
+    return sorted(regions)
+
+
+def timed(function, genome, threads, workdir):
+    os.mkdir(workdir)
+    os.chdir(workdir)
+    start = time.perf_counter()
+    function(genome, threads)
+    elapsed = time.perf_counter() - start
+    os.chdir("..")
+    return elapsed
+
+
+def main():
+    genome_size = int(float(sys.argv[1]) * 1_000_000) if len(sys.argv) > 1 else 50_000_000
+    nb_contigs = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        genome = os.path.join(tmp, "genome.fasta")
+        write_genome(genome, genome_size, nb_contigs)
+        print(f"Genome: {genome_size:,} bases in {nb_contigs} contigs, {threads} chunks")
+
+        legacy = timed(legacy_create_chunks, genome, threads, "legacy")
+        streaming = timed(pipeline.create_chunks, genome, threads, "streaming")
+
+        # Chunks are now balanced and only list regions, every sequence must
+        # still be in exactly one chunk
+        legacy_regions = bed_regions("legacy")
+        streaming_regions = bed_regions("streaming")
+        identical = legacy_regions == streaming_regions
+        if not identical:
+            print("Different regions in the BED files of the chunks")
+
+        print(f"\nBiopython two-pass chunker : {legacy:.2f} seconds")
+        print(f"Streaming chunker          : {streaming:.2f} seconds")
+        print(f"Speedup                    : {legacy / streaming:.1f}x")
+        print(f"Same regions in the chunks : {identical}")
+
+
+if __name__ == "__main__":
+    main()
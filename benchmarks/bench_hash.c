@@ -0,0 +1,84 @@
+/// @file bench_hash.c
+/// Microbenchmark of the read name hash table (src/hash.c)
+///
+/// Build: gcc -O3 -I../src bench_hash.c ../src/hash.c -o bench_hash
+/// Usage: samtools view aln.bam | cut -f1 > names.txt
+///        ./bench_hash names.txt [rounds]
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "hash.h"
+
+double now() {
+  struct timespec t;
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec + t.tv_nsec / 1e9;
+}
+
+int main(int argc, char* argv[]) {
+  if(argc < 2) {
+    fprintf(stderr, "Usage: bench_hash names.txt [rounds]\n");
+    return 1;
+  }
+  int rounds = (argc > 2) ? atoi(argv[2]) : 5;
+  FILE* f = fopen(argv[1], "r");
+  if(f == NULL) {
+    fprintf(stderr, "Could not open %s\n", argv[1]);
+    return 1;
+  }
+
+  // load the stream of read names in memory
+  int nb = 0, max = 1024, i = 0, r = 0;
+  char **names = malloc(max * sizeof(char*));
+  char line[1024];
+  while(fgets(line, 1024, f) != NULL) {
+    line[strcspn(line, "\r\n")] = '\0';
+    if(nb == max) {
+      max *= 2;
+      names = realloc(names, max * sizeof(char*));
+    }
+    names[nb++] = strdup(line);
+  }
+  fclose(f);
+  printf("Read names        : %i\n", nb);
+
+  double search = 0, toggle = 0, fill = 0;
+  long found = 0;
+  for(r = 0 ; r < rounds ; r++) {
+    // every incoming alignment is looked up, as in parse_bam
+    hash_t* h = hash_init();
+    double t = now();
+    for(i = 0 ; i < nb ; i++) found += hash_search(h, names[i]);
+    search += now() - t;
+
+    // a name is inserted when first seen and erased when seen again, as
+    // for hapB reads and their mates
+    t = now();
+    for(i = 0 ; i < nb ; i++) {
+      if(!hash_search(h, names[i])) hash_insert(h, names[i]);
+      else hash_delete(h, names[i]);
+    }
+    toggle += now() - t;
+    hash_free(h);
+
+    // insert everything, look everything up and erase everything
+    t = now();
+    h = hash_init();
+    for(i = 0 ; i < nb ; i++) hash_insert(h, names[i]);
+    for(i = 0 ; i < nb ; i++) found += hash_search(h, names[i]);
+    for(i = 0 ; i < nb ; i++) hash_delete(h, names[i]);
+    hash_free(h);
+    fill += now() - t;
+  }
+  printf("Search only       : %.3f s\n", search / rounds);
+  printf("Insert or delete  : %.3f s\n", toggle / rounds);
+  printf("Fill and empty    : %.3f s\n", fill / rounds);
+  printf("Found             : %li\n", found);
+
+  for(i = 0 ; i < nb ; i++) free(names[i]);
+  free(names);
+  return 0;
+}
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Benchmarks of Hapo-G on synthetic diploid assemblies (see simulate.py)
+#
+# For each genome size, coverage and read type, the harness:
+#   - simulates the dataset once (kept in the work directory)
+#   - runs the whole pipeline (hapog.py) and collects its telemetry report,
+#     the BAM file of the first run is kept as the input of the next steps
+#   - runs create_chunks, extract_bam, launch_hapog and write_results on their
+#     own, from this BAM file, and measures each of them
+#   - computes the checksums of hapog.fasta and hapog.changes of these steps,
+#     which only depend on the BAM file and must not change when the code is
+#     optimized
+#
+# The aligners are not deterministic with several threads, so the checksums of
+# the whole pipeline are reported but never compared.
+#
+# Usage: python3 benchmarks/run_benchmarks.py [--sizes 1,10] [--coverages 30]
+#            [--reads short,long] [-t 8] [--workdir bench_work]
+#            [--save-reference ref.json | --reference ref.json]
+# Requires bwa, minimap2 and samtools in $PATH, like hapog.py
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+BENCHMARKS = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, ".."))
+sys.path.insert(0, BENCHMARKS)
+from hapog import pipeline
+from hapog import telemetry
+import simulate
+
+COLUMNS = [
+    "dataset",
+    "run",
+    "step",
+    "wall_time",
+    "user_time",
+    "system_time",
+    "max_rss",
+    "bases_per_second",
+]
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checksums(run_dir):
+    return {
+        f: checksum(f"{run_dir}/hapog_results/{f}") for f in ("hapog.fasta", "hapog.changes")
+    }
+
+
+def row(dataset, run, record, size):
+    return {
+        "dataset": dataset,
+        "run": run,
+        "step": record["name"],
+        "wall_time": record["wall_time"],
+        "user_time": record["user_time"],
+        "system_time": record["system_time"],
+        "max_rss": record["max_rss"],
+        "bases_per_second": int(size / record["wall_time"]) if record["wall_time"] else None,
+    }
+
+
+def run_pipeline(dataset, dataset_dir, read_files, reads, args, size):
+    # Whole pipeline, as launched by users
+    run_dir = f"{args.workdir}/runs/{dataset}/pipeline"
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(run_dir), exist_ok=True)
+    cmd = [
+        sys.executable,
+        os.path.join(BENCHMARKS, "..", "hapog.py"),
+        "-g",
+        f"{dataset_dir}/assembly.fasta",
+        "-o",
+        run_dir,
+        "-t",
+        str(args.threads),
+        "-u",
+    ]
+    if reads == "short":
+        cmd += ["--pe1", read_files[0], "--pe2", read_files[1]]
+    else:
+        cmd += ["--single", read_files[0]]
+    if args.window_size:
+        cmd += ["--window-size", str(args.window_size)]
+    if args.hapog_bin:
+        cmd += ["--bin", args.hapog_bin]
+
+    print(f"\n[{dataset}] Running the whole pipeline...", flush=True)
+    start = time.perf_counter()
+    with open(f"{run_dir}.log", "w") as log:
+        if subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode != 0:
+            print(f"ERROR: hapog.py failed, see {run_dir}.log")
+            exit(1)
+    wall_time = time.perf_counter() - start
+
+    with open(f"{run_dir}/logs/telemetry.json") as report:
+        rows = [row(dataset, "pipeline", r, size) for r in json.load(report) if r["kind"] == "stage"]
+    rows.append(
+        {
+            "dataset": dataset,
+            "run": "pipeline",
+            "step": "total",
+            "wall_time": round(wall_time, 3),
+            "bases_per_second": int(size / wall_time),
+        }
+    )
+
+    # The first alignments are kept so that the next runs polish the same data
+    if not os.path.exists(f"{dataset_dir}/aln.bam"):
+        shutil.copy(f"{run_dir}/bam/aln.sorted.bam", f"{dataset_dir}/aln.bam")
+        shutil.copy(f"{run_dir}/bam/aln.sorted.bam.bai", f"{dataset_dir}/aln.bam.bai")
+    return rows, checksums(run_dir)
+
+
+def run_steps(dataset, dataset_dir, args, size):
+    # Steps of the pipeline run one by one in the same process
+    run_dir = os.path.abspath(f"{args.workdir}/runs/{dataset}/steps")
+    shutil.rmtree(run_dir, ignore_errors=True)
+    for d in ("bam", "logs", "cmds"):
+        os.makedirs(f"{run_dir}/{d}")
+    shutil.copy(f"{dataset_dir}/assembly.fasta", f"{run_dir}/assembly.fasta")
+    os.symlink(f"{dataset_dir}/aln.bam", f"{run_dir}/bam/aln.sorted.bam")
+    os.symlink(f"{dataset_dir}/aln.bam.bai", f"{run_dir}/bam/aln.sorted.bam.bai")
+
+    steps = [
+        (
+            "create_chunks",
+            pipeline.create_chunks,
+            "assembly.fasta",
+            args.threads,
+            args.window_size,
+            args.window_overlap,
+        ),
+        ("extract_bam", pipeline.extract_bam, args.threads),
+        (
+            "launch_hapog",
+            pipeline.launch_hapog,
+            args.hapog_bin,
+            args.threads,
+            None,
+            args.window_overlap,
+        ),
+        ("write_results", pipeline.write_results, True),
+    ]
+
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    rows = []
+    for name, function, *function_args in steps:
+        nb_records = len(telemetry.records)
+        begin = telemetry.start()
+        function(*function_args)
+        telemetry.stop(name, begin)
+        record = telemetry.records[-1]
+        # Peak memory of the jobs launched by the step
+        jobs = [r for r in telemetry.records[nb_records:-1] if r["max_rss"]]
+        if jobs:
+            record["max_rss"] = max(r["max_rss"] for r in jobs)
+        rows.append(row(dataset, "steps", record, size))
+    os.chdir(cwd)
+    return rows, checksums(run_dir)
+
+
+def write_table(rows, output):
+    with open(output, "w") as out:
+        out.write("\t".join(COLUMNS) + "\n")
+        for r in rows:
+            out.write("\t".join("NA" if r.get(c) is None else str(r[c]) for c in COLUMNS) + "\n")
+
+    print()
+    widths = [max(len(c), max(len(str(r.get(c))) for r in rows)) for c in COLUMNS]
+    print("  ".join(c.ljust(w) for c, w in zip(COLUMNS, widths)))
+    for r in rows:
+        print(
+            "  ".join(
+                ("NA" if r.get(c) is None else str(r[c])).ljust(w) for c, w in zip(COLUMNS, widths)
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of Hapo-G on simulated data")
+    parser.add_argument("--sizes", default="1,10", help="Genome sizes in Mb (Default: 1,10)")
+    parser.add_argument("--coverages", default="30", help="Read coverages (Default: 30)")
+    parser.add_argument("--reads", default="short,long", help="Read types (Default: short,long)")
+    parser.add_argument("--threads", "-t", default=8, type=int, help="Number of threads")
+    parser.add_argument("--window-size", default=0, type=int, dest="window_size")
+    parser.add_argument("--window-overlap", default=100000, type=int, dest="window_overlap")
+    parser.add_argument("--bin", default=None, dest="hapog_bin", help="Hapo-G binary to use")
+    parser.add_argument("--workdir", default="bench_work", help="Datasets and runs directory")
+    parser.add_argument(
+        "--skip-pipeline",
+        action="store_true",
+        dest="skip_pipeline",
+        help="Only run the steps, the BAM file of each dataset must have been made by a previous run",
+    )
+    parser.add_argument(
+        "--save-reference", default=None, dest="save_reference", help="Write the checksums"
+    )
+    parser.add_argument(
+        "--reference", default=None, help="Compare the checksums with those of this file"
+    )
+    args = parser.parse_args()
+    args.workdir = os.path.abspath(args.workdir)
+    if args.hapog_bin:
+        args.hapog_bin = os.path.abspath(args.hapog_bin)
+
+    rows = []
+    sums = {}
+    for reads in args.reads.split(","):
+        for size_mb in args.sizes.split(","):
+            for coverage in args.coverages.split(","):
+                dataset = f"{size_mb}Mb_{reads}_{coverage}x"
+                dataset_dir = f"{args.workdir}/datasets/{dataset}"
+                print(f"\n[{dataset}] Simulating the dataset...", flush=True)
+                read_files = simulate.simulate(
+                    dataset_dir, int(float(size_mb) * 1_000_000), float(coverage), reads
+                )
+                size = pipeline.get_genome_size(f"{dataset_dir}/assembly.fasta")
+
+                if not args.skip_pipeline:
+                    pipeline_rows, pipeline_sums = run_pipeline(
+                        dataset, dataset_dir, read_files, reads, args, size
+                    )
+                    rows += pipeline_rows
+                    print(f"[{dataset}] Checksums of the pipeline: {pipeline_sums}", flush=True)
+                if not os.path.exists(f"{dataset_dir}/aln.bam"):
+                    print(f"ERROR: no BAM file for {dataset}, run the whole pipeline first")
+                    exit(1)
+
+                print(f"\n[{dataset}] Running the steps one by one...", flush=True)
+                step_rows, sums[dataset] = run_steps(dataset, dataset_dir, args, size)
+                rows += step_rows
+
+    write_table(rows, f"{args.workdir}/results.tsv")
+    print(f"\nResults written to {args.workdir}/results.tsv")
+
+    if args.save_reference:
+        with open(args.save_reference, "w") as out:
+            json.dump(sums, out, indent=2)
+        print(f"Checksums written to {args.save_reference}")
+
+    if args.reference:
+        with open(args.reference) as reference_file:
+            reference = json.load(reference_file)
+        identical = True
+        for dataset, dataset_sums in sums.items():
+            if dataset not in reference:
+                print(f"{dataset}: not in the reference")
+                continue
+            for f, digest in dataset_sums.items():
+                same = reference[dataset].get(f) == digest
+                identical = identical and same
+                print(f"{dataset} {f}: {'identical' if same else 'DIFFERENT'}")
+        if not identical:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
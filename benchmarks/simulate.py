@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Synthetic diploid assemblies and read sets for the benchmarks
+#
+# A random haplotype A is generated, haplotype B carries heterozygous SNPs and
+# small indels. The assembly switches from one haplotype to the other every
+# few kilobases (phasing errors) and carries base errors. Reads are sampled
+# from both haplotypes with sequencing errors. Everything is seeded, the same
+# parameters always give the same files.
+#
+# Usage: python3 benchmarks/simulate.py output_dir [genome_size_mb] [coverage] [short|long]
+import gzip
+import os
+import random
+import sys
+
+
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+# Heterozygosity between the two haplotypes, a tenth of the events are indels
+HETEROZYGOSITY = 0.01
+# Length of the haplotype blocks of the assembly
+SWITCH_LENGTH = 20000
+# Base errors of the assembly
+ASSEMBLY_ERRORS = 0.002
+
+# Short paired-end reads
+SHORT_LENGTH = 150
+INSERT_SIZE = 400
+INSERT_SD = 50
+SHORT_ERRORS = 0.002
+
+# Long reads (HiFi-like)
+LONG_MIN = 5000
+LONG_MAX = 25000
+LONG_ERRORS = 0.005
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choices("ACGT", k=length))
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def mutate(rng, seq, rate, indels=True):
+    # Substitutions, and 1-3 bp insertions or deletions for a tenth of the
+    # events, at random positions
+    nb_events = int(len(seq) * rate)
+    if nb_events == 0:
+        return seq
+    pieces = []
+    previous = 0
+    for position in sorted(rng.sample(range(len(seq)), nb_events)):
+        if position < previous:
+            continue
+        pieces.append(seq[previous:position])
+        event = rng.random()
+        if not indels or event < 0.9:
+            pieces.append(rng.choice([base for base in "ACGT" if base != seq[position]]))
+            previous = position + 1
+        elif event < 0.95:
+            pieces.append(seq[position] + random_sequence(rng, rng.randint(1, 3)))
+            previous = position + 1
+        else:
+            previous = position + rng.randint(1, 3)
+    pieces.append(seq[previous:])
+    return "".join(pieces)
+
+
+def contig_sizes(rng, genome_size, nb_contigs):
+    # A few large scaffolds followed by many small contigs
+    sizes = [rng.randint(1, 1000) ** 2 for _ in range(nb_contigs)]
+    scale = genome_size / sum(sizes)
+    return [max(1000, int(size * scale)) for size in sizes]
+
+
+def make_genome(rng, genome_size, nb_contigs):
+    hap_a, hap_b, assembly = {}, {}, {}
+    for i, size in enumerate(contig_sizes(rng, genome_size, nb_contigs)):
+        name = f"contig_{i}"
+        hap_a[name] = random_sequence(rng, size)
+        hap_b[name] = mutate(rng, hap_a[name], HETEROZYGOSITY)
+
+        # Blocks are taken at the same relative position of both haplotypes
+        blocks = []
+        for block, start in enumerate(range(0, size, SWITCH_LENGTH)):
+            hap = hap_a[name] if block % 2 == 0 else hap_b[name]
+            scale = len(hap) / size
+            blocks.append(hap[int(start * scale) : int((start + SWITCH_LENGTH) * scale)])
+        assembly[name] = mutate(rng, "".join(blocks), ASSEMBLY_ERRORS)
+    return hap_a, hap_b, assembly
+
+
+def write_fasta(path, sequences):
+    with open(path, "w") as out:
+        for name, seq in sequences.items():
+            out.write(f">{name}\n")
+            for i in range(0, len(seq), 60):
+                out.write(seq[i : i + 60] + "\n")
+
+
+def write_read(out, name, seq):
+    out.write(f"@{name}\n{seq}\n+\n{'I' * len(seq)}\n")
+
+
+def simulate_short_reads(rng, haplotypes, coverage, prefix):
+    # Pairs of reads from fragments of both haplotypes, each haplotype gets
+    # half of the coverage
+    nb_pairs = 0
+    with gzip.open(f"{prefix}_1.fastq.gz", "wt", compresslevel=1) as out1, gzip.open(
+        f"{prefix}_2.fastq.gz", "wt", compresslevel=1
+    ) as out2:
+        for hap in haplotypes:
+            for seq in hap.values():
+                if len(seq) < INSERT_SIZE + 4 * INSERT_SD:
+                    continue
+                for _ in range(int(coverage / 2 * len(seq) / (2 * SHORT_LENGTH))):
+                    insert = max(SHORT_LENGTH, int(rng.gauss(INSERT_SIZE, INSERT_SD)))
+                    start = rng.randint(0, len(seq) - insert)
+                    fragment = seq[start : start + insert]
+                    if rng.random() < 0.5:
+                        fragment = reverse_complement(fragment)
+                    read1 = mutate(rng, fragment[:SHORT_LENGTH], SHORT_ERRORS, indels=False)
+                    read2 = mutate(
+                        rng, reverse_complement(fragment)[:SHORT_LENGTH], SHORT_ERRORS, indels=False
+                    )
+                    write_read(out1, f"pair_{nb_pairs}/1", read1)
+                    write_read(out2, f"pair_{nb_pairs}/2", read2)
+                    nb_pairs += 1
+    return nb_pairs
+
+
+def simulate_long_reads(rng, haplotypes, coverage, path):
+    nb_reads = 0
+    with gzip.open(path, "wt", compresslevel=1) as out:
+        for hap in haplotypes:
+            for seq in hap.values():
+                for _ in range(max(1, int(coverage / 2 * len(seq) / ((LONG_MIN + LONG_MAX) / 2)))):
+                    length = min(len(seq), rng.randint(LONG_MIN, LONG_MAX))
+                    start = rng.randint(0, len(seq) - length)
+                    read = seq[start : start + length]
+                    if rng.random() < 0.5:
+                        read = reverse_complement(read)
+                    write_read(out, f"read_{nb_reads}", mutate(rng, read, LONG_ERRORS))
+                    nb_reads += 1
+    return nb_reads
+
+
+def simulate(output_dir, genome_size, coverage, reads, seed=42):
+    # Returns the read files of the dataset, nothing is generated again when
+    # the dataset is already there
+    os.makedirs(output_dir, exist_ok=True)
+    if reads == "short":
+        read_files = [f"{output_dir}/reads_1.fastq.gz", f"{output_dir}/reads_2.fastq.gz"]
+    else:
+        read_files = [f"{output_dir}/reads.fastq.gz"]
+    if os.path.exists(f"{output_dir}/done"):
+        return read_files
+
+    rng = random.Random(seed)
+    nb_contigs = max(10, genome_size // 100000)
+    hap_a, hap_b, assembly = make_genome(rng, genome_size, nb_contigs)
+    write_fasta(f"{output_dir}/assembly.fasta", assembly)
+    write_fasta(f"{output_dir}/hapA.fasta", hap_a)
+    write_fasta(f"{output_dir}/hapB.fasta", hap_b)
+    if reads == "short":
+        nb_reads = 2 * simulate_short_reads(rng, (hap_a, hap_b), coverage, f"{output_dir}/reads")
+    else:
+        nb_reads = simulate_long_reads(rng, (hap_a, hap_b), coverage, read_files[0])
+    print(
+        f"Simulated {sum(len(s) for s in assembly.values()):,} bases in {len(assembly)} contigs and {nb_reads:,} {reads} reads",
+        flush=True,
+    )
+    open(f"{output_dir}/done", "w").close()
+    return read_files
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: simulate.py output_dir [genome_size_mb] [coverage] [short|long]")
+        sys.exit(1)
+    simulate(
+        sys.argv[1],
+        int(float(sys.argv[2]) * 1_000_000) if len(sys.argv) > 2 else 1_000_000,
+        float(sys.argv[3]) if len(sys.argv) > 3 else 30,
+        sys.argv[4] if len(sys.argv) > 4 else "short",
+    )
@@ -41,5 +41,6 @@ cd ..
 
 mkdir bin
 ln -s ../hapog_build/hapog bin/hapog
+ln -s ../hapog_build/hapog_split bin/hapog_split
 
 echo "HAPoG was successfully built!"
@@ -14,3 +14,4 @@ cmake -DCMAKE_INSTALL_PREFIX=${PREFIX} \
 make
 cd ..
 cp -r hapog_build/hapog ${PREFIX}/bin/hapog_bin
+cp -r hapog_build/hapog_split ${PREFIX}/bin/hapog_split
@@ -0,0 +1,96 @@
+from hapog import telemetry
+
+import glob
+import hashlib
+import json
+import os
+
+
+# Directory of the stage manifests, relative to the output directory
+CHECKPOINTS = "checkpoints"
+
+# Reads and BAM files are too large to be hashed at each restart, only their
+# size and the hash of their first and last blocks are compared
+HASH_BLOCK = 1024 * 1024
+
+# path -> (size, mtime, fingerprint), files are only hashed once per run
+fingerprint_cache = {}
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    cached = fingerprint_cache.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        if stat.st_size <= 2 * HASH_BLOCK:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(HASH_BLOCK))
+            f.seek(stat.st_size - HASH_BLOCK)
+            digest.update(f.read(HASH_BLOCK))
+    result = f"{stat.st_size}:{digest.hexdigest()}"
+    fingerprint_cache[path] = (stat.st_size, stat.st_mtime_ns, result)
+    return result
+
+
+def expand(paths):
+    # Paths may be glob patterns, missing files are ignored
+    files = []
+    for path in paths:
+        if glob.has_magic(path):
+            files += sorted(glob.glob(path))
+        elif os.path.exists(path):
+            files.append(path)
+    return files
+
+
+def fingerprints(paths):
+    return {path: fingerprint(path) for path in expand(paths)}
+
+
+def manifest_file(stage):
+    return f"{CHECKPOINTS}/{stage}.json"
+
+
+def is_done(stage, inputs, params):
+    # A stage is done when its manifest was written with the same parameters
+    # and inputs, and its outputs were not modified since
+    try:
+        with open(manifest_file(stage)) as manifest:
+            manifest = json.load(manifest)
+    except (OSError, ValueError):
+        return False
+
+    if manifest["params"] != params or manifest["inputs"] != fingerprints(inputs):
+        return False
+    for path, path_fingerprint in manifest["outputs"].items():
+        if not os.path.exists(path) or fingerprint(path) != path_fingerprint:
+            return False
+    return True
+
+
+def record(stage, inputs, params, outputs):
+    os.makedirs(CHECKPOINTS, exist_ok=True)
+    manifest = {
+        "inputs": fingerprints(inputs),
+        "params": params,
+        "outputs": fingerprints(outputs),
+    }
+    with open(f"{manifest_file(stage)}.tmp", "w") as out:
+        json.dump(manifest, out, indent=2)
+    os.replace(f"{manifest_file(stage)}.tmp", manifest_file(stage))
+
+
+def run_stage(stage, inputs, params, outputs, function, *args):
+    # Run function(*args) unless the stage was already done with the same
+    # inputs and parameters, outputs of downstream stages are inputs of these
+    # stages so that they are computed again when an upstream stage is
+    if is_done(stage, inputs, params):
+        print(f"\nSkipping {stage}, already done", flush=True)
+        return False
+    telemetry.run(stage, function, *args)
+    record(stage, inputs, params, outputs)
+    return True
@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
+from hapog import checkpoint
+from hapog import fasta
 from hapog import mapping
 from hapog import pipeline
+from hapog import planner
+from hapog import telemetry
+from hapog import workqueue
 
 import argparse
+import atexit
 import os
 import sys
 import time
 
 
 def main():
+    # hapog worker OUTPUT_DIR: runs the jobs of a pipeline launched with --scatter
+    if sys.argv[1:2] == ["worker"]:
+        workqueue.main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         prog="hapog",
         description="\n\nHapo-G uses alignments produced by BWA (or any other aligner that produces SAM files) to polish the consensus of a genome assembly.",
@@ -68,6 +79,14 @@ def main():
         default=False,
         required=False,
     )
+    optional_args.add_argument(
+        "--bgzip",
+        action="store_true",
+        dest="bgzip",
+        help="Write the polished sequences to hapog_results/hapog.fasta.gz, compressed with BGZF (Default: when the input genome is compressed with bgzip)",
+        default=False,
+        required=False,
+    )
     optional_args.add_argument(
         "--output",
         "-o",
@@ -90,11 +109,79 @@ def main():
         "--hapog-threads",
         action="store",
         dest="hapog_threads",
-        help="Maximum number of Hapo-G jobs to launch in parallel (Defaults to the same value as --threads)",
+        help="Maximum number of Hapo-G jobs to launch in parallel (Defaults to --threads, or less if the jobs don't fit in --memory)",
         default=0,
         type=int,
         required=False,
     )
+    optional_args.add_argument(
+        "--window-size",
+        action="store",
+        dest="window_size",
+        help="Split sequences longer than this size into windows that are polished in parallel (Default: 0, sequences are never split)",
+        default=0,
+        type=int,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--window-overlap",
+        action="store",
+        dest="window_overlap",
+        help="Number of bases before each window used to select reads, these bases are polished by the previous window (Default: 100000)",
+        default=100000,
+        type=int,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--split-bam",
+        action="store_true",
+        dest="split_bam",
+        help="Write one BAM file per chunk instead of reading each chunk from the indexed BAM file (useful when the BAM file is on slow storage)",
+        default=False,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--fused-mapping",
+        action="store_true",
+        dest="fused_mapping",
+        help="Sort the alignments of each chunk separately while reads are mapped, instead of writing and splitting a sorted BAM file of the whole genome (not compatible with -b)",
+        default=False,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--aligner",
+        action="store",
+        dest="aligner",
+        choices=sorted(mapping.ALIGNERS),
+        help="Aligner used to map the reads (Default: bwa for paired-end reads, minimap2 for long reads)",
+        default=None,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--preset",
+        action="store",
+        dest="preset",
+        help="Minimap2 preset (Default: 'sr' for paired-end reads, 'map-pb' for long reads)",
+        default=None,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--sort-tmp",
+        action="store",
+        dest="sort_tmp",
+        help="Directory of the temporary files of samtools sort, preferably on a fast local disk (Default: the output directory)",
+        default=None,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--sort-level",
+        action="store",
+        dest="sort_level",
+        help="Compression level of the sorted BAM files, from 0 (uncompressed, fastest) to 9 (Default: samtools default)",
+        default=None,
+        type=int,
+        required=False,
+    )
     optional_args.add_argument(
         "--bin",
         action="store",
@@ -107,8 +194,58 @@ def main():
         "--samtools-mem",
         action="store",
         dest="samtools_mem",
-        help="Amount of memory to use per samtools thread (Default: '5G')",
-        default="5G",
+        help="Amount of memory to use per samtools thread (Default: what fits in --memory next to the aligner, at most '5G')",
+        default=None,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--memory",
+        action="store",
+        dest="memory",
+        help="Amount of memory Hapo-G can use (e.g. '200G'), Hapo-G jobs are not launched while the memory used by the running jobs is above this value (Default: 90%% of the memory of the node)",
+        default=None,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--retries",
+        action="store",
+        dest="retries",
+        help="Number of times a failed Hapo-G job is launched again (Default: 2)",
+        default=2,
+        type=int,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--scatter",
+        action="store_true",
+        dest="scatter",
+        help="Write the Hapo-G jobs to OUTPUT_DIR/queue and let 'hapog worker OUTPUT_DIR' processes run them, on any node that shares the output directory",
+        default=False,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--local-workers",
+        action="store",
+        dest="local_workers",
+        help="Number of workers started on this node with --scatter (Default: 0, all the workers are started by the user)",
+        default=0,
+        type=int,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--scratch",
+        action="store",
+        dest="scratch",
+        help="Node-local directory where the Hapo-G jobs read their chunk and write their results, copied back to the output directory in the background (Default: jobs run in the output directory)",
+        default=None,
+        required=False,
+    )
+    optional_args.add_argument(
+        "--scratch-size",
+        action="store",
+        dest="scratch_size",
+        help="Space Hapo-G can use in the --scratch directory (e.g. '100G'), jobs wait for the results of others to be copied back when it is full (Default: 90%% of its free space)",
+        default=None,
         required=False,
     )
     optional_args.add_argument(
@@ -121,14 +258,39 @@ def main():
     )
 
     args = parser.parse_args()
-    pipeline.check_dependencies()
+    if not args.aligner:
+        args.aligner = mapping.default_aligner(args.long_reads)
+    tools = ["samtools"]
+    if not args.bam_file:
+        tools.append(mapping.ALIGNERS[args.aligner].binary)
+    pipeline.check_dependencies(tools)
 
     args.input_genome = os.path.abspath(args.input_genome)
+    # Compressed genomes are read through their .fai and .gzi indexes, which
+    # can't be made for plain gzip files
+    if fasta.is_gzip(args.input_genome):
+        if not fasta.is_bgzf(args.input_genome):
+            print("ERROR: the genome is compressed with gzip, compress it with bgzip instead")
+            sys.exit(1)
+        args.bgzip = True
     args.output_dir = os.path.abspath(args.output_dir)
-    if args.hapog_threads == 0:
-        args.hapog_threads = args.threads
     if args.bam_file:
         args.bam_file = os.path.abspath(args.bam_file)
+    if args.sort_tmp:
+        args.sort_tmp = os.path.abspath(args.sort_tmp)
+    if args.window_size and args.window_overlap >= args.window_size:
+        print("ERROR: --window-overlap must be smaller than --window-size")
+        sys.exit(1)
+    if args.bam_file and args.fused_mapping:
+        print("ERROR: --fused-mapping can't be used with -b")
+        sys.exit(1)
+    if args.scratch and args.scatter:
+        print("ERROR: --scratch can't be used with --scatter")
+        sys.exit(1)
+    if args.scratch:
+        args.scratch = os.path.abspath(args.scratch)
+    if args.scratch_size:
+        args.scratch_size = planner.parse_memory(args.scratch_size)
 
     # Parse chunk list if provided
     chunk_list = None
@@ -146,7 +308,9 @@ def main():
     pe2 = []
     use_short_reads = False
 
-    if not args.chunk_list:
+    # Stages done by a previous run in the same output directory are skipped
+    resume = os.path.isdir(f"{args.output_dir}/{checkpoint.CHECKPOINTS}")
+    if not args.chunk_list and not resume:
         try:
             os.mkdir(args.output_dir)
         except:
@@ -158,11 +322,10 @@ def main():
         os.mkdir(f"{args.output_dir}/bam")
         os.mkdir(f"{args.output_dir}/logs")
         os.mkdir(f"{args.output_dir}/cmds")
+    elif resume:
+        print(f"\nResuming the run found in {args.output_dir}", flush=True)
 
-    if args.bam_file:
-        mapping.remove_secondary_alignments(args.bam_file, args.output_dir)
-        args.bam_file = os.path.abspath("no_secondary.bam")
-    else:
+    if not args.bam_file:
         if not args.long_reads and (not args.pe1 or not args.pe2):
             print("You need to specify the paths to paired-end or long reads files.")
             sys.exit(-1)
@@ -181,11 +344,55 @@ def main():
 
     global_start = time.perf_counter()
     os.chdir(args.output_dir)
+    # The report is also written when the run stops on an error
+    atexit.register(telemetry.write_report)
 
-    non_alphanumeric_chars = False
-    if args.chunk_list and os.path.exists("correspondance.txt"):
-        non_alphanumeric_chars = True
+    reads = []
+    if not args.bam_file:
+        reads = pe1 + pe2 if use_short_reads else [args.long_reads]
+    read_sets = [pe1, pe2] if use_short_reads else [[args.long_reads]]
+    mapping_options = mapping.MappingOptions(
+        args.aligner, args.preset, args.sort_tmp, args.sort_level
+    )
+    resources = planner.plan(
+        args.input_genome,
+        reads,
+        args.aligner,
+        args.threads,
+        args.hapog_threads,
+        args.samtools_mem,
+        args.memory,
+        args.window_size,
+        args.window_overlap,
+    )
+    args.hapog_threads = resources.hapog_threads
+    args.samtools_mem = resources.samtools_mem
+
+    chunks_stage = (
+        "chunks",
+        ["assembly.fasta"],
+        {
+            "threads": args.hapog_threads,
+            "window_size": args.window_size,
+            "window_overlap": args.window_overlap,
+        },
+        ["chunks/*.bed", pipeline.MANIFEST, "assembly.fasta.fai", "assembly.fasta.gzi"],
+        pipeline.create_chunks,
+        "assembly.fasta",
+        args.hapog_threads,
+        args.window_size,
+        args.window_overlap,
+    )
 
+    # Secondary and supplementary alignments of a BAM file given with -b are
+    # skipped while it is read, it is neither copied nor filtered
+    bam_filter = None
+    bam_indexed = False
+    if args.bam_file:
+        bam_filter = pipeline.SECONDARY_FILTER
+        bam_indexed = mapping.link_bam(args.bam_file)
+
+    non_alphanumeric_chars = False
     if not args.bam_file and not args.chunk_list:
         non_alphanumeric_chars = pipeline.check_fasta_headers(args.input_genome)
         if non_alphanumeric_chars:
@@ -193,17 +400,46 @@ def main():
                 "\nNon alphanumeric characters detected in fasta headers. Renaming sequences.",
                 flush=True,
             )
-            pipeline.rename_assembly(args.input_genome)
+        if non_alphanumeric_chars:
+            assembly_function = (pipeline.rename_assembly, args.input_genome, args.threads)
         else:
-            os.system(f"ln -s {args.input_genome} assembly.fasta")
+            assembly_function = (pipeline.link_assembly, args.input_genome)
+        checkpoint.run_stage(
+            "assembly",
+            [args.input_genome],
+            {"rename": non_alphanumeric_chars},
+            ["assembly.fasta", "correspondance.txt"],
+            *assembly_function,
+        )
 
-        if use_short_reads:
-            mapping.launch_PE_mapping(
-                "assembly.fasta", pe1, pe2, args.threads, args.samtools_mem
+        if args.fused_mapping:
+            # Chunks are known before the mapping, their BAM files are
+            # sorted as the reads are mapped
+            checkpoint.run_stage(*chunks_stage)
+            checkpoint.run_stage(
+                "mapping",
+                ["assembly.fasta", "chunks/*.bed"] + reads,
+                {"reads": reads, "fused": True, "aligner": args.aligner, "preset": args.preset},
+                ["chunks_bam/*.bam", "chunks_bam/*.bai"],
+                pipeline.map_to_chunks,
+                "assembly.fasta",
+                read_sets,
+                args.threads,
+                args.samtools_mem,
+                mapping_options,
             )
         else:
-            mapping.launch_LR_mapping(
-                "assembly.fasta", args.long_reads, args.threads, args.samtools_mem
+            checkpoint.run_stage(
+                "mapping",
+                ["assembly.fasta"] + reads,
+                {"reads": reads, "aligner": args.aligner, "preset": args.preset},
+                ["bam/aln.sorted.bam", "bam/aln.sorted.bam.bai"],
+                mapping.launch_mapping,
+                "assembly.fasta",
+                read_sets,
+                args.threads,
+                args.samtools_mem,
+                mapping_options,
             )
 
     else:
@@ -223,32 +459,59 @@ def main():
             sys.exit(-1)
 
         if not args.chunk_list:
-            os.system(f"ln -s {args.input_genome} assembly.fasta")
-            mapping.index_bam()
-
-    if not args.chunk_list and int(args.hapog_threads) > 1:
-        pipeline.create_chunks("assembly.fasta", args.threads)
-        pipeline.extract_bam(int(args.threads))
-    elif not args.chunk_list:
-        os.mkdir("chunks")
-        os.mkdir("chunks_bam")
-        if non_alphanumeric_chars:
-            os.system("ln -s ../assembly.fasta chunks/chunks_1.fasta")
-        else:
-            os.system(f"ln -s {args.input_genome} chunks/chunks_1.fasta")
-        os.system(f"ln -s ../bam/aln.sorted.bam chunks_bam/chunks_1.bam")
-
-    pipeline.launch_hapog(args.hapog_bin, args.hapog_threads, chunk_list)
-    pipeline.merge_results(int(args.threads))
+            checkpoint.run_stage(
+                "assembly",
+                [args.input_genome],
+                {"rename": False},
+                ["assembly.fasta", "correspondance.txt"],
+                pipeline.link_assembly,
+                args.input_genome,
+            )
+            if not bam_indexed:
+                checkpoint.run_stage(
+                    "index_bam",
+                    ["bam/aln.sorted.bam"],
+                    {},
+                    ["bam/aln.sorted.bam.bai"],
+                    mapping.index_bam,
+                )
 
-    if non_alphanumeric_chars:
-        pipeline.rename_results()
-    else:
-        os.system("mv hapog_results/hapog.changes.tmp hapog_results/hapog.changes")
-        os.system("mv hapog_results/hapog.fasta.tmp hapog_results/hapog.fasta")
+    if not args.chunk_list and not args.fused_mapping:
+        checkpoint.run_stage(*chunks_stage)
+        if args.split_bam:
+            checkpoint.run_stage(
+                "split_bam",
+                ["bam/aln.sorted.bam", "chunks/*.bed"],
+                {"filter": bam_filter},
+                ["chunks_bam/*.bam", "chunks_bam/*.bai"],
+                pipeline.extract_bam,
+                int(args.threads),
+                bam_filter,
+            )
 
-    if args.include_unpolished:
-        pipeline.include_unpolished(args.input_genome)
+    telemetry.run(
+        "hapog",
+        pipeline.launch_hapog,
+        args.hapog_bin,
+        args.hapog_threads,
+        chunk_list,
+        args.window_overlap,
+        args.retries,
+        resources.memory,
+        bam_filter,
+        args.scatter,
+        args.local_workers,
+        args.scratch,
+        args.scratch_size,
+    )
+    telemetry.run(
+        "write_results",
+        pipeline.write_results,
+        args.include_unpolished,
+        args.bgzip,
+        int(args.threads),
+    )
+    telemetry.write_report()
 
     print("\nResults can be found in the hapog_results directory")
     print(f"Total running time: {int(time.perf_counter() - global_start)} seconds")
@@ -0,0 +1,488 @@
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import bisect
+import gzip
+import mmap
+import os
+import struct
+import zlib
+
+
+# Size of the windows used when scanning or copying raw sequence bytes
+BLOCK_SIZE = 64 * 1024 * 1024
+# Size of the blocks read backwards when looking for a header line
+HEADER_BLOCK_SIZE = 64 * 1024
+
+# Uncompressed bytes of a BGZF (bgzip) block, and the empty block ending a file
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# One sequence of a fasta file, described by its byte offsets in the file:
+#   header_offset: offset of the '>' character
+#   offset:        offset of the first sequence byte (same meaning as in .fai)
+#   end:           offset of the first byte after the record
+FastaRecord = namedtuple(
+    "FastaRecord",
+    ["name", "length", "header_offset", "offset", "end", "line_bases", "line_width"],
+)
+
+# A BGZF-compressed file opened for random access, offsets of a fasta file in
+# BGZF are offsets in the uncompressed data (same meaning as in .fai):
+#   fd:          file descriptor of the compressed file
+#   offsets:     uncompressed offset of each block
+#   positions:   offset of each block in the compressed file
+#   size:        uncompressed size of the file
+Bgzf = namedtuple("Bgzf", ["fd", "offsets", "positions", "size"])
+
+
+def count_bases(mm, start, end):
+    # Number of sequence characters between start and end, line breaks excluded
+    length = 0
+    while start < end:
+        block_end = min(start + BLOCK_SIZE, end)
+        block = mm[start:block_end]
+        length += len(block) - block.count(b"\n") - block.count(b"\r")
+        start = block_end
+    return length
+
+
+def index_fasta(genome):
+    # Single raw pass over the genome: sequences are never decoded, only the
+    # position of each header is looked up and line breaks are counted
+    records = []
+    if os.path.getsize(genome) == 0:
+        return records
+    if is_bgzf(genome):
+        return index_bgzf(genome)
+
+    with open(genome, "rb") as genome_file:
+        with mmap.mmap(genome_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            if mm[:1] == b">":
+                header_offset = 0
+            else:
+                header_offset = mm.find(b"\n>") + 1
+                if header_offset == 0:
+                    return records
+
+            while True:
+                header_end = mm.find(b"\n", header_offset)
+                if header_end == -1:
+                    header_end = size
+                header = mm[header_offset + 1 : header_end].decode().split()
+                name = header[0] if header else ""
+
+                offset = min(header_end + 1, size)
+                next_header = mm.find(b"\n>", header_end)
+                end = size if next_header == -1 else next_header + 1
+
+                first_line_end = mm.find(b"\n", offset, end)
+                if first_line_end == -1:
+                    line_width = end - offset
+                else:
+                    line_width = first_line_end - offset + 1
+                line_bases = len(mm[offset : offset + line_width].rstrip(b"\r\n"))
+
+                records.append(
+                    FastaRecord(
+                        name,
+                        count_bases(mm, offset, end),
+                        header_offset,
+                        offset,
+                        end,
+                        line_bases,
+                        line_width,
+                    )
+                )
+
+                if next_header == -1:
+                    break
+                header_offset = next_header + 1
+    return records
+
+
+def index_bgzf(genome):
+    # Same as index_fasta() on a BGZF-compressed genome, decompressed in memory
+    # by blocks of whole lines. Records are [name, header_offset, offset,
+    # length, line_bases, line_width] until their end is known.
+    records = []
+    record = None
+
+    def add_record(end):
+        name, header_offset, offset, length, line_bases, line_width = record
+        records.append(
+            FastaRecord(
+                name, length, header_offset, min(offset, end), end, line_bases or 0, line_width or 0
+            )
+        )
+
+    position = 0
+    rest = b""
+    with gzip.open(genome, "rb") as genome_file:
+        while True:
+            block = genome_file.read(BLOCK_SIZE)
+            data = rest + block
+            if block:
+                line_end = data.rfind(b"\n") + 1
+                data, rest = data[:line_end], data[line_end:]
+
+            start = 0
+            while start < len(data):
+                if data[start : start + 1] == b">":
+                    header_end = data.find(b"\n", start)
+                    if header_end == -1:
+                        header_end = len(data)
+                    if record:
+                        add_record(position + start)
+                    header = data[start + 1 : header_end].decode().split()
+                    name = header[0] if header else ""
+                    record = [name, position + start, position + header_end + 1, 0, None, None]
+                    start = header_end + 1
+                    continue
+
+                next_header = data.find(b"\n>", start)
+                end = len(data) if next_header == -1 else next_header + 1
+                if record:
+                    lines = data[start:end]
+                    record[3] += len(lines) - lines.count(b"\n") - lines.count(b"\r")
+                    if record[5] is None:
+                        first_line_end = lines.find(b"\n")
+                        record[5] = len(lines) if first_line_end == -1 else first_line_end + 1
+                        record[4] = len(lines[: record[5]].rstrip(b"\r\n"))
+                start = end
+
+            position += len(data)
+            if not block:
+                break
+    if record:
+        add_record(position)
+    return records
+
+
+def copy_range(src_fd, out, start, end):
+    # Copy bytes [start, end) of src_fd to the file object out without going
+    # through Python buffers when the platform allows it. Compressed files are
+    # copied through pread().
+    try:
+        if not isinstance(src_fd, int):
+            raise AttributeError
+        out.flush()
+        out_fd = out.fileno()
+        while start < end:
+            sent = os.sendfile(out_fd, src_fd, start, min(end - start, BLOCK_SIZE))
+            if sent == 0:
+                break
+            start += sent
+    except (AttributeError, OSError):
+        while start < end:
+            block = pread(src_fd, min(end - start, BLOCK_SIZE), start)
+            if not block:
+                break
+            out.write(block)
+            start += len(block)
+        out.flush()
+
+
+def copy_record(src_fd, out, record, header=None):
+    # Write a full record (header and sequence lines) and make sure it ends
+    # with a line break so that the next record starts on its own line, the
+    # header line of the record is replaced by header when given
+    if header is None:
+        copy_range(src_fd, out, record.header_offset, record.end)
+    else:
+        out.write(header)
+        copy_range(src_fd, out, record.offset, record.end)
+    if record.end > record.header_offset:
+        last_byte = pread(src_fd, 1, record.end - 1)
+        if last_byte != b"\n":
+            out.write(b"\n")
+            out.flush()
+
+
+def is_uniform(record):
+    # Same test as samtools faidx: all lines but the last have the same size
+    if record.length == 0:
+        return True
+    full_lines, remainder = divmod(record.length, record.line_bases)
+    expected_end = record.offset + full_lines * record.line_width
+    if remainder:
+        expected_end += remainder + record.line_width - record.line_bases
+    return expected_end - (record.line_width - record.line_bases) <= record.end <= expected_end
+
+
+def write_fai(records, fai):
+    # Write the .fai index from an index_fasta() scan, returns False if the
+    # file can't be indexed because of irregular line lengths
+    if not all(is_uniform(record) for record in records):
+        return False
+    with open(fai, "w") as out:
+        for record in records:
+            out.write(
+                f"{record.name}\t{record.length}\t{record.offset}\t{record.line_bases}\t{record.line_width}\n"
+            )
+    return True
+
+
+def find_header(fd, offset):
+    # Offset of the '>' starting the header line that ends just before offset,
+    # headers are short and read backwards by small blocks
+    end = offset - 1
+    while end > 0:
+        start = max(0, end - HEADER_BLOCK_SIZE)
+        block = pread(fd, end - start, start)
+        line_start = block.rfind(b"\n")
+        if line_start != -1:
+            return start + line_start + 1
+        end = start
+    return 0
+
+
+def read_fai(genome):
+    # Records of an indexed fasta file, from the .fai index only
+    records = []
+    fd = open_fasta(genome)
+    size = data_size(fd)
+    with open(f"{genome}.fai") as fai:
+        for line in fai:
+            name, length, offset, line_bases, line_width = line.split("\t")[:5]
+            length, offset = int(length), int(offset)
+            line_bases, line_width = int(line_bases), int(line_width)
+            full_lines, remainder = divmod(length, line_bases) if line_bases else (0, 0)
+            end = offset + full_lines * line_width
+            if remainder:
+                end += remainder + line_width - line_bases
+            records.append(
+                FastaRecord(
+                    name,
+                    length,
+                    find_header(fd, offset),
+                    offset,
+                    min(end, size),
+                    line_bases,
+                    line_width,
+                )
+            )
+    close_fasta(fd)
+    return records
+
+
+def base_offset(record, position):
+    # Byte offset of a sequence position in a uniformly wrapped record
+    if record.line_bases == 0:
+        return record.offset
+    line, column = divmod(position, record.line_bases)
+    return record.offset + line * record.line_width + column
+
+
+def read_sequence(fd, record, start, end):
+    # Yield the bases of [start, end) of a record, without line breaks
+    byte_start = base_offset(record, start)
+    byte_end = min(base_offset(record, end), record.end)
+    while byte_start < byte_end:
+        block = pread(fd, min(byte_end - byte_start, BLOCK_SIZE), byte_start)
+        if not block:
+            break
+        byte_start += len(block)
+        yield block.replace(b"\n", b"").replace(b"\r", b"")
+
+
+def write_wrapped(out, blocks, line_size=60):
+    # Write sequence blocks to out, line_size bases per line
+    pending = b""
+    for block in blocks:
+        pending += block
+        full = len(pending) - len(pending) % line_size
+        if full:
+            out.write(
+                b"".join(
+                    pending[i : i + line_size] + b"\n" for i in range(0, full, line_size)
+                )
+            )
+            pending = pending[full:]
+    if pending:
+        out.write(pending + b"\n")
+
+
+# BGZF files
+
+
+def is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(path):
+    # gzip header with the BC extra field of BGZF, plain gzip files can't be
+    # read at random positions
+    with open(path, "rb") as f:
+        header = f.read(14)
+    return header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def open_text(path):
+    # Line by line reading of a plain or compressed fasta file
+    if is_gzip(path):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def block_size(fd, position):
+    # Sizes of the gzip header and of the whole BGZF block at position
+    header = os.pread(fd, 12, position)
+    extra_size = struct.unpack_from("<H", header, 10)[0]
+    extra = os.pread(fd, extra_size, position + 12)
+    i = 0
+    while i + 4 <= extra_size:
+        field_size = struct.unpack_from("<H", extra, i + 2)[0]
+        if extra[i : i + 2] == b"BC":
+            return 12 + extra_size, struct.unpack_from("<H", extra, i + 4)[0] + 1
+        i += 4 + field_size
+    raise ValueError(f"Not a BGZF block at offset {position}")
+
+
+def bgzf_blocks(fd):
+    # Blocks are found from their headers and trailers (uncompressed size),
+    # without decompressing them. Empty blocks are left out.
+    offsets = []
+    positions = []
+    offset = position = 0
+    file_size = os.fstat(fd).st_size
+    while position < file_size:
+        _, size = block_size(fd, position)
+        data_length = struct.unpack("<I", os.pread(fd, 4, position + size - 4))[0]
+        if data_length:
+            offsets.append(offset)
+            positions.append(position)
+        offset += data_length
+        position += size
+    return Bgzf(fd, offsets, positions, offset)
+
+
+def open_fasta(path):
+    # File descriptor of a plain fasta file, Bgzf of a compressed one. Both
+    # are read with pread().
+    fd = os.open(path, os.O_RDONLY)
+    if is_bgzf(path):
+        return bgzf_blocks(fd)
+    return fd
+
+
+def close_fasta(fd):
+    os.close(fd if isinstance(fd, int) else fd.fd)
+
+
+def data_size(fd):
+    if isinstance(fd, int):
+        return os.fstat(fd).st_size
+    return fd.size
+
+
+def pread(fd, size, offset):
+    # os.pread() in the uncompressed data of a Bgzf, only the blocks holding
+    # the bytes are decompressed
+    if isinstance(fd, int):
+        return os.pread(fd, size, offset)
+    index = bisect.bisect_right(fd.offsets, offset) - 1
+    if index < 0 or size <= 0:
+        return b""
+    skip = offset - fd.offsets[index]
+    blocks = []
+    remaining = skip + size
+    for position in fd.positions[index:]:
+        if remaining <= 0:
+            break
+        header_size, size_in_file = block_size(fd.fd, position)
+        block = os.pread(fd.fd, size_in_file, position)
+        blocks.append(zlib.decompress(block[header_size:-8], -15))
+        remaining -= len(blocks[-1])
+    return b"".join(blocks)[skip : skip + size]
+
+
+def write_gzi(genome, gzi):
+    # Index read by htslib (faidx) to fetch regions of a BGZF file: number of
+    # blocks after the first one, then their compressed and uncompressed
+    # offsets
+    fd = os.open(genome, os.O_RDONLY)
+    blocks = bgzf_blocks(fd)
+    os.close(fd)
+    write_gzi_entries(gzi, zip(blocks.positions[1:], blocks.offsets[1:]))
+
+
+def write_gzi_entries(gzi, entries):
+    entries = list(entries)
+    with open(gzi, "wb") as out:
+        out.write(struct.pack("<Q", len(entries)))
+        for position, offset in entries:
+            out.write(struct.pack("<QQ", position, offset))
+
+
+def compress_block(data, level):
+    # One BGZF block: gzip member with the BC extra field giving its size
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack(
+        "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25
+    )
+    return header + deflated + struct.pack("<2I", zlib.crc32(data), len(data))
+
+
+class BgzfWriter:
+    # Binary file object writing BGZF blocks, compressed by several threads
+    # (zlib releases the GIL) and written in order. The .gzi index of the file
+    # is written next to it when it is closed.
+
+    def __init__(self, path, threads=1, level=6):
+        self.path = path
+        self.out = open(path, "wb")
+        self.level = level
+        self.threads = max(1, int(threads))
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.buffer = bytearray()
+        self.blocks = deque()
+        self.index = []
+        self.position = self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self.buffer += data
+        full = len(self.buffer) - len(self.buffer) % BGZF_BLOCK_SIZE
+        for start in range(0, full, BGZF_BLOCK_SIZE):
+            block = bytes(self.buffer[start : start + BGZF_BLOCK_SIZE])
+            self.blocks.append((len(block), self.pool.submit(compress_block, block, self.level)))
+        del self.buffer[:full]
+        # A few blocks per thread are compressed ahead of the writes
+        while len(self.blocks) > 4 * self.threads:
+            self.write_block()
+
+    def write_block(self):
+        data_length, block = self.blocks.popleft()
+        block = block.result()
+        if self.position:
+            self.index.append((self.position, self.offset))
+        self.out.write(block)
+        self.position += len(block)
+        self.offset += data_length
+
+    def flush(self):
+        # Blocks are only written when full
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.blocks.append(
+                (len(self.buffer), self.pool.submit(compress_block, bytes(self.buffer), self.level))
+            )
+            self.buffer = bytearray()
+        while self.blocks:
+            self.write_block()
+        self.pool.shutdown()
+        self.out.write(BGZF_EOF)
+        self.out.close()
+        write_gzi_entries(f"{self.path}.gzi", self.index)
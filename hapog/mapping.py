@@ -1,15 +1,82 @@
+from collections import namedtuple
+
+from hapog import scheduler
+from hapog import telemetry
+
 import os
+import shutil
+import signal
 import subprocess
 import time
 import warnings
 
 
-def launch_PE_mapping(genome, pe1, pe2, threads, samtools_memory):
-    print("\nGenerating bwa index...", flush=True)
-    cmd = ["bwa", "index", genome]
+# An aligner:
+#   binary:  executable that must be found in $PATH
+#   index:   command building the index of the genome, None if not needed
+#   command: function(genome, reads, threads, preset) giving the command that
+#            writes SAM records to stdout
+#   preset:  default preset for (short reads, long reads), None if unused
+Aligner = namedtuple("Aligner", ["binary", "index", "command", "preset"])
+
+# How reads are mapped and sorted:
+#   aligner:    name of the aligner in ALIGNERS
+#   preset:     aligner preset (minimap2 -x), the default one of the aligner if None
+#   sort_tmp:   directory of the temporary files of samtools sort
+#   sort_level: compression level of the sorted BAM file (0: uncompressed)
+MappingOptions = namedtuple(
+    "MappingOptions", ["aligner", "preset", "sort_tmp", "sort_level"], defaults=(None, None, None)
+)
+
+# Seconds between two reads of the I/O counters of the mapping processes
+SAMPLING_PERIOD = 1
+
+
+def bwa_mem_cmd(genome, reads, threads, preset=None):
+    return ["bwa", "mem", "-t", str(threads), genome] + reads
+
+
+def bwa_mem2_cmd(genome, reads, threads, preset=None):
+    return ["bwa-mem2", "mem", "-t", str(threads), genome] + reads
+
+
+def minimap2_cmd(genome, reads, threads, preset):
+    return ["minimap2", "-t", str(threads), "-a", "--secondary=no", "-x", preset, genome] + reads
+
+
+ALIGNERS = {
+    "bwa": Aligner("bwa", ["bwa", "index"], bwa_mem_cmd, None),
+    "bwa-mem2": Aligner("bwa-mem2", ["bwa-mem2", "index"], bwa_mem2_cmd, None),
+    "minimap2": Aligner("minimap2", None, minimap2_cmd, ("sr", "map-pb")),
+}
+
+
+def samtools_sort_cmd(output, threads, memory, tmp_dir=None, level=None):
+    cmd = ["samtools", "sort", "-m", str(memory), "-@", str(threads)]
+    if tmp_dir:
+        # output may carry the index name (out.bam##idx##out.bam.bai)
+        cmd += ["-T", f"{tmp_dir}/{os.path.basename(output.split('##idx##')[0])}.tmp"]
+    if level is not None:
+        cmd += ["-l", str(level)]
+    return cmd + ["-o", output, "-"]
+
+
+SORTERS = {"samtools": samtools_sort_cmd}
+
+
+def default_aligner(long_reads):
+    return "minimap2" if long_reads else "bwa"
+
+
+def build_index(aligner, genome):
+    cmd = ALIGNERS[aligner].index
+    if cmd is None:
+        return
+    print(f"\nGenerating {aligner} index...", flush=True)
+    cmd = cmd + [genome]
 
     start = time.perf_counter()
-    with open("cmds/bwa_index.cmds", "w") as cmd_file:
+    with open(f"cmds/{aligner}_index.cmds", "w") as cmd_file:
         print(" ".join(cmd), flush=True, file=cmd_file)
 
     try:
@@ -17,8 +84,8 @@ def launch_PE_mapping(genome, pe1, pe2, threads, samtools_memory):
             warnings.simplefilter("ignore")
             _ = subprocess.run(
                 cmd,
-                stdout=open("logs/bwa_index.o", "w"),
-                stderr=open("logs/bwa_index.e", "w"),
+                stdout=open(f"logs/{aligner}_index.o", "w"),
+                stderr=open(f"logs/{aligner}_index.e", "w"),
                 check=True,
             )
     except Exception as e:
@@ -28,87 +95,184 @@ def launch_PE_mapping(genome, pe1, pe2, threads, samtools_memory):
 
     print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
-    print("\nLaunching mapping on genome...", flush=True)
-    cmd = "bash -c 'bwa mem -t %s %s " % (threads, genome)
-
-    streamer = "cat"
-    if pe1[0].endswith(".gz"):
-        streamer = "zcat"
-
-    if len(pe1) > 1:
-        cmd += f"<({streamer}"
-        for pe in pe1:
-            cmd += " %s" % pe
-        cmd += ") "
-        cmd += f"<({streamer}"
-        for pe in pe2:
-            cmd += " %s" % pe
-        cmd += ") 2> logs/bwa_mem.e"
-    else:
-        cmd += pe1[0] + " " + pe2[0] + " 2> logs/bwa_mem.e"
-
-    cmd += f" | samtools sort -m {samtools_memory} -@ {threads} -o bam/aln.sorted.bam - 2> logs/samtools_sort.e'"
 
-    start = time.perf_counter()
+def start_process(processes, name, cmd, log, **kwargs):
+    # Processes of a stream: (name, command, Popen, start time)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        proc = subprocess.Popen(cmd, stderr=open(log, "w"), **kwargs)
+    processes.append((name, cmd, proc, time.perf_counter()))
+    return proc
 
-    with open("cmds/mapping.cmds", "w") as cmd_file:
-        print(cmd, flush=True, file=cmd_file)
 
-    return_code = os.system(cmd)
-    if return_code != 0:
-        print(f"Error in bwa mem and samtools sort, return code: {return_code}")
-        print(f"Faulty command: {cmd}")
-        exit(1)
-    else:
-        print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
+def start_readers(processes, read_sets, threads):
+    # Each set of read files is given to the aligner as a single file. One
+    # file is read by the aligner itself, unless it is gzipped and pigz can
+    # decompress it faster. Several files are concatenated, as the aligner
+    # would do with a process substitution.
+    pigz = shutil.which("pigz") is not None
+    reads, fds = [], []
+    for i, files in enumerate(read_sets, 1):
+        gzipped = files[0].endswith(".gz")
+        if len(files) == 1 and not (gzipped and pigz):
+            reads.append(files[0])
+            continue
+        if gzipped and pigz:
+            cmd = ["pigz", "-dc", "-p", str(max(1, int(threads) // 8))] + files
+        elif gzipped:
+            cmd = ["gzip", "-dc"] + files
+        else:
+            cmd = ["cat"] + files
+        read_fd, write_fd = os.pipe()
+        start_process(processes, f"reads_{i}", cmd, f"logs/reads_{i}.e", stdout=write_fd)
+        os.close(write_fd)
+        reads.append(f"/dev/fd/{read_fd}")
+        fds.append(read_fd)
+    return reads, fds
 
-    index_bam()
 
+def start_aligner(processes, genome, read_sets, threads, options):
+    # Aligner and reader processes, returns the aligner whose stdout gives
+    # the SAM records
+    aligner = ALIGNERS[options.aligner]
+    reads, fds = start_readers(processes, read_sets, threads)
+    preset = None
+    if aligner.preset:
+        preset = options.preset or aligner.preset[len(read_sets) == 1]
+    proc = start_process(
+        processes,
+        options.aligner,
+        aligner.command(genome, reads, threads, preset),
+        f"logs/{options.aligner}.e",
+        stdout=subprocess.PIPE,
+        pass_fds=fds,
+    )
+    for fd in fds:
+        os.close(fd)
+    return proc
 
-def launch_LR_mapping(genome, long_reads, threads, samtools_memory):
-    print("\nLaunching mapping on genome...", flush=True)
-    cmd = f"bash -c 'minimap2 -t {threads} -a --secondary=no -x map-pb {genome} {long_reads} 2> logs/minimap2.e"
-    cmd += f" | samtools sort -m {samtools_memory} -@ {threads} -o bam/aln.sorted.bam - 2> logs/samtools_sort.e'"
 
-    start = time.perf_counter()
+def read_io(pid):
+    # Characters read and written by a running process
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io") as io:
+            for line in io:
+                key, value = line.split(":")
+                if key in ("rchar", "wchar"):
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def wait_stream(processes):
+    # Wait for all the processes of a stream. The I/O counters of each process
+    # are read while it runs and added with its resource usage to the
+    # telemetry report. When a process fails, the others are killed.
+    running = {proc.pid: (name, cmd, proc, start) for name, cmd, proc, start in processes}
+    io = {}
+    failed = []
+    while running:
+        try:
+            pid, status, usage = os.wait4(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            for pid in running:
+                io[pid] = read_io(pid) or io.get(pid, {})
+            time.sleep(SAMPLING_PERIOD)
+            continue
+        if pid not in running:
+            continue
+
+        name, cmd, proc, start = running.pop(pid)
+        proc.returncode = scheduler.exit_code(status)
+        wall_time = time.perf_counter() - start
+        counters = {}
+        if "rchar" in io.get(pid, {}):
+            counters = {
+                "read_chars": io[pid]["rchar"],
+                "written_chars": io[pid]["wchar"],
+                "write_rate": int(io[pid]["wchar"] / wall_time) if wall_time else 0,
+            }
+        telemetry.add_job(name, wall_time, usage, 0, proc.returncode, counters)
 
-    with open("cmds/mapping.cmds", "w") as cmd_file:
-        print(cmd, flush=True, file=cmd_file)
+        # processes killed after a failure are not reported
+        if proc.returncode != 0 and not (failed and proc.returncode == -signal.SIGKILL):
+            failed.append((name, cmd, proc.returncode))
+            for _, _, other, _ in running.values():
+                other.kill()
 
-    return_code = os.system(cmd)
-    if return_code != 0:
-        print(f"Error in minimap2 and samtools sort, return code: {return_code}")
-        print(f"Faulty command: {cmd}")
+    if failed:
+        for name, cmd, return_code in failed:
+            print(f"ERROR: {name} didn't finish successfully, exit code: {return_code}")
+            print("Faulty command: %s" % (" ".join(cmd)))
+            print(f"See logs/{name}.e")
         exit(1)
-    else:
-        print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
-    index_bam()
+
+def log_stream(processes, cmd_log):
+    with open(cmd_log, "w") as cmd_file:
+        for _, cmd, _, _ in processes:
+            print(" ".join(cmd), flush=True, file=cmd_file)
 
 
-def remove_secondary_alignments(bam, output_dir):
-    print("\nRemoving secondary alignments from BAM file...", flush=True)
-    cmd = ["samtools", "view", "-b", "-h", "-F", "0x900", bam]
+def launch_mapping(genome, read_sets, threads, samtools_memory, options):
+    # read_sets: [pe1 files, pe2 files] or [[long read file]]
+    build_index(options.aligner, genome)
 
+    print("\nLaunching mapping on genome...", flush=True)
     start = time.perf_counter()
-    with open(f"{output_dir}/cmds/samtools_view.cmds", "w") as cmd_file:
-        print(" ".join(cmd), flush=True, file=cmd_file)
-        
-    try:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            _ = subprocess.run(
-                cmd,
-                stdout=open(f"{output_dir}/bam/aln.sorted.bam", "w"),
-                stderr=open(f"{output_dir}/logs/samtools_view.e", "w"),
-                check=True,
-            )
-    except Exception as e:
-        print("\nERROR: Couldn't remove secondary alignments")
-        print(e)
-        exit(1)
+    processes = []
+    aligner = start_aligner(processes, genome, read_sets, threads, options)
+    sort_cmd = SORTERS["samtools"](
+        "bam/aln.sorted.bam", threads, samtools_memory, options.sort_tmp, options.sort_level
+    )
+    start_process(
+        processes,
+        "samtools_sort",
+        sort_cmd,
+        "logs/samtools_sort.e",
+        stdin=aligner.stdout,
+        stdout=subprocess.DEVNULL,
+    )
+    # the aligner gets SIGPIPE if the sort stops
+    aligner.stdout.close()
+    log_stream(processes, "cmds/mapping.cmds")
+    wait_stream(processes)
     print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
+    index_bam()
+
+
+def find_index(bam):
+    # Index of a BAM file, ignored when it is older than the BAM file
+    for index in (f"{bam}.bai", f"{os.path.splitext(bam)[0]}.bai", f"{bam}.csi"):
+        if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(bam):
+            return index
+    return None
+
+
+def link_bam(bam):
+    # The BAM file given with -b is read in place, with its own index when
+    # there is one. Returns False when the BAM file still has to be indexed.
+    if os.path.realpath("bam/aln.sorted.bam") != os.path.realpath(bam):
+        if os.path.lexists("bam/aln.sorted.bam"):
+            os.remove("bam/aln.sorted.bam")
+        os.symlink(bam, "bam/aln.sorted.bam")
+
+    index = find_index(bam)
+    if index is None:
+        return False
+    link = "bam/aln.sorted.bam" + os.path.splitext(index)[1]
+    if os.path.realpath(link) != os.path.realpath(index):
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(index, link)
+    print(f"\nUsing the index of the BAM file: {index}", flush=True)
+    return True
+
 
 def index_bam():
     print("\nIndexing the BAM file...", flush=True)
@@ -1,22 +1,40 @@
-from Bio import SeqIO
+from hapog import checkpoint
+from hapog import fasta
+from hapog import mapping
+from hapog import planner
+from hapog import scheduler
+from hapog import scratch
+from hapog import telemetry
+from hapog import workqueue
 
 import glob
+import heapq
+import itertools
 import os
 import shutil
 import subprocess
 import time
-import warnings
+
+
+# Number of chunks created for each Hapo-G job allowed to run in parallel
+CHUNKS_PER_JOB = 4
+MANIFEST = "chunks/manifest.tsv"
+# Flags of the alignments skipped in the BAM files given with -b: secondary
+# and supplementary alignments
+SECONDARY_FILTER = "0x900"
+# Assembly read by the Hapo-G jobs and its indexes, the .gzi index is only
+# written for a BGZF-compressed assembly
+ASSEMBLY_FILES = ["assembly.fasta", "assembly.fasta.fai", "assembly.fasta.gzi"]
 
 
 def is_in_path(tool):
     return shutil.which(tool) is not None
 
 
-def check_dependencies():
+def check_dependencies(tools):
     missing_dependency = False
     print("\nChecking dependencies...", flush=True)
 
-    tools = ["bwa", "samtools"]
     for tool in tools:
         if not is_in_path(tool):
             print(f"\tWARNING: {tool} not found.", flush=True)
@@ -30,7 +48,7 @@ def check_dependencies():
 
 def check_fasta_headers(genome):
     authorized_chars = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-_"
-    with open(genome) as genome_file:
+    with fasta.open_text(genome) as genome_file:
         for line in genome_file:
             if line.startswith(">"):
                 header = line[1:].rstrip("\n")
@@ -41,34 +59,82 @@ def check_fasta_headers(genome):
 
 
 def get_genome_size(genome):
-    cumul_size = 0
-    with open(genome) as genome_file:
-        for record in SeqIO.parse(genome_file, "fasta"):
-            cumul_size += len(record.seq)
-    return cumul_size
+    return sum(record.length for record in fasta.index_fasta(genome))
+
+
+def link_assembly(genome):
+    for f in ("assembly.fasta", "correspondance.txt"):
+        if os.path.lexists(f):
+            os.remove(f)
+    os.symlink(genome, "assembly.fasta")
 
 
-def rename_assembly(genome):
+def rename_assembly(genome, threads=1):
+    # assembly.fasta may be a link to the input genome made by a previous run.
+    # A compressed genome is written compressed again.
+    if os.path.lexists("assembly.fasta"):
+        os.remove("assembly.fasta")
     correspondance_file = open("correspondance.txt", "w")
-    with open("assembly.fasta", "w") as out:
+    if fasta.is_bgzf(genome):
+        out = fasta.BgzfWriter("assembly.fasta", threads)
+    else:
+        out = open("assembly.fasta", "wb")
+    with out:
         counter = 0
-        with open(genome) as genome_file:
+        with fasta.open_text(genome) as genome_file:
             for line in genome_file:
                 if line.startswith(">"):
-                    out.write(f">Contig{counter}\n")
+                    out.write(f">Contig{counter}\n".encode())
                     correspondance_file.write(f"Contig{counter}\t{line[1:]}")
                     counter += 1
                 else:
-                    out.write(line)
+                    out.write(line.encode())
     correspondance_file.close()
 
 
-def create_chunks(genome, threads):
-    cumul_size = get_genome_size(genome)
-
-    chunk_size = cumul_size / int(threads)
+def plan_chunks(loads, nb_chunks):
+    # Longest-processing-time-first bin packing: pieces of work are taken from
+    # the longest to the shortest and always given to the least loaded chunk
+    heap = [(0, i) for i in range(nb_chunks)]
+    chunks = [[] for _ in range(nb_chunks)]
+    for index in sorted(range(len(loads)), key=lambda i: -loads[i]):
+        load, chunk = heapq.heappop(heap)
+        chunks[chunk].append(index)
+        heapq.heappush(heap, (load + loads[index], chunk))
+
+    # Most loaded chunks first so that they are launched first, pieces of a
+    # chunk in their original order
+    chunks = [sorted(chunk) for chunk in chunks if chunk]
+    chunks.sort(key=lambda chunk: -sum(loads[i] for i in chunk))
+    return chunks
+
+
+def split_record(record, window_size):
+    if not window_size or record.length <= window_size:
+        return [(0, record.length)]
+    return [
+        (start, min(start + window_size, record.length))
+        for start in range(0, record.length, window_size)
+    ]
+
+
+def create_chunks(genome, threads, window_size=0, window_overlap=0):
+    records = fasta.index_fasta(genome)
+    cumul_size = sum(record.length for record in records)
+
+    # Whole records, or windows of long records when window_size is set.
+    # Windows are polished after window_overlap bases used to select reads.
+    pieces = [
+        (index, start, end)
+        for index, record in enumerate(records)
+        for start, end in split_record(record, window_size)
+    ]
+    loads = [end - start + (window_overlap if start > 0 else 0) for _, start, end in pieces]
+
+    nb_chunks = max(1, min(len(pieces), int(threads) * CHUNKS_PER_JOB))
+    chunks = plan_chunks(loads, nb_chunks)
     print(
-        f"\nFragmenting the genome into {threads} chunks of {int(chunk_size):,} bases (depending of scaffold sizes)",
+        f"\nFragmenting the genome into {len(chunks)} chunks of about {int(cumul_size / max(1, len(chunks))):,} bases (depending of scaffold sizes)",
         flush=True,
     )
     try:
@@ -76,33 +142,94 @@ def create_chunks(genome, threads):
     except:
         pass
 
-    current_chunk = 1
-    current_chunk_size = 0
-    current_chunk_file = open("chunks/chunks_1.fasta", "w")
-    current_bed_file = open("chunks/chunks_1.bed", "w")
+    # Chunks of a previous run may not all be created again
+    for f in glob.glob("chunks/chunks_*.bed") + glob.glob("chunks_bam/chunks_*.bam*"):
+        os.remove(f)
 
     start = time.perf_counter()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-
-        for record in SeqIO.parse(open(genome), "fasta"):
-            if current_chunk_size >= chunk_size and current_chunk != threads:
-                current_chunk_file.close()
-                current_chunk_file = open(f"chunks/chunks_{current_chunk + 1}.fasta", "w")
-                current_bed_file = open(f"chunks/chunks_{current_chunk + 1}.bed", "w")
-                current_chunk += 1
-                current_chunk_size = 0
-
-            current_chunk_file.write(record.format("fasta"))
-            current_bed_file.write(f"{record.id}\t0\t{len(record.seq)}\n")
-            current_chunk_size += len(record.seq)
+    chunk_of_piece = {}
+    for chunk_number, chunk in enumerate(chunks, 1):
+        for piece in chunk:
+            chunk_of_piece[piece] = chunk_number
+
+    # Consecutive windows that ended up in the same chunk are polished together
+    regions = []
+    for piece, (index, piece_start, piece_end) in enumerate(pieces):
+        chunk_number = chunk_of_piece[piece]
+        if regions and regions[-1][0] == index and regions[-1][3] == chunk_number:
+            regions[-1][2] = piece_end
+        else:
+            regions.append([index, piece_start, piece_end, chunk_number])
+
+    # Hapo-G reads the regions of its chunk from the indexed genome and BAM
+    # files, chunks only list these regions
+    if not fasta.write_fai(records, f"{genome}.fai"):
+        index_fasta_with_samtools(genome)
+    elif fasta.is_bgzf(genome):
+        fasta.write_gzi(genome, f"{genome}.gzi")
+    for chunk_number in range(1, len(chunks) + 1):
+        with open(f"chunks/chunks_{chunk_number}.bed", "w") as bed_file:
+            for index, region_start, region_end, region_chunk in regions:
+                if region_chunk == chunk_number:
+                    context_start = max(0, region_start - window_overlap)
+                    bed_file.write(f"{records[index].name}\t{context_start}\t{region_end}\n")
+
+    # Chunk of each contig or window, in the order of the input genome
+    with open(MANIFEST, "w") as manifest:
+        for index, region_start, region_end, chunk_number in regions:
+            manifest.write(
+                f"{records[index].name}\t{region_start}\t{region_end}\tchunks_{chunk_number}\n"
+            )
     print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
-    current_chunk_file.close()
-    current_bed_file.close()
 
+def index_fasta_with_samtools(genome):
+    cmd = ["samtools", "faidx", genome]
+    with open("cmds/samtools_faidx.cmds", "w") as cmd_file:
+        print(" ".join(cmd), flush=True, file=cmd_file)
+
+    try:
+        _ = subprocess.run(
+            cmd,
+            stdout=open("logs/samtools_faidx.o", "w"),
+            stderr=open("logs/samtools_faidx.e", "w"),
+            check=True,
+        )
+    except Exception as e:
+        print("\nERROR: Couldn't index genome", flush=True)
+        print(e)
+        exit(1)
+
+
+def read_manifest():
+    manifest = []
+    with open(MANIFEST) as manifest_file:
+        for line in manifest_file:
+            contig, start, end, chunk = line.rstrip("\n").split("\t")
+            manifest.append((contig, int(start), int(end), chunk))
+    return manifest
+
+
+def bed_size(bed):
+    # Total and longest region sizes of a bed file
+    size = longest = 0
+    with open(bed) as bed_file:
+        for line in bed_file:
+            _, region_start, region_end = line.split("\t")[:3]
+            size += int(region_end) - int(region_start)
+            longest = max(longest, int(region_end) - int(region_start))
+    return size, longest
 
-def extract_bam(processes):
+
+def find_binary(binary, build_name):
+    # Installed binaries first (conda), then the ones compiled by build.sh
+    if is_in_path(binary):
+        return binary
+    script_path = os.path.realpath(__file__).replace("/hapog/pipeline.py", "")
+    return f"{script_path}/hapog_build/{build_name}"
+
+
+def extract_bam(processes, bam_filter=None):
     print("\nExtracting bam for each chunk", flush=True)
     try:
         os.mkdir("chunks_bam")
@@ -111,46 +238,114 @@ def extract_bam(processes):
 
     start = time.perf_counter()
 
-    cmds = []
-    nb_beds = 0
-    for bed in glob.glob("chunks/*.bed"):
-        nb_beds += 1
-        cmds.append(["samtools", "view", "-ML", bed, "-b", "bam/aln.sorted.bam"])
-
-    procs = []
-    for j in range(0, len(cmds)):
-        cmd = cmds.pop(0)
-        bam = "chunks_bam/" + cmd[3].split("/")[1].replace(".bed", ".bam")
-        with open("cmds/extract_bam.cmds", "a") as cmd_file:
-            print(" ".join(cmd), flush=True, file=cmd_file)
+    # The BAM file is read once, each alignment is sent to the chunks that
+    # contain its reference sequence. Regions are fetched by Hapo-G through
+    # the index of the chunk BAM files.
+    cmd = [
+        find_binary("hapog_split", "hapog_split"),
+        "-b",
+        "bam/aln.sorted.bam",
+        "-o",
+        "chunks_bam",
+        "-@",
+        str(processes),
+        "-x",
+    ]
+    if bam_filter:
+        cmd += ["-F", bam_filter]
+    cmd += sorted(glob.glob("chunks/*.bed"))
+
+    with open("cmds/extract_bam.cmds", "w") as cmd_file:
+        print(" ".join(cmd), flush=True, file=cmd_file)
 
-        # Ignore the ResourceWarning about unclosed files
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            procs.append(
-                subprocess.Popen(
-                    cmd,
-                    stdout=open(bam, "w"),
-                    stderr=open("logs/samtools_split.e", "a"),
-                )
-            )
+    try:
+        _ = subprocess.run(
+            cmd,
+            stdout=open("logs/hapog_split.o", "w"),
+            stderr=open("logs/hapog_split.e", "w"),
+            check=True,
+        )
+    except Exception as e:
+        print("\nERROR: Couldn't split the BAM file", flush=True)
+        print(e)
+        exit(1)
 
-    has_failed = False
-    for p in procs:
-        p.wait()
+    print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
-        if p.returncode != 0:
-            print(f"ERROR: Samtools view didn't finish correctly, return code: {p.returncode}")
-            print("Faulty command: {p.args}")
-            has_failed = True
 
-    if has_failed:
-        exit(1)
+def map_to_chunks(genome, read_sets, threads, samtools_memory, options):
+    # The alignments are sent to the chunks while they are produced by the
+    # aligner and each chunk is sorted on its own, no global BAM file is written
+    mapping.build_index(options.aligner, genome)
+
+    print("\nLaunching mapping on genome, alignments are sorted by chunk...", flush=True)
+    os.makedirs("chunks_bam/fifo", exist_ok=True)
+    start = time.perf_counter()
+
+    beds = sorted(glob.glob("chunks/*.bed"), key=lambda f: int(f.split("_")[-1].replace(".bed", "")))
+    # The memory of a single samtools sort is shared by the sorts of all chunks
+    memory = max(64 * 1024 ** 2, planner.parse_memory(samtools_memory) * int(threads) // len(beds))
+
+    processes = []
+    for bed in beds:
+        chunk_prefix = os.path.basename(bed).replace(".bed", "")
+        fifo = f"chunks_bam/fifo/{chunk_prefix}.bam"
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+        bam = f"chunks_bam/{chunk_prefix}.bam"
+        cmd = mapping.SORTERS["samtools"](
+            f"{bam}##idx##{bam}.bai",
+            0,
+            f"{memory // 1024 ** 2}M",
+            options.sort_tmp,
+            options.sort_level,
+        )
+        # samtools sort reads the FIFO of the chunk instead of its stdin
+        cmd = cmd[:-1] + ["--write-index", fifo]
+        mapping.start_process(
+            processes,
+            f"samtools_sort_{chunk_prefix}",
+            cmd,
+            f"logs/samtools_sort_{chunk_prefix}.e",
+            stdout=subprocess.DEVNULL,
+        )
+    with open("cmds/chunks_sort.cmds", "w") as cmd_file:
+        for _, cmd, _, _ in processes:
+            print(" ".join(cmd), flush=True, file=cmd_file)
+
+    aligner = mapping.start_aligner(processes, genome, read_sets, threads, options)
+    mapping.start_process(
+        processes,
+        "hapog_split",
+        [find_binary("hapog_split", "hapog_split"), "-b", "-", "-o", "chunks_bam/fifo", "-u"]
+        + beds,
+        "logs/hapog_split.e",
+        stdin=aligner.stdout,
+        stdout=open("logs/hapog_split.o", "w"),
+    )
+    aligner.stdout.close()
+    mapping.log_stream(processes[len(beds) :], "cmds/mapping.cmds")
 
+    mapping.wait_stream(processes)
+    shutil.rmtree("chunks_bam/fifo")
     print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
 
-def launch_hapog(hapog_bin, parallel_jobs, chunk_list=None):
+def launch_hapog(
+    hapog_bin,
+    parallel_jobs,
+    chunk_list=None,
+    window_overlap=0,
+    retries=scheduler.RETRIES,
+    memory=0,
+    bam_filter=None,
+    scatter=False,
+    local_workers=0,
+    scratch_dir=None,
+    scratch_size=None,
+):
     if chunk_list:
         print(f"\nLaunching Hapo-G on specified chunks: {chunk_list}", flush=True)
     else:
@@ -162,19 +357,24 @@ def launch_hapog(hapog_bin, parallel_jobs, chunk_list=None):
 
     start = time.perf_counter()
 
-    script_path = os.path.realpath(__file__).replace("/hapog/pipeline.py", "")
     if not hapog_bin:
-        if not is_in_path("hapog_bin"):
-            hapog_bin = f"{script_path}/hapog_build/hapog"
-        else:
-            hapog_bin = "hapog_bin"
+        hapog_bin = find_binary("hapog_bin", "hapog")
     else:
         print(f"Using this bin: {hapog_bin}")
 
-    procs = []
-    for chunk in glob.glob("chunks/*.fasta"):
-        chunk_prefix = chunk.split("/")[-1].replace(".fasta", "")
-
+    # Chunks are staged on a node-local scratch, the output directory only
+    # sees the copies of their inputs and outputs
+    shared = {}
+    if scratch_dir:
+        scratch.setup(scratch_dir, scratch_size)
+        shared = scratch.share(checkpoint.expand(ASSEMBLY_FILES))
+
+    # Chunks are numbered from the most to the least loaded
+    chunk_prefixes = [os.path.basename(f).replace(".bed", "") for f in glob.glob("chunks/*.bed")]
+    jobs = []
+    stages = []
+    nb_done = 0
+    for chunk_prefix in sorted(chunk_prefixes, key=lambda c: int(c.split("_")[-1])):
         # Extract chunk number from chunk_prefix (e.g., "chunks_12" -> 12)
         chunk_number = int(chunk_prefix.split("_")[-1])
 
@@ -182,53 +382,163 @@ def launch_hapog(hapog_bin, parallel_jobs, chunk_list=None):
         if chunk_list and chunk_number not in chunk_list:
             continue
 
+        # Regions are read from the BAM file of the chunk when it was extracted
+        bed = f"chunks/{chunk_prefix}.bed"
+        bam = f"chunks_bam/{chunk_prefix}.bam"
+        if not os.path.exists(bam):
+            bam = "bam/aln.sorted.bam"
+
         cmd = [
             hapog_bin,
             "-b",
-            f"chunks_bam/{chunk_prefix}.bam",
+            bam,
             "-f",
-            chunk,
+            "assembly.fasta",
+            "-r",
+            bed,
+            "-w",
+            str(window_overlap),
             "-o",
             f"hapog_chunks/{chunk_prefix}.fasta",
             "-c",
             f"hapog_chunks/{chunk_prefix}.changes",
+            "-m",
+            f"logs/hapog_{chunk_prefix}.metrics",
         ]
-        with open("cmds/hapog.cmds", "a") as cmd_file:
-            print(" ".join(cmd), flush=True, file=cmd_file)
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            procs.append(
-                subprocess.Popen(
-                    cmd,
-                    stdout=open(f"logs/hapog_{chunk_prefix}.o", "w"),
-                    stderr=open(f"logs/hapog_{chunk_prefix}.e", "w"),
-                )
-            )
+        if bam_filter:
+            cmd += ["-F", bam_filter]
+
+        # Chunks polished by a previous run are skipped, unless asked for
+        inputs = [bed, bam, f"{bam}.bai", "bam/aln.sorted.bam"] + ASSEMBLY_FILES
+        params = {"cmd": cmd}
+        if not chunk_list and checkpoint.is_done(f"hapog_{chunk_prefix}", inputs, params):
+            nb_done += 1
+            continue
 
-        # Only launch a job if there is less than 'parallel_jobs' running
-        # Otherwise, wait for any to finish before launching a new one
-        while len([p for p in procs if p.poll() is None]) >= int(parallel_jobs):
-            time.sleep(1)
+        size, longest = bed_size(bed)
+        job = scheduler.Job(
+            cmd,
+            f"logs/hapog_{chunk_prefix}.o",
+            f"logs/hapog_{chunk_prefix}.e",
+            size=size,
+            memory=planner.region_memory(longest),
+            name=f"hapog_{chunk_prefix}",
+        )
+        outputs = [f"hapog_chunks/{chunk_prefix}.fasta", f"hapog_chunks/{chunk_prefix}.changes"]
+        if scratch_dir:
+            # The BAM file of the whole assembly is read in place, only the
+            # regions of the chunk are read from it
+            staged = [bed] + ([bam, f"{bam}.bai"] if bam != "bam/aln.sorted.bam" else [])
+            logs = [job.stdout, job.stderr, f"logs/hapog_{chunk_prefix}.metrics"]
+            # Polished sequences and changes of the chunk, with room for the logs
+            job = scratch.prepare(job, staged, outputs + logs, shared, 2 * size + 1024 ** 2)
+        jobs.append(job)
+        stages.append((f"hapog_{chunk_prefix}", inputs, params, outputs))
+
+    if nb_done:
+        print(f"{nb_done} chunks already polished, skipping them", flush=True)
+
+    if scatter:
+        failed = workqueue.run_jobs(
+            jobs, stages, retries, cmd_log="cmds/hapog.cmds", local_workers=local_workers
+        )
+    else:
+        failed = scheduler.run_jobs(
+            jobs, parallel_jobs, retries, cmd_log="cmds/hapog.cmds", memory=memory
+        )
+    if scratch_dir:
+        scratch.wait()
+    for job, return_code in failed:
+        print(f"ERROR: Hapo-G didn't finish successfully, exit code: {return_code}")
+        print("Faulty command: %s" % (" ".join(job.cmd)))
+
+    failed_jobs = [job for job, _ in failed]
+    for job, stage in zip(jobs, stages):
+        telemetry.add_counters(job.name, f"logs/{job.name}.metrics")
+        if job not in failed_jobs:
+            checkpoint.record(*stage)
+
+    if failed:
+        exit(1)
 
-    has_failed = False
-    for p in procs:
-        p.wait()
+    print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
 
-        return_code = p.returncode
-        if return_code != 0:
-            print(f"ERROR: Hapo-G didn't finish successfully, exit code: {return_code}")
-            print("Faulty command: %s" % (" ".join(p.args)))
-            has_failed = True
 
-    if has_failed:
-        exit(1)
+def index_changes(changes):
+    # Byte ranges of the lines of each contig in a changes file
+    ranges = {}
+    offset = 0
+    with open(changes, "rb") as changes_file:
+        for line in changes_file:
+            contig = line.split(b"\t", 1)[0].decode()
+            contig_ranges = ranges.setdefault(contig, [])
+            if contig_ranges and contig_ranges[-1][1] == offset:
+                contig_ranges[-1][1] = offset + len(line)
+            else:
+                contig_ranges.append([offset, offset + len(line)])
+            offset += len(line)
+    return ranges
+
+
+def polished_region(fd, record):
+    # Contig and start of the region polished in a Hapo-G output record, windows
+    # are described by a 'contig:start-end' region after the sequence name
+    header = os.pread(fd, record.offset - record.header_offset, record.header_offset)
+    header = header.decode().split()
+    contig = record.name.replace("_polished", "")
+    if len(header) > 1 and ":" in header[1]:
+        return (contig, int(header[1].rsplit(":", 1)[1].split("-")[0]) - 1)
+    return (contig, 0)
+
+
+def stitch_windows(out, contig, pieces, polished, assembly_fd, assembly, header):
+    # Join the polished windows of a contig, windows without reads keep the
+    # sequence of the assembly
+    if not any((contig, piece_start) in polished for _, piece_start, _, _ in pieces):
+        return False
+
+    blocks = []
+    for _, piece_start, piece_end, _ in pieces:
+        if (contig, piece_start) in polished:
+            fd, record = polished[(contig, piece_start)]
+            blocks.append(fasta.read_sequence(fd, record, 0, record.length))
+        else:
+            blocks.append(
+                fasta.read_sequence(assembly_fd, assembly[contig], piece_start, piece_end)
+            )
 
-    print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
+    out.write((header or f">{contig}_polished\n").encode())
+    fasta.write_wrapped(out, itertools.chain.from_iterable(blocks))
+    return True
 
 
-def merge_results(threads):
-    print("\nMerging results", flush=True)
+def read_correspondance():
+    # Original name of each renamed sequence
+    names = {}
+    if os.path.exists("correspondance.txt"):
+        with open("correspondance.txt") as correspondance_file:
+            for line in correspondance_file:
+                new, original = line.rstrip("\n").split("\t", 1)
+                names[new] = original
+    return names
+
+
+def rename_changes(lines, contig, names):
+    # Give back its original name to the contig of a block of changes lines
+    if contig not in names:
+        return lines
+    prefix = len(contig)
+    original = names[contig].encode()
+    return b"".join(original + line[prefix:] for line in lines.splitlines(True))
+
+
+def write_results(include_unpolished=False, compress=False, threads=1):
+    # Single pass over the Hapo-G outputs: polished sequences and changes are
+    # copied in the genome order, renamed sequences get back their original
+    # name and unpolished sequences are copied from the assembly. With
+    # compress, sequences are written to hapog.fasta.gz in BGZF blocks
+    # compressed by several threads.
+    print("\nWriting results", flush=True)
     try:
         os.mkdir("hapog_results")
     except:
@@ -241,86 +551,101 @@ def merge_results(threads):
         pass
 
     start = time.perf_counter()
+    names = read_correspondance()
 
-    with open("hapog_results/hapog.fasta.tmp", "w") as out:
-        for i in range(1, threads + 1):
-            f = f"hapog_chunks/chunks_{i}.fasta"
-            if os.path.exists(f):
-                with open(f, "r") as fd:
-                    shutil.copyfileobj(fd, out)
-                    out.write("\n")
-
-    with open("hapog_results/hapog.changes.tmp", "w") as out:
-        for i in range(1, threads + 1):
-            f = f"hapog_chunks/chunks_{i}.changes"
-            if os.path.exists(f):
-                with open(f, "r") as fd:
-                    shutil.copyfileobj(fd, out)
-                    out.write("\n")
-
-    print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
-
-
-def rename_results():
-    correspondance_file = open("correspondance.txt")
-    dict_correspondance = {}
-    for line in correspondance_file:
-        new, original = line.strip("\n").split("\t")
-        dict_correspondance[new] = original
-    correspondance_file.close()
-
-    with open("hapog_results/hapog.fasta", "w") as out:
-        hapog_tmp = open("hapog_results/hapog.fasta.tmp")
-        for record in SeqIO.parse(hapog_tmp, "fasta"):
-            out.write(f">{dict_correspondance[str(record.id).replace('_polished', '')]}\n{record.seq}\n")
-        hapog_tmp.close()
-
-    with open("hapog_results/hapog.changes", "w") as out:
-        hapog_tmp = open("hapog_results/hapog.changes.tmp")
-        for line in hapog_tmp:
-            line = line.strip("\n").split("\t")
-            try:
-                line[0] = dict_correspondance[line[0]]
-            except:
-                continue
-            line = "\t".join(line)
-            out.write(f"{line}\n")
-        hapog_tmp.close()
-
-    for f in glob.glob("assembly.fasta*"):
-        os.remove(f)
-    os.remove("hapog_results/hapog.fasta.tmp")
-    os.remove("hapog_results/hapog.changes.tmp")
-
-
-def include_unpolished(genome):
-    print("\nWriting unpolished contigs to final output...")
-    start = time.perf_counter()
-
-    initial_contig_names = set()
-    if os.path.exists("correspondance.txt"):
-        with open("correspondance.txt") as corr:
-            for line in corr:
-                _, initial = line.strip("\n").split("\t")
-                initial_contig_names.add(initial)
+    if os.path.exists(MANIFEST):
+        manifest = read_manifest()
     else:
-        with open(genome) as genome_file:
-            for line in genome_file:
-                if line.startswith(">"):
-                    initial_contig_names.add(line[1:].strip("\n"))
-
-    polished_contig_names = set()
-    with open("hapog_results/hapog.fasta") as fasta:
-        for line in fasta:
-            if line.startswith(">"):
-                contig_name = line[1:].strip("\n").replace("_polished", "")
-                polished_contig_names.add(contig_name)
-
-    with open("hapog_results/hapog.fasta", "a") as out:
-        genome_file = open(genome)
-        for record in SeqIO.parse(genome_file, "fasta"):
-            if record.description.replace("_polished", "") not in polished_contig_names:
-                out.write(record.format("fasta"))
-        genome_file.close()
+        # Chunks were not planned (single Hapo-G job), keep their order
+        manifest = []
+        for f in sorted(
+            glob.glob("hapog_chunks/*.fasta"),
+            key=lambda f: int(f.split("_")[-1].replace(".fasta", "")),
+        ):
+            chunk = os.path.basename(f).replace(".fasta", "")
+            for record in fasta.index_fasta(f):
+                manifest.append((record.name.replace("_polished", ""), 0, record.length, chunk))
+
+    # Polished sequences and changes are copied back in the genome order
+    chunks = sorted(set(chunk for _, _, _, chunk in manifest))
+    polished = {}
+    changes = {}
+    fds = {}
+    for chunk in chunks:
+        fasta_file = f"hapog_chunks/{chunk}.fasta"
+        changes_file = f"hapog_chunks/{chunk}.changes"
+        if os.path.exists(fasta_file):
+            fd = os.open(fasta_file, os.O_RDONLY)
+            fds[fasta_file] = fd
+            for record in fasta.index_fasta(fasta_file):
+                polished[polished_region(fd, record)] = (fd, record)
+        if os.path.exists(changes_file):
+            fds[changes_file] = os.open(changes_file, os.O_RDONLY)
+            changes[chunk] = (fds[changes_file], index_changes(changes_file))
+
+    contigs = [
+        (contig, list(pieces))
+        for contig, pieces in itertools.groupby(manifest, key=lambda piece: piece[0])
+    ]
+
+    assembly = {}
+    if include_unpolished or any(len(pieces) > 1 for _, pieces in contigs):
+        if not os.path.exists("assembly.fasta.fai"):
+            index_fasta_with_samtools("assembly.fasta")
+        fds["assembly.fasta"] = fasta.open_fasta("assembly.fasta")
+        assembly = {record.name: record for record in fasta.read_fai("assembly.fasta")}
+
+    results = "hapog_results/hapog.fasta.gz" if compress else "hapog_results/hapog.fasta"
+    if compress:
+        out = fasta.BgzfWriter(f"{results}.tmp", threads)
+    else:
+        out = open(f"{results}.tmp", "wb")
+    written = set()
+    with out:
+        for contig, pieces in contigs:
+            header = f">{names[contig]}\n" if contig in names else None
+            if len(pieces) == 1:
+                if (contig, 0) in polished:
+                    fd, record = polished[(contig, 0)]
+                    fasta.copy_record(fd, out, record, header and header.encode())
+                    written.add(contig)
+            elif stitch_windows(
+                out, contig, pieces, polished, fds.get("assembly.fasta"), assembly, header
+            ):
+                written.add(contig)
+
+        if include_unpolished:
+            for contig, record in assembly.items():
+                if contig not in written:
+                    header = f">{names[contig]}\n".encode() if contig in names else None
+                    fasta.copy_record(fds["assembly.fasta"], out, record, header)
+
+    with open("hapog_results/hapog.changes.tmp", "wb") as out:
+        for contig, pieces in contigs:
+            contig_changes = []
+            for chunk in dict.fromkeys(chunk for _, _, _, chunk in pieces):
+                if chunk in changes and contig in changes[chunk][1]:
+                    fd, ranges = changes[chunk][0], changes[chunk][1][contig]
+                    contig_changes += [(fd, range_start, range_end) for range_start, range_end in ranges]
+
+            if len(pieces) == 1 and contig not in names:
+                for fd, range_start, range_end in contig_changes:
+                    fasta.copy_range(fd, out, range_start, range_end)
+            else:
+                # Windows may come from several chunks, sort changes by position
+                lines = []
+                for fd, range_start, range_end in contig_changes:
+                    lines += os.pread(fd, range_end - range_start, range_start).splitlines(True)
+                if len(pieces) > 1:
+                    lines.sort(key=lambda line: int(line.split(b"\t", 2)[1]))
+                out.write(rename_changes(b"".join(lines), contig, names))
+
+    for fd in fds.values():
+        fasta.close_fasta(fd)
+
+    os.replace(f"{results}.tmp", results)
+    if compress:
+        os.replace(f"{results}.tmp.gzi", f"{results}.gzi")
+    os.replace("hapog_results/hapog.changes.tmp", "hapog_results/hapog.changes")
 
     print(f"Done in {int(time.perf_counter() - start)} seconds", flush=True)
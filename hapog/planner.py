@@ -0,0 +1,187 @@
+from collections import namedtuple
+
+from hapog import fasta
+
+import os
+
+
+# Rough peak memory of each stage, in bytes. These are upper bounds observed
+# on plant and animal genomes, used to share the memory of the node between
+# the processes of a stage.
+#   bwa mem loads ~2 bytes of index per base and its read batches per thread
+BWA_BYTES_PER_BASE = 2
+BWA_THREAD_MEMORY = 64 * 1024 ** 2
+#   bwa index peaks at ~5.4 bytes per base
+BWA_INDEX_BYTES_PER_BASE = 6
+#   bwa-mem2 loads a larger index, its indexing peaks at ~28 bytes per base
+BWA_MEM2_BYTES_PER_BASE = 10
+BWA_MEM2_INDEX_BYTES_PER_BASE = 28
+#   minimap2 (map-pb) index and long read batches per thread
+MINIMAP2_BYTES_PER_BASE = 3
+MINIMAP2_THREAD_MEMORY = 256 * 1024 ** 2
+#   samtools sort goes a bit over its -m value
+SORT_OVERHEAD = 1.2
+MIN_SORT_MEMORY = 256 * 1024 ** 2
+MAX_SORT_MEMORY = 5 * 1024 ** 3
+#   bytes of uncompressed alignments per byte of gzipped reads
+GZIP_RATIO = 4
+#   Hapo-G keeps a region and its polished copy in memory, plus the reads of
+#   the pile and the names of the reads of the other haplotype
+HAPOG_BYTES_PER_BASE = 3
+HAPOG_BASE_MEMORY = 256 * 1024 ** 2
+
+# Share of the memory of the node left to the system and other processes
+RESERVED_MEMORY = 0.1
+
+# Resources given to the stages of a run:
+#   memory:        memory budget of the run, in bytes
+#   samtools_mem:  memory per samtools sort thread, in the samtools format
+#   hapog_threads: number of Hapo-G jobs launched in parallel
+#   job_memory:    expected peak memory of the largest Hapo-G job
+Plan = namedtuple("Plan", ["memory", "samtools_mem", "hapog_threads", "job_memory"])
+
+
+def parse_memory(memory):
+    # Amount of memory in the samtools format (e.g. '768M', '5G') in bytes
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    memory = str(memory).upper()
+    if memory[-1] in units:
+        return int(float(memory[:-1]) * units[memory[-1]])
+    return int(memory)
+
+
+def format_memory(memory):
+    # Rounded down, to be used as a limit
+    if memory >= 16 * 1024 ** 3 or (memory >= 1024 ** 3 and memory % 1024 ** 3 == 0):
+        return f"{memory // 1024 ** 3}G"
+    return f"{memory // 1024 ** 2}M"
+
+
+def total_memory():
+    # Memory of the node, or the memory limit of the job when it runs in a
+    # cgroup (SLURM, containers). MemTotal is used rather than MemAvailable so
+    # that a resumed run gets the same plan.
+    limits = []
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(path) as limit:
+                limits.append(int(limit.read().strip()))
+        except (OSError, ValueError):
+            pass
+
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    limits.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError):
+        limits.append(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"))
+    return min(limits)
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def contig_lengths(genome):
+    if os.path.exists(f"{genome}.fai") and os.path.getmtime(f"{genome}.fai") >= os.path.getmtime(
+        genome
+    ):
+        records = fasta.read_fai(genome)
+    else:
+        records = fasta.index_fasta(genome)
+    return [record.length for record in records]
+
+
+def reads_volume(reads):
+    # Approximate size of the uncompressed alignments of the reads
+    volume = 0
+    for read_file in reads:
+        size = os.path.getsize(read_file)
+        volume += size * GZIP_RATIO if read_file.endswith(".gz") else size
+    return volume
+
+
+def region_memory(length):
+    return HAPOG_BYTES_PER_BASE * length + HAPOG_BASE_MEMORY
+
+
+def aligner_memory(genome_size, threads, aligner):
+    if aligner == "minimap2":
+        return MINIMAP2_BYTES_PER_BASE * genome_size + MINIMAP2_THREAD_MEMORY * threads
+    if aligner == "bwa-mem2":
+        return max(
+            BWA_MEM2_BYTES_PER_BASE * genome_size + BWA_THREAD_MEMORY * threads,
+            BWA_MEM2_INDEX_BYTES_PER_BASE * genome_size,
+        )
+    return max(
+        BWA_BYTES_PER_BASE * genome_size + BWA_THREAD_MEMORY * threads,
+        BWA_INDEX_BYTES_PER_BASE * genome_size,
+    )
+
+
+def plan(
+    genome,
+    reads,
+    aligner,
+    threads,
+    hapog_threads=0,
+    samtools_mem=None,
+    memory=None,
+    window_size=0,
+    window_overlap=0,
+):
+    # Fit the sort memory and the number of parallel Hapo-G jobs in the memory
+    # budget, values given on the command line are kept as they are
+    print("\nPlanning resources...", flush=True)
+    threads = int(threads)
+    cpus = available_cpus()
+    budget = parse_memory(memory) if memory else int(total_memory() * (1 - RESERVED_MEMORY))
+    lengths = contig_lengths(genome)
+    genome_size = sum(lengths)
+    print(f"\tMemory budget: {format_memory(budget)}, {cpus} CPUs available", flush=True)
+    if threads > cpus:
+        print(
+            f"\tWARNING: {threads} threads requested but only {cpus} CPUs are available",
+            flush=True,
+        )
+
+    if not samtools_mem:
+        sort_memory = MAX_SORT_MEMORY
+        if reads:
+            aligner_peak = aligner_memory(genome_size, threads, aligner)
+            sort_memory = (budget - aligner_peak) / SORT_OVERHEAD / threads
+            # Memory above the size of the data to sort would not be used
+            sort_memory = min(sort_memory, reads_volume(reads) / threads, MAX_SORT_MEMORY)
+            print(f"\tMapping: about {format_memory(aligner_peak)} for {aligner}", flush=True)
+        samtools_mem = format_memory(max(MIN_SORT_MEMORY, int(sort_memory)))
+    if reads:
+        print(f"\tSorting: {threads} threads of {samtools_mem}", flush=True)
+        if parse_memory(samtools_mem) * threads * SORT_OVERHEAD > budget:
+            print("\tWARNING: samtools sort may use more memory than the budget", flush=True)
+
+    # Jobs only hold one region in memory at a time, the longest one
+    longest = max(lengths, default=0)
+    if window_size:
+        longest = min(longest, window_size + window_overlap)
+    job_memory = region_memory(longest)
+    if not hapog_threads:
+        hapog_threads = max(1, min(threads, budget // job_memory))
+    print(
+        f"\tHapo-G: {hapog_threads} parallel jobs of at most {format_memory(job_memory)}",
+        flush=True,
+    )
+    if job_memory > budget:
+        print(
+            "\tWARNING: the longest sequence may not fit in the memory budget, consider using --window-size",
+            flush=True,
+        )
+
+    return Plan(budget, samtools_mem, int(hapog_threads), job_memory)
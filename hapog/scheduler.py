@@ -0,0 +1,130 @@
+from collections import namedtuple
+
+from hapog import scratch
+from hapog import telemetry
+
+import os
+import subprocess
+import time
+import warnings
+
+
+# Number of times a failed job is launched again before giving up
+RETRIES = 2
+
+# A command to run:
+#   stdout:    file receiving the standard output (truncated at each attempt)
+#   stderr:    file receiving the standard error
+#   cpus:      number of CPUs used by the command
+#   size:      expected amount of work, largest jobs are launched first
+#   log_mode:  'w' or 'a' to truncate or append to stderr on the first attempt
+#   memory:    expected peak resident memory of the command, in bytes
+#   name:      name of the job in the telemetry report (command name if None)
+#   stage:     scratch.Staging of a job run on the scratch directory
+Job = namedtuple(
+    "Job",
+    ["cmd", "stdout", "stderr", "cpus", "size", "log_mode", "memory", "name", "stage"],
+    defaults=(1, 0, "w", 0, None, None),
+)
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def resident_memory(pid):
+    # Current resident memory of a running process, 0 if it can't be read
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def launch(job, attempt, cmd_log):
+    if cmd_log:
+        with open(cmd_log, "a") as cmd_file:
+            print(" ".join(job.cmd), flush=True, file=cmd_file)
+
+    stdout = subprocess.DEVNULL if job.stdout is None else open(job.stdout, "w")
+    stderr = open(job.stderr, job.log_mode if attempt == 0 else "a")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        proc = subprocess.Popen(job.cmd, stdout=stdout, stderr=stderr)
+    for f in (stdout, stderr):
+        if f is not subprocess.DEVNULL:
+            f.close()
+    return proc
+
+
+def run_jobs(jobs, cpus, retries=RETRIES, cmd_log=None, memory=0):
+    # Run jobs, largest first, without using more than 'cpus' CPUs at once.
+    # The scheduler sleeps in waitpid() until a child exits, so a slot is
+    # given to the next job as soon as it is freed.
+    # When a memory budget is given, a job is only launched if its expected
+    # memory fits next to the running jobs, counted for the largest of their
+    # expected and current resident memory.
+    # Jobs run on the scratch directory are only launched once their inputs
+    # are staged within the scratch budget, their outputs are copied back in
+    # the background when they end (see scratch.wait()).
+    # The resources used by each attempt, as given by wait4(), are added to
+    # the telemetry report.
+    # Returns the list of (job, return code) that failed after all retries.
+    cpus = max(1, int(cpus))
+    pending = [(job, 0) for job in sorted(jobs, key=lambda job: -job.size)]
+    running = {}
+    used_cpus = 0
+    failed = []
+
+    while pending or running:
+        while pending:
+            job, attempt = pending[0]
+            job_cpus = min(max(1, job.cpus), cpus)
+            if running and used_cpus + job_cpus > cpus:
+                break
+            if running and memory:
+                used_memory = sum(
+                    max(running_job.memory, resident_memory(pid))
+                    for pid, (running_job, _, _, _, _) in running.items()
+                )
+                if used_memory + job.memory > memory:
+                    break
+            if job.stage and not scratch.stage(job.stage, wait=not running):
+                break
+            pending.pop(0)
+            proc = launch(job, attempt, cmd_log)
+            running[proc.pid] = (job, attempt, proc, job_cpus, time.perf_counter())
+            used_cpus += job_cpus
+
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+
+        job, attempt, proc, job_cpus, start = running.pop(pid)
+        used_cpus -= job_cpus
+        proc.returncode = exit_code(status)
+        telemetry.add_job(
+            job.name or os.path.basename(job.cmd[0]),
+            time.perf_counter() - start,
+            usage,
+            attempt,
+            proc.returncode,
+        )
+        if proc.returncode != 0:
+            if attempt < retries:
+                print(
+                    f"WARNING: Job failed with exit code {proc.returncode}, relaunching it: {' '.join(job.cmd)}",
+                    flush=True,
+                )
+                pending.insert(0, (job, attempt + 1))
+                continue
+            failed.append((job, proc.returncode))
+        if job.stage:
+            scratch.release(job.stage)
+
+    return failed
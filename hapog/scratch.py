@@ -0,0 +1,136 @@
+from collections import namedtuple
+
+from hapog import planner
+
+import atexit
+import os
+import queue
+import shutil
+import socket
+import threading
+
+
+# Files of a job moved to the scratch directory:
+#   directory: directory of the job on the scratch, removed once the job ended
+#   inputs:    (path, scratch path) of the files copied before the job starts
+#   outputs:   (scratch path, path) of the files copied back once it ended
+#   size:      bytes of the scratch held by the job until its outputs are back
+Staging = namedtuple("Staging", ["directory", "inputs", "outputs", "size"])
+
+# Scratch directory of the run, bytes it may hold and bytes held by the shared
+# files and the staged jobs
+state = {"directory": None, "budget": 0, "shared": 0, "used": 0}
+condition = threading.Condition()
+
+# Jobs whose outputs are waiting to be copied back, and the copies that failed
+copies = queue.Queue()
+errors = []
+
+
+def setup(directory, budget=None):
+    # Budget defaults to 90% of the free space of the scratch file system
+    directory = os.path.join(directory, f"hapog_{socket.gethostname()}_{os.getpid()}")
+    os.makedirs(directory)
+    atexit.register(shutil.rmtree, directory, True)
+    if not budget:
+        budget = int(shutil.disk_usage(directory).free * 0.9)
+    state.update(directory=directory, budget=budget, shared=0, used=0)
+    threading.Thread(target=copy_back, daemon=True).start()
+    print(
+        f"Staging the chunks in {directory}, using at most {planner.format_memory(budget)}",
+        flush=True,
+    )
+
+
+def share(paths):
+    # Files read by every job are copied once, if they take at most half of
+    # the budget. Returns the scratch path of each copied file.
+    size = sum(os.path.getsize(path) for path in paths)
+    if size > state["budget"] // 2:
+        return {}
+    local = {path: f"{state['directory']}/{os.path.basename(path)}" for path in paths}
+    for path in paths:
+        shutil.copyfile(path, local[path])
+    with condition:
+        state["shared"] += size
+        state["used"] += size
+    return local
+
+
+def prepare(job, inputs, outputs, shared, output_size):
+    # The job reads its inputs and writes its outputs in its own directory of
+    # the scratch. inputs and outputs are paths of the output directory, the
+    # command line and log files of the job are changed to their scratch paths.
+    directory = f"{state['directory']}/{job.name}"
+    local = dict(shared)
+    for path in inputs + outputs:
+        local[path] = f"{directory}/{os.path.basename(path)}"
+    staging = Staging(
+        directory,
+        [(path, local[path]) for path in inputs],
+        [(local[path], path) for path in outputs],
+        sum(os.path.getsize(path) for path in inputs) + output_size,
+    )
+    return job._replace(
+        cmd=[local.get(arg, arg) for arg in job.cmd],
+        stdout=local.get(job.stdout, job.stdout),
+        stderr=local.get(job.stderr, job.stderr),
+        stage=staging,
+    )
+
+
+def stage(staging, wait=False):
+    # Hold the space of a job and copy its inputs. Returns False when the job
+    # doesn't fit in the budget, unless wait is set: the copies of the jobs
+    # that ended then free the space, and a job larger than the budget is
+    # staged alone.
+    if os.path.isdir(staging.directory):
+        # Relaunched job, its inputs are already there
+        return True
+    with condition:
+        while state["used"] + staging.size > state["budget"]:
+            if not wait:
+                return False
+            if state["used"] == state["shared"]:
+                break
+            condition.wait()
+        state["used"] += staging.size
+    os.makedirs(staging.directory)
+    for path, local in staging.inputs:
+        shutil.copyfile(path, local)
+    return True
+
+
+def release(staging):
+    # Outputs are copied back by a background thread while other jobs run
+    copies.put(staging)
+
+
+def copy_back():
+    while True:
+        staging = copies.get()
+        try:
+            # Copied next to the final file and renamed, an output is never
+            # seen half written
+            for local, path in staging.outputs:
+                if os.path.exists(local):
+                    shutil.copyfile(local, f"{path}.tmp")
+                    os.replace(f"{path}.tmp", path)
+        except OSError as error:
+            errors.append(f"{staging.directory}: {error}")
+        finally:
+            shutil.rmtree(staging.directory, ignore_errors=True)
+            with condition:
+                state["used"] -= staging.size
+                condition.notify_all()
+            copies.task_done()
+
+
+def wait():
+    # All outputs are back in the output directory when it returns
+    copies.join()
+    if errors:
+        for error in errors:
+            print(f"ERROR: outputs couldn't be copied back from {error}", flush=True)
+        exit(1)
+    shutil.rmtree(state["directory"], ignore_errors=True)
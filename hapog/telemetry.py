@@ -0,0 +1,148 @@
+import json
+import resource
+import sys
+import time
+
+
+# Report written at the end of a run, relative to the output directory
+REPORT = "logs/telemetry"
+
+# Columns of the TSV report, counters written by the Hapo-G binary follow
+COLUMNS = [
+    "name",
+    "kind",
+    "attempt",
+    "status",
+    "wall_time",
+    "user_time",
+    "system_time",
+    "max_rss",
+    "read_bytes",
+    "write_bytes",
+]
+
+# One dict per pipeline stage or job, in the order they ended
+records = []
+
+
+def rss_bytes(maxrss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def usage_record(name, kind, wall_time, usage, attempt=0, status=0):
+    # ru_inblock and ru_oublock count 512-byte blocks read from or written to
+    # the disks, reads served by the page cache are not counted
+    return {
+        "name": name,
+        "kind": kind,
+        "attempt": attempt,
+        "status": status,
+        "wall_time": round(wall_time, 3),
+        "user_time": round(usage.ru_utime, 3),
+        "system_time": round(usage.ru_stime, 3),
+        "max_rss": rss_bytes(usage.ru_maxrss),
+        "read_bytes": usage.ru_inblock * 512,
+        "write_bytes": usage.ru_oublock * 512,
+    }
+
+
+def start():
+    return (
+        time.perf_counter(),
+        resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN),
+    )
+
+
+def stop(name, begin):
+    # Resources used by the pipeline itself and the children it waited for
+    # since begin. The peak RSS of a stage is only known when one of its
+    # processes went above the peaks of the previous stages, it is None
+    # otherwise.
+    wall_start, self_start, children_start = begin
+    wall_time = time.perf_counter() - wall_start
+    self_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def delta(usage_field):
+        return (
+            getattr(self_end, usage_field)
+            - getattr(self_start, usage_field)
+            + getattr(children_end, usage_field)
+            - getattr(children_start, usage_field)
+        )
+
+    max_rss = None
+    for usage_start, usage_end in ((self_start, self_end), (children_start, children_end)):
+        if usage_end.ru_maxrss > usage_start.ru_maxrss:
+            max_rss = max(max_rss or 0, rss_bytes(usage_end.ru_maxrss))
+
+    record = {
+        "name": name,
+        "kind": "stage",
+        "attempt": 0,
+        "status": 0,
+        "wall_time": round(wall_time, 3),
+        "user_time": round(delta("ru_utime"), 3),
+        "system_time": round(delta("ru_stime"), 3),
+        "max_rss": max_rss,
+        "read_bytes": delta("ru_inblock") * 512,
+        "write_bytes": delta("ru_oublock") * 512,
+    }
+    records.append(record)
+
+
+def run(name, function, *args):
+    begin = start()
+    result = function(*args)
+    stop(name, begin)
+    return result
+
+
+def add_job(name, wall_time, usage, attempt, status, counters=None):
+    # Resources of a single child process, as given by os.wait4()
+    records.append(usage_record(name, "job", wall_time, usage, attempt, status))
+    if counters:
+        records[-1].update(counters)
+
+
+def add_record(record):
+    # Record made by another process, such as a worker of the work queue
+    records.append(record)
+
+
+def add_counters(name, metrics):
+    # Counters written by the Hapo-G binary (-m) are added to the last
+    # attempt of the job
+    try:
+        with open(metrics) as metrics_file:
+            counters = dict(
+                line.rstrip("\n").split("\t")[:2] for line in metrics_file if "\t" in line
+            )
+    except OSError:
+        return
+    for record in reversed(records):
+        if record["name"] == name and record["kind"] == "job":
+            for key, value in counters.items():
+                record[key] = float(value) if "." in value else int(value)
+            return
+
+
+def write_report():
+    # Records are only written once, at the end of the run or when it stops
+    if not records:
+        return
+    with open(f"{REPORT}.json", "w") as out:
+        json.dump(records, out, indent=2)
+
+    columns = COLUMNS + sorted({key for record in records for key in record} - set(COLUMNS))
+    with open(f"{REPORT}.tsv", "w") as out:
+        out.write("\t".join(columns) + "\n")
+        for record in records:
+            out.write(
+                "\t".join("NA" if record.get(c) is None else str(record[c]) for c in columns)
+                + "\n"
+            )
+    print(f"\nTelemetry report written to {REPORT}.tsv and {REPORT}.json", flush=True)
+    records.clear()
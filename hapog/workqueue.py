@@ -0,0 +1,322 @@
+from hapog import checkpoint
+from hapog import scheduler
+from hapog import telemetry
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+# Queue of the jobs, relative to the output directory. A job goes from
+# pending/ to running/ when a worker claims it, then to done/ or failed/.
+# Files only move through os.rename(), which is atomic on a shared file system:
+# when two workers claim the same job, only one of them gets it.
+QUEUE = "queue"
+DIRECTORIES = ["pending", "running", "done", "failed", "tmp"]
+
+# Seconds between two looks at the queue
+POLL = 2
+# Seconds between two heartbeats of a running job (mtime of its running/ file)
+HEARTBEAT = 10
+# A job whose heartbeat didn't change for this many seconds is given to
+# another worker
+TIMEOUT = 120
+
+
+def write_spec(path, spec):
+    # Written next to the queue and renamed, a spec is never seen half written
+    tmp = f"{QUEUE}/tmp/{os.path.basename(path)}.{socket.gethostname()}.{os.getpid()}"
+    with open(tmp, "w") as out:
+        json.dump(spec, out, indent=2)
+    os.rename(tmp, path)
+
+
+def read_spec(path):
+    with open(path) as spec_file:
+        return json.load(spec_file)
+
+
+def pending_file(spec):
+    # Ranks keep the largest jobs first in the listing of pending/
+    return f"{QUEUE}/pending/{spec['rank']:05d}.{spec['name']}.json"
+
+
+def job_name(path):
+    # rank.name.json or rank.name@worker.json
+    name = os.path.basename(path).split("@")[0]
+    name = name[: -len(".json")] if name.endswith(".json") else name
+    return name.split(".", 1)[1]
+
+
+def listdir(directory):
+    try:
+        return sorted(os.listdir(f"{QUEUE}/{directory}"))
+    except FileNotFoundError:
+        return []
+
+
+def take(path):
+    # Move a running/ file out of the queue, None if someone else was faster
+    tmp = f"{QUEUE}/tmp/{os.path.basename(path)}"
+    try:
+        os.rename(path, tmp)
+    except FileNotFoundError:
+        return None
+    return tmp
+
+
+def requeue(spec, status):
+    # Attempts left go back to pending/, the others to failed/
+    if spec["attempt"] < spec["retries"]:
+        spec["attempt"] += 1
+        write_spec(pending_file(spec), spec)
+    else:
+        spec["status"] = status
+        write_spec(f"{QUEUE}/failed/{spec['name']}.json", spec)
+
+
+# Scatter and gather, run by the pipeline
+
+
+def run_jobs(jobs, stages, retries=scheduler.RETRIES, cmd_log=None, local_workers=0):
+    # Same as scheduler.run_jobs(), the jobs are run by 'hapog worker'
+    # processes that may run on other nodes. stages gives the (name, inputs,
+    # params, outputs) of each job: the fingerprints of the inputs are checked
+    # by the worker before running the job, those of the outputs by the
+    # pipeline once the job is done.
+    # Returns the list of (job, return code) that failed after all retries.
+    shutil.rmtree(QUEUE, ignore_errors=True)
+    for directory in DIRECTORIES:
+        os.makedirs(f"{QUEUE}/{directory}")
+
+    by_name = {}
+    ranked = sorted(zip(jobs, stages), key=lambda job_stage: -job_stage[0].size)
+    for rank, (job, (name, inputs, _, outputs)) in enumerate(ranked):
+        spec = {
+            "name": name,
+            "rank": rank,
+            "job": job._asdict(),
+            "inputs": checkpoint.fingerprints(inputs),
+            "outputs": outputs,
+            "attempt": 0,
+            "retries": retries,
+            "records": [],
+        }
+        write_spec(pending_file(spec), spec)
+        by_name[name] = job
+        if cmd_log:
+            with open(cmd_log, "a") as cmd_file:
+                print(" ".join(job.cmd), flush=True, file=cmd_file)
+    open(f"{QUEUE}/ready", "w").close()
+
+    output_dir = os.getcwd()
+    print(f"{len(jobs)} jobs written to {output_dir}/{QUEUE}", flush=True)
+    workers = [start_worker(i) for i in range(local_workers)]
+    if not local_workers:
+        print(f"Waiting for workers, launch them with: hapog worker {output_dir}", flush=True)
+
+    heartbeats = {}
+    progress = None
+    while True:
+        finished = len(listdir("done")) + len(listdir("failed"))
+        if finished == len(jobs):
+            break
+        if progress != finished:
+            print(f"\t{finished}/{len(jobs)} jobs finished", flush=True)
+            progress = finished
+
+        # The clocks of the nodes may differ, heartbeats are compared with the
+        # previous mtime and timed with the clock of the pipeline
+        now = time.monotonic()
+        for running_file in listdir("running"):
+            path = f"{QUEUE}/running/{running_file}"
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if heartbeats.get(path, (None,))[0] != mtime:
+                heartbeats[path] = (mtime, now)
+            elif now - heartbeats[path][1] > TIMEOUT:
+                tmp = take(path)
+                if tmp is None:
+                    continue
+                worker = running_file.split("@")[1][: -len(".json")]
+                print(
+                    f"WARNING: worker {worker} stopped sending heartbeats, requeuing {job_name(path)}",
+                    flush=True,
+                )
+                requeue(read_spec(tmp), None)
+                os.remove(tmp)
+
+        # Local workers only stop when the queue is empty
+        if workers and all(worker.poll() is not None for worker in workers):
+            print("WARNING: all local workers stopped, starting new ones", flush=True)
+            workers = [start_worker(i) for i in range(local_workers)]
+        time.sleep(POLL)
+
+    open(f"{QUEUE}/closed", "w").close()
+    for worker in workers:
+        worker.wait()
+
+    failed = []
+    for name, job in by_name.items():
+        spec_file = f"{QUEUE}/done/{name}.json"
+        if not os.path.exists(spec_file):
+            spec_file = f"{QUEUE}/failed/{name}.json"
+        spec = read_spec(spec_file)
+        for record in spec["records"]:
+            telemetry.add_record(record)
+        if "status" in spec:
+            failed.append((job, spec["status"]))
+        elif checkpoint.fingerprints(spec["outputs"]) != spec["checksums"]:
+            print(f"ERROR: outputs of {name} differ from those written by the worker", flush=True)
+            failed.append((job, None))
+    return failed
+
+
+def start_worker(number):
+    # Local worker, started with the Python interpreter and package of the
+    # pipeline
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_dir, env.get("PYTHONPATH")]))
+    return subprocess.Popen(
+        [sys.executable, "-m", "hapog.workqueue", "worker", "."],
+        stdout=open(f"logs/worker_{number}.o", "w"),
+        stderr=open(f"logs/worker_{number}.e", "w"),
+        env=env,
+    )
+
+
+# Worker
+
+
+def claim(worker):
+    # Largest pending job first
+    for pending in listdir("pending"):
+        path = f"{QUEUE}/running/{pending[: -len('.json')]}@{worker}.json"
+        try:
+            os.rename(f"{QUEUE}/pending/{pending}", path)
+        except FileNotFoundError:
+            continue
+        return read_spec(path), path
+    return None
+
+
+def finish(spec, path, status, record):
+    # The result is dropped when the job was given to another worker
+    tmp = take(path)
+    if tmp is None:
+        print(f"Job {spec['name']} was requeued, result dropped", flush=True)
+        return
+    spec["records"].append(record)
+    if status == 0:
+        spec["checksums"] = checkpoint.fingerprints(spec["outputs"])
+        write_spec(f"{QUEUE}/done/{spec['name']}.json", spec)
+    else:
+        print(f"Job {spec['name']} failed with exit code {status}", flush=True)
+        requeue(spec, status)
+    os.remove(tmp)
+
+
+def heartbeat(running, lock, stop):
+    # Touch the running/ file of each job, jobs requeued by the pipeline
+    # meanwhile are run by another worker and are stopped
+    while not stop.wait(HEARTBEAT):
+        with lock:
+            jobs = list(running.values())
+        for spec, path, proc, _ in jobs:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                print(f"Job {spec['name']} was requeued, stopping it", flush=True)
+                proc.send_signal(signal.SIGKILL)
+
+
+def work(output_dir, jobs=1):
+    os.chdir(output_dir)
+    worker = f"{socket.gethostname()}.{os.getpid()}"
+    print(f"Worker {worker} waiting for jobs in {os.getcwd()}/{QUEUE}", flush=True)
+    while not os.path.exists(f"{QUEUE}/ready"):
+        time.sleep(POLL)
+
+    running = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(running, lock, stop), daemon=True).start()
+    while not os.path.exists(f"{QUEUE}/closed"):
+        while len(running) < jobs:
+            claimed = claim(worker)
+            if claimed is None:
+                break
+            spec, path = claimed
+            # Inputs must be those seen by the pipeline (shared file system
+            # not up to date, or files changed since the jobs were written)
+            if checkpoint.fingerprints(spec["inputs"]) != spec["inputs"]:
+                print(f"ERROR: inputs of {spec['name']} differ from those of the pipeline", flush=True)
+                record = {"name": spec["name"], "kind": "job", "attempt": spec["attempt"], "status": -1}
+                finish(spec, path, -1, record)
+                continue
+            print(f"Running {spec['name']}", flush=True)
+            job = scheduler.Job(**spec["job"])
+            proc = scheduler.launch(job, spec["attempt"], None)
+            with lock:
+                running[proc.pid] = (spec, path, proc, time.perf_counter())
+
+        if not running:
+            # Jobs of other workers may still be requeued
+            if not listdir("pending") and not listdir("running"):
+                break
+            time.sleep(POLL)
+            continue
+
+        # Slots are filled again as soon as a job ends
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        with lock:
+            spec, path, proc, start = running.pop(pid)
+        proc.returncode = scheduler.exit_code(status)
+        record = telemetry.usage_record(
+            spec["name"],
+            "job",
+            time.perf_counter() - start,
+            usage,
+            spec["attempt"],
+            proc.returncode,
+        )
+        record["worker"] = worker
+        finish(spec, path, proc.returncode, record)
+
+    stop.set()
+    print(f"Worker {worker} stopped, no job left", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="hapog worker",
+        description="Run the Hapo-G jobs of a pipeline launched with --scatter, several workers can run on different nodes sharing the output directory",
+    )
+    parser.add_argument("output_dir", help="Output directory of the pipeline")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        action="store",
+        dest="jobs",
+        help="Number of jobs run at the same time by this worker (Default: 1)",
+        default=1,
+        type=int,
+    )
+    args = parser.parse_args(argv)
+    work(args.output_dir, max(1, args.jobs))
+
+
+if __name__ == "__main__":
+    main(sys.argv[2:] if sys.argv[1:2] == ["worker"] else sys.argv[1:])
@@ -44,26 +44,44 @@ int compare( const void* a, const void* b) {
   return (int_a > int_b) - (int_a < int_b);
 }
 
+ali_t *ali_init(bam1_t *aln) {
+  ali_t* a = (ali_t*) malloc(sizeof(ali_t));
+  a->b = aln;
+  a->end = bam_endpos(aln);
+  a->refs = 1;
+  return a;
+}
+
+void ali_release(ali_t *a) {
+  if(--a->refs > 0) return;
+  bam_destroy1(a->b);
+  free(a);
+}
+
 alipile_t *alipile_init(FILE* out) {
   alipile_t* ap = (alipile_t*) calloc(1, sizeof(alipile_t));
   ap->max_cov = 500;
   ap->current_read = -1;
   ap->read_choice = 0;
   ap->current_seq = -1;
+  ap->seq_start = 0;
   ap->min_cov = 3;
   ap->nb_ali = 0;
   ap->debug = 0;
   ap->nb_changes = 0;
   ap->changes = out;
   ap->nbhapB = 0;
+  ap->column_pos = -1;
+  ap->min_end = INT_MAX;
   return ap;
 }
 
 void alipile_free(alipile_t *ap) {
   int i;
-  for (i = 0; i < ap->nb_ali; i++) free(ap->seqpile[i]);
-  //free(ap->seqpile);
-  for (i = 0; i < ap->nb_ali; i++) bam_destroy1(ap->pile[i]);
+  for (i = 0; i < ap->nb_ali; i++) free(ap->column[i]);
+  for (i = 0; i < ap->nb_ali; i++) ali_release(ap->pile[i]);
+  for (i = 0; i < ap->nb_pending; i++) ali_release(ap->pending[i]);
+  free(ap->pending);
   //free(ap->pile);
   //free(ap->name_seq);
   free(ap->seq);
@@ -71,50 +89,119 @@ void alipile_free(alipile_t *ap) {
 }
 
 void clean(alipile_t *ap, int pos) {
+  // nothing to erase before the first alignment end
+  if(ap->min_end > pos+10) return;
   int idread[ap->nb_ali];
   int nbdel = 0, c = 0;
   // retrieve all possibilities
   for( c = 0 ; c < ap->nb_ali ; c++) {
-    bam1_t *b = ap->pile[c];
-    if(bam_endpos(b) <= pos+10) {
+    if(ap->pile[c]->end <= pos+10) {
       idread[nbdel] = c;
       nbdel++;
     }
   }
-  for( c = nbdel-1 ; c >= 0 ; c-- )
-    delete(ap, idread[c]);
+  delete_reads(ap, idread, nbdel);
 }
 
-void add(alipile_t *ap, bam1_t *aln) {
-  int c = 0, smallest = -1, value = 0;
-  clean(ap, aln->core.pos);
-
-  //need to delete an alignment
-  if(ap->nb_ali == ap->max_cov) {
-    for( c = 0, value = 0 ; c < ap->nb_ali ; c++) {
-      bam1_t *b = ap->pile[c];
-      int size = bam_endpos(b) - aln->core.pos;
-      if(smallest == -1 || size < value) { smallest = c; value = size; }
+void add(alipile_t *ap, ali_t *a) {
+  if(ap->nb_pending == ap->size_pending) {
+    ap->size_pending = ap->size_pending ? 2 * ap->size_pending : 64;
+    ap->pending = realloc(ap->pending, ap->size_pending * sizeof(ali_t*));
+  }
+  a->refs++;
+  ap->pending[ap->nb_pending++] = a;
+}
+
+// Remove the alignments of a simulated pile whose end is <= limit (limit = -1:
+// only the alignment c), as delete_reads does
+static void sim_delete(int *id, int *end, int *n, int *min_end, int *current, int limit, int c) {
+  int i = 0, k = 0;
+  *min_end = INT_MAX;
+  for(i = 0 ; i < *n ; i++) {
+    if(limit >= 0 ? end[i] <= limit : i == c) continue;
+    id[k] = id[i];
+    end[k] = end[i];
+    if(end[k] < *min_end) *min_end = end[k];
+    k++;
+  }
+  *n = k;
+  if(*current >= *n) *current = 0;
+}
+
+void flush(alipile_t *ap) {
+  int nb = ap->nb_pending, nb_ali = ap->nb_ali, i = 0, c = 0;
+  if(nb == 0) return;
+
+  // Alignments are added to a pile of end positions first: cleaning, eviction
+  // and the choice of the current read only depend on the positions, so the
+  // simulated pile ends up like the real one would. Alignments of the pile
+  // refer to themselves (id < nb_ali), pending ones to nb_ali + their index.
+  int n = ap->nb_ali, min_end = ap->min_end, current = ap->current_read;
+  int *id = malloc((n + nb) * sizeof(int));
+  int *end = malloc((n + nb) * sizeof(int));
+  for(i = 0 ; i < n ; i++) {
+    id[i] = i;
+    end[i] = ap->pile[i]->end;
+  }
+  for(i = 0 ; i < nb ; i++) {
+    int pos = ap->pending[i]->b->core.pos, smallest = -1;
+    if(min_end <= pos+10) sim_delete(id, end, &n, &min_end, &current, pos+10, -1);
+    if(n == ap->max_cov) {
+      for( c = 0 ; end[c] != min_end ; c++);
+      smallest = c;
+      sim_delete(id, end, &n, &min_end, &current, -1, smallest);
+    }
+    id[n] = ap->nb_ali + i;
+    end[n] = ap->pending[i]->end;
+    if(end[n] < min_end) min_end = end[n];
+    n++;
+    if(current == -1 || smallest == current) {
+      int value = 0;
+      current = -1;
+      for( c = 0 ; c < n ; c++) {
+	int size = end[c] - pos;
+	if(current == -1 || size < value) { current = c; value = size; }
+      }
     }
-    delete(ap, smallest);
   }
-  
-  //add the new alignment
-  ap->pile[ap->nb_ali] = aln;
-  ap->seqpile[ap->nb_ali] = get_seqali(aln);
-  //printf("->add: %s\tseq=%s\tnbreads=%i\tcurrentpos=%i\n", bam_get_qname(aln), ap->seqpile[ap->nb_ali], ap->nb_ali, aln->core.pos);
-  ap->nb_ali++;
-  
-  // if current_read has been deleted, need to select a new read
-  if(ap->current_read == -1 || smallest == ap->current_read)
-    change_currentread(ap, aln->core.pos);
+
+  // Alignments of the pile that were evicted are deleted, the kept pending
+  // alignments follow the others in the simulated pile
+  int nbdel = 0, k = 0;
+  int idread[nb_ali > 0 ? nb_ali : 1];
+  for(i = 0 ; i < nb_ali ; i++) {
+    if(k < n && id[k] == i) k++;
+    else idread[nbdel++] = i;
+  }
+  delete_reads(ap, idread, nbdel);
+  for(i = 0 ; i < nb ; i++) {
+    ali_t *a = ap->pending[i];
+    if(k == n || id[k] != nb_ali + i) {
+      ap->nb_skipped++;
+      ali_release(a);
+      continue;
+    }
+    k++;
+    ap->pile[ap->nb_ali] = a;
+    cursor_t start = {0, 0, 0, a->b->core.pos};
+    ap->cursor[ap->nb_ali] = start;
+    ap->column_size[ap->nb_ali] = 16;
+    ap->column[ap->nb_ali] = malloc(16 * sizeof(char));
+    ap->column[ap->nb_ali][0] = '\0';
+    if(a->end < ap->min_end) ap->min_end = a->end;
+    ap->nb_ali++;
+  }
+  ap->column_pos = -1;
+  ap->current_read = current;
+  ap->nb_pending = 0;
+  free(id);
+  free(end);
 }
 
 void change_currentread(alipile_t *ap, int pos) {
   int c = 0, smallest = -1, value = 0;
   for( c = 0 ; c < ap->nb_ali ; c++) {
-    bam1_t *b = ap->pile[c];
-    int size = bam_endpos(b) - pos;
+    int size = ap->pile[c]->end - pos;
     if(smallest == -1 || size < value) { smallest = c; value = size; }
   }
   ap->current_read = smallest;
@@ -123,27 +210,41 @@ void change_currentread(alipile_t *ap, int pos) {
 void change_currentread2(alipile_t *ap, int pos) {
   int c = 0, smallest = -1;
   float value = 0.0;
+  update_column(ap, pos);
   for( c = 0 ; c < ap->nb_ali ; c++) {
-    char *nt = get_base(ap, c, pos);
-    float ratio = get_ratio_base(ap, nt, pos);
-    free(nt);
+    float ratio = get_ratio_base(ap, ap->column[c], pos);
     if(smallest == -1 || ratio > value) { smallest = c; value = ratio; }
   }
   ap->current_read = smallest;
 }
 
 void delete(alipile_t *ap, int c) {
-  assert( c < ap->nb_ali );
-  bam1_t *remove = ap->pile[c];
-  //printf("->remove: %s\tseq=%s\tindex=%i\n", bam_get_qname(remove), get_bamseq(remove), elem);
-  bam_destroy1(remove);
-  free(ap->seqpile[c]);
-  while(c+1 < ap->max_cov) {
-    ap->pile[c] = ap->pile[c+1];
-    ap->seqpile[c] = ap->seqpile[c+1];
-    c++;
-  } 
-  ap->nb_ali--;
+  delete_reads(ap, &c, 1);
+}
+
+void delete_reads(alipile_t *ap, int *ids, int nb) {
+  int c = 0, k = 0, i = 0;
+  if(nb == 0) return;
+  // erase the reads and move the others down in a single pass
+  ap->min_end = INT_MAX;
+  for( c = 0 ; c < ap->nb_ali ; c++) {
+    if(i < nb && ids[i] == c) {
+      assert( c < ap->nb_ali );
+      ali_release(ap->pile[c]);
+      free(ap->column[c]);
+      i++;
+      continue;
+    }
+    if(k != c) {
+      ap->pile[k] = ap->pile[c];
+      ap->cursor[k] = ap->cursor[c];
+      ap->column[k] = ap->column[c];
+      ap->column_size[k] = ap->column_size[c];
+    }
+    if(ap->pile[k]->end < ap->min_end) ap->min_end = ap->pile[k]->end;
+    k++;
+  }
+  ap->nb_ali = k;
   if(ap->current_read >= ap->nb_ali)
     ap->current_read = 0;
 }
@@ -203,51 +304,94 @@ char* get_bamseq(bam1_t *aln) {
   return cp;
 }
 
-char* get_base(alipile_t *ap, int read, int pos) {
-  char* region = malloc(100000 * sizeof(char));
-  region[0]= '\0';
-  char* aliseq = ap->seqpile[read];
-  bam1_t* aln = ap->pile[read];
-  int i = 0, c = 0, len = strlen(aliseq);
-  for (i = aln->core.pos , c = 0; c < len ; c++) {
-    char nt = aliseq[c];
-    if(i == pos) {
-      int l = strlen(region);
+char next_char(bam1_t *aln, cursor_t *c) {
+  uint32_t *cigar = bam_get_cigar(aln);
+  uint8_t *seq = bam_get_seq(aln);
+  while(c->op < aln->core.n_cigar) {
+    int op = bam_cigar_op(cigar[c->op]);
+    int ol = bam_cigar_oplen(cigar[c->op]);
+    if(op == BAM_CSOFT_CLIP) c->qpos += ol;
+    if(c->off >= ol || !(op == BAM_CMATCH || op == BAM_CEQUAL || op == BAM_CDIFF ||
+			 op == BAM_CINS || op == BAM_CDEL)) {
+      c->op++;
+      c->off = 0;
+      continue;
+    }
+    char nt = '-';
+    if(op != BAM_CDEL) {
+      nt = seq_nt16_str[bam_seqi(seq, c->qpos)];
+      if(op == BAM_CINS) nt = tolower(nt);
+      c->qpos++;
+    }
+    c->off++;
+    // lowercase indicate insertion in read
+    if(!(nt >= 'a' && nt <= 'z')) c->pos++;
+    return nt;
+  }
+  return '\0';
+}
+
+void update_column(alipile_t *ap, int pos) {
+  int r = 0;
+  if(ap->column_pos == pos) return;
+  for( r = 0 ; r < ap->nb_ali ; r++ ) {
+    bam1_t *aln = ap->pile[r]->b;
+    cursor_t *c = &ap->cursor[r];
+    // positions only move forward, start again from the beginning otherwise
+    if(c->pos > pos && (c->op > 0 || c->off > 0)) {
+      cursor_t start = {0, 0, 0, aln->core.pos};
+      *c = start;
+    }
+    // skip the characters before pos
+    while(c->pos < pos && next_char(aln, c) != '\0');
+    cursor_t next = *c;
+
+    // the base at pos is made of the inserted bases followed by the aligned base
+    int l = 0;
+    char nt, *base = ap->column[r];
+    while(next.pos == pos && (nt = next_char(aln, &next)) != '\0') {
       if(l == 0 || nt != '-') {
-	region[l] = nt;
-	region[l+1] = '\0';
+	if(l + 2 > ap->column_size[r]) {
+	  ap->column_size[r] *= 2;
+	  base = ap->column[r] = realloc(base, ap->column_size[r] * sizeof(char));
+	}
+	base[l++] = nt;
       }
     }
-    // lowercase indicate insertion in read
-    if(!(nt >= 'a' && nt <= 'z')) i++;
+    base[l] = '\0';
   }
-  return region;
+  ap->column_pos = pos;
+}
+
+const char* get_base(alipile_t *ap, int read, int pos) {
+  update_column(ap, pos);
+  return ap->column[read];
 }
 
-float get_ratio_base(alipile_t *ap, char* str, int pos) {
+float get_ratio_base(alipile_t *ap, const char* str, int pos) {
   int i = 0, nb_id = 0, tot = 0;
+  update_column(ap, pos);
   for( i = 0 ; i < ap->nb_ali ; i++ ) {
-    char *seq = get_base(ap, i, pos);
-    bam1_t *b = ap->pile[i];
+    bam1_t *b = ap->pile[i]->b;
     // check if the alignment start before the current base minus the size of the insertion
     if(b->core.pos < pos - strlen(str)) {
-      if(strcmp(str, seq) == 0) nb_id++;
+      if(strcmp(str, ap->column[i]) == 0) nb_id++;
       tot++;
     }
-    free(seq);
   }
   return ((float)nb_id/(float)tot);
 }
 
-void removehapB_read(alipile_t *ap, char* str, int pos, hash_t* readname) {
+void removehapB_read(alipile_t *ap, const char* str, int pos, hash_t* readname) {
   int i = 0, j = 0, id = -1, nbdiff = 0, vu = 0;
-  if(ap->debug) printf("**** Remove hapB **** hapA=%s read=%s, seqpile=%s aliseq=%s\n", str, bam_get_qname(ap->pile[ap->current_read]), ap->seqpile[ap->current_read], get_seqali(ap->pile[ap->current_read]));
-  char *seen[ap->nb_ali];
+  if(ap->debug) printf("**** Remove hapB **** hapA=%s read=%s, aliseq=%s\n", str, bam_get_qname(ap->pile[ap->current_read]->b), get_seqali(ap->pile[ap->current_read]->b));
+  const char *seen[ap->nb_ali];
   int nbocc[ap->nb_ali];
   int idread[ap->nb_ali][ap->nb_ali];
   // retrieve all possibilities
+  update_column(ap, pos);
   for( i = 0 ; i < ap->nb_ali ; i++ ) {
-    char *seq = get_base(ap, i, pos);
+    const char *seq = ap->column[i];
     vu = 0;
     for( j = 0 ; j < nbdiff ; j++) 
       if(strcmp(seen[j], seq) == 0) { vu = 1; idread[j][nbocc[j]]=i; nbocc[j]++; }
@@ -257,7 +401,7 @@ void removehapB_read(alipile_t *ap, char* str, int pos, hash_t* readname) {
       nbocc[nbdiff] = 1; 
       if(strcmp(str, seq) == 0) id = nbdiff;
       nbdiff++;      
-    } else { free(seq); }
+    }
   }
   // erase reads from hapB
   int nbdelread = 0, delread[ap->nb_ali];
@@ -268,7 +412,7 @@ void removehapB_read(alipile_t *ap, char* str, int pos, hash_t* readname) {
 	     seen[j], nbocc[j], ratio);
     if( j == id ) continue;
     for( i = nbocc[j]-1 ; i >= 0 ; i-- ) {
-      bam1_t *aln = ap->pile[idread[j][i]];
+      bam1_t *aln = ap->pile[idread[j][i]]->b;
       
       if(ap->debug) 
 	printf("======> erase readid= %s\t base=%s\t ratio=%.4f\n", 
@@ -284,18 +428,18 @@ void removehapB_read(alipile_t *ap, char* str, int pos, hash_t* readname) {
     }
   }
   qsort(delread, nbdelread, sizeof(int), compare);
-  for( i = nbdelread - 1 ; i >= 0 ; i--) delete(ap, delread[i]);
-
-  for( j = 0 ; j < nbdiff ; j++) free(seen[j]);
+  delete_reads(ap, delread, nbdelread);
 }
 
 void select_base(alipile_t *ap, alipile_t *allali, int current_pos, 
 		 polished_t *s, hash_t* readname) {
-  char ref[2] = {toupper(ap->seq[current_pos])};
+  char ref[2] = {toupper(ap->seq[current_pos - ap->seq_start])};
   char *read = NULL;
   int ret = 0;
   
-  // clean the pile
+  // add the alignments read since the previous position, and clean the pile
+  flush(ap);
+  flush(allali);
   clean(ap, current_pos);
   clean(allali, current_pos);
 
@@ -309,21 +453,21 @@ void select_base(alipile_t *ap, alipile_t *allali, int current_pos,
       add_str(s, ref);
       ret = 1;
     } else {
-      read = get_base(ap, ap->current_read, current_pos);
+      read = strdup(get_base(ap, ap->current_read, current_pos));
       float ratio = get_ratio_base(ap, read, current_pos);
       float ratioall = get_ratio_base(allali, read, current_pos);
       if(ratioall >= 0.8) {
 	if(strcmp(read, "-") != 0) add_str(s, read);
-	if(strcmp(ref, read) != 0) {
+	if(ap->changes && strcmp(ref, read) != 0) {
 	  fprintf(ap->changes, "%s\t%i\tref=%s\tread=%s\treadname=%s\thomo\tratio1=%.4f\tratio2=%.4f\n",
 		  ap->name_seq, current_pos, ref, read,
-		  bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);
+		  bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);
 	  
 	  ap->nb_changes++;
 	  if(ap->debug)
 	    printf("%s\t%i\tref=%s\tread=%s\treadname=%s\thomo-lowcov\tratio1=%.4f\tratio2=%.4f\n",
 		   ap->name_seq, current_pos, ref, read,
-		   bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);
+		   bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);
 	}
 	ret = 1;
       }
@@ -332,28 +476,29 @@ void select_base(alipile_t *ap, alipile_t *allali, int current_pos,
   }
   
   if(!ret) {
-    read = get_base(ap, ap->current_read, current_pos);
+    free(read);
+    read = strdup(get_base(ap, ap->current_read, current_pos));
   
     float ratio = get_ratio_base(ap, read, current_pos);
     float ratioall = get_ratio_base(allali, read, current_pos);
     if(ap->debug) 
       printf("==> seq=%s pos=%i base_ref=%s base_read=%s ratio=%f ratioall=%f nbali=%i read=%s\n", 
 	     ap->name_seq, current_pos, ref, read, ratio, ratioall, ap->nb_ali,
-	     bam_get_qname(ap->pile[ap->current_read]));
+	     bam_get_qname(ap->pile[ap->current_read]->b));
     
     // keep read base (homo diff)
     if(!ret && ratioall >= 0.8 && (ratio * ap->nb_ali) > ap->min_cov) {
       if(strcmp(read, "-") != 0) add_str(s, read);
-      if(strcmp(ref, read) != 0) {
+      if(ap->changes && strcmp(ref, read) != 0) {
 	fprintf(ap->changes, "%s\t%i\tref=%s\tread=%s\treadname=%s\thomo\tratio1=%.4f\tratio2=%.4f\n", 
 		ap->name_seq, current_pos, ref, read, 
-		 bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);
+		 bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);
 
 	ap->nb_changes++;
 	if(ap->debug) 
 	  printf("%s\t%i\tref=%s\tread=%s\treadname=%s\thomo\tratio1=%.4f\tratio2=%.4f\n", 
 		ap->name_seq, current_pos, ref, read, 
-		 bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);
+		 bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);
       }
       ret = 1;
     }
@@ -365,24 +510,24 @@ void select_base(alipile_t *ap, alipile_t *allali, int current_pos,
       if(r<0.05) {
 	change_currentread2(ap, current_pos);
 	free(read);
-	read = get_base(ap, ap->current_read, current_pos);
+	read = strdup(get_base(ap, ap->current_read, current_pos));
 	if(ap->debug) 
 	  printf("CHANGE %s\t%i\tref=%s\tread=%s\treadname=%s\thetero\tratio1=%.4f\tratio2=%.4f\n",
 		 ap->name_seq, current_pos, ref, read, 
-		 bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);	
+		 bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);	
       }
 
       removehapB_read(ap, read, current_pos, readname);
       if(strcmp(read, "-") != 0) add_str(s, read);
-      if(strcmp(ref, read) != 0) {
+      if(ap->changes && strcmp(ref, read) != 0) {
 	fprintf(ap->changes, "%s\t%i\tref=%s\tread=%s\treadname=%s\thetero\tratio1=%.4f\tratio2=%.4f\n", 
 		ap->name_seq, current_pos, ref, read, 
-		bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);
+		bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);
 	ap->nb_changes++;
 	if(ap->debug) 
 	  printf("%s\t%i\tref=%s\tread=%s\treadname=%s\thetero\tratio1=%.4f\tratio2=%.4f\n",
 		 ap->name_seq, current_pos, ref, read, 
-		 bam_get_qname(ap->pile[ap->current_read]), ratio, ratioall);
+		 bam_get_qname(ap->pile[ap->current_read]->b), ratio, ratioall);
       }
       ret = 1;
     }
@@ -392,6 +537,7 @@ void select_base(alipile_t *ap, alipile_t *allali, int current_pos,
       delete(ap, ap->current_read);
       ap->current_read = -1;
       change_currentread2(ap, current_pos);
+      free(read);
       return select_base(ap, allali, current_pos, s, readname);
     }
 
@@ -401,3 +547,34 @@ void select_base(alipile_t *ap, alipile_t *allali, int current_pos,
 
   free(read);
 }
+
+// Number of bases from pos copied from the reference because the coverage of
+// both piles is too low, select_base would keep the reference base. Piles
+// only lose reads until the next alignment is added at end, so the coverage
+// stays too low up to end once it is.
+static int keep_reference(alipile_t *ap, alipile_t *allali, int pos, int end,
+			  polished_t *s) {
+  if(ap->debug) return 0;
+  flush(ap);
+  flush(allali);
+  clean(ap, pos);
+  clean(allali, pos);
+  if(ap->nb_ali >= ap->min_cov || (ap->nb_ali > 0 && allali->nb_ali >= ap->min_cov))
+    return 0;
+
+  // the piles are cleaned as they would be at the last position
+  clean(ap, end - 1);
+  clean(allali, end - 1);
+  add_upper(s, ap->seq + pos - ap->seq_start, end - pos);
+  return end - pos;
+}
+
+void select_bases(alipile_t *ap, alipile_t *allali, int start, int end,
+		  polished_t *s, hash_t* readname) {
+  int i = 0;
+  for(i = start ; i < end ; i++) {
+    int nb = keep_reference(ap, allali, i, end, s);
+    if(nb > 0) i += nb - 1;
+    else select_base(ap, allali, i, s, readname);
+  }
+}
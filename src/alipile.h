@@ -42,6 +42,7 @@
 #include <assert.h>
 #include <string.h>
 #include <ctype.h>
+#include <limits.h>
 
 #include "polished.h"
 #include "hash.h"
@@ -52,27 +53,74 @@
 //const unsigned int MAX_COV = 50;
 //const unsigned int MIN_COV = 3;
 
+/*! @typedef
+ @abstract Alignment shared by several piles.
+ @field  b            BAM alignment, destroyed with the last reference
+ @field  end          End position of the alignment (bam_endpos)
+ @field  refs         Number of piles holding the alignment
+ */
+typedef struct {
+  bam1_t* b;
+  int end;
+  int refs;
+} ali_t;
+
+/*! @typedef
+ @abstract Position of a read of the pile in its padded alignment, the padded
+           alignment is never built and is read from the CIGAR and the packed
+           sequence of the BAM record.
+ @field  op           Index of the CIGAR operation
+ @field  off          Offset in the CIGAR operation
+ @field  qpos         Position in the read sequence
+ @field  pos          Reference position
+ */
+typedef struct {
+  int op;
+  int off;
+  int qpos;
+  int pos;
+} cursor_t;
+
 /*! @typedef
  @abstract Structure for alignment pile information.
  @field  max_cov      Maximal coverage of the pile
  @field  min_cov      Minimal coverage required to correct the consensus
- @field  pile         Array of bam alignment
- @field  seqpile      Array of padded alignment
+ @field  pile         Array of shared bam alignment
+ @field  cursor       Position reached by each read of the pile
+ @field  column       Bases of each read at position column_pos
+ @field  column_size  Allocated size of each string of column
+ @field  column_pos   Position of the cached column, -1 when it must be computed
+ @field  min_end      Smallest end position of the alignments of the pile
+ @field  pending      Alignments added since the pile was last read
+ @field  nb_pending   Number of pending alignments
+ @field  size_pending Allocated size of pending
+ @field  nb_skipped   Number of alignments evicted before the pile was read
  @field  current_read Index of the selected Read
  @field  current_seq  Index of the reference sequence
  @field  name_seq     Name of the reference sequence
  @field  seq          Reference sequence
+ @field  seq_start    Position of the first base of seq in the reference sequence
  @field  len_seq      Reference sequence length
  @field  nb_ali       Number of alignment
  @field  nbhapB       Number of removed PE reads from hapB
- @field  changes      FILE output changes
+ @field  changes      FILE output changes (changes are not reported when NULL)
  */
 typedef struct {
   int max_cov;
   int min_cov;
 
-  bam1_t* pile[500];
-  char* seqpile[500];
+  ali_t* pile[500];
+
+  cursor_t cursor[500];
+  char* column[500];
+  int column_size[500];
+  int column_pos;
+  int min_end;
+
+  ali_t** pending;
+  int nb_pending;
+  int size_pending;
+  int nb_skipped;
 
   int current_read;
   int read_choice;
@@ -80,6 +128,7 @@ typedef struct {
   int current_seq;
   char* name_seq;
   char* seq;
+  int seq_start;
   int len_seq;
 
   int nb_ali;
@@ -92,6 +141,13 @@ typedef struct {
 } alipile_t;
 
 
+// Create a shared alignment holding one reference to aln
+ali_t *ali_init(bam1_t *aln);
+
+// Release a reference to a shared alignment, the alignment is destroyed
+// with its last reference
+void ali_release(ali_t *a);
+
 // Create a alipile_t structure
 /**
    @return An empty alipile_t structure on success, NULL on failure
@@ -108,8 +164,15 @@ void alipile_free(alipile_t *ap);
 // Clean pile by erasing alignment that do not overlap pos
 void clean(alipile_t *ap, int pos);
 
-// Add an alignment to the alipile_t structure
-void add(alipile_t *ap, bam1_t *aln);
+// Add an alignment to the alipile_t structure, the pile holds a new reference
+/**
+   The alignment is only put in the pile when the pile is read next, and only
+   if it is not evicted by the alignments added before.
+ */
+void add(alipile_t *ap, ali_t *a);
+
+// Put the pending alignments in the pile
+void flush(alipile_t *ap);
 
 // Change current read in the alipile_t structure
 void change_currentread(alipile_t *ap, int pos);
@@ -120,27 +183,47 @@ void change_currentread2(alipile_t *ap, int pos);
 // Delete an alignment from the alipile_t structure
 void delete(alipile_t *ap, int elem);
 
+// Delete several alignments, ids are sorted in increasing order
+void delete_reads(alipile_t *ap, int *ids, int nb);
+
 // Get padded-alignment length
 int get_lseqali(bam1_t *aln);
 
 // Get padded-alignment
 char* get_seqali(bam1_t *aln);
 
+// Return the next character of the padded-alignment and move the cursor,
+// or '\0' at the end of the alignment
+char next_char(bam1_t *aln, cursor_t *c);
+
 // Get sequence from bam alignment
 char* get_bamseq(bam1_t *aln);
 
+// Compute the bases of all the reads of the pile at position pos
+void update_column(alipile_t *ap, int pos);
+
 // Return the base of the read at position pos
-char* get_base(alipile_t *ap, int read, int pos);
+/**
+   The returned string belongs to the pile, it is valid until the pile or
+   the position changes.
+ */
+const char* get_base(alipile_t *ap, int read, int pos);
 
 // return the proportion of ali with base nt at given position
-float get_ratio_base(alipile_t *ap, char *nt, int pos);
+float get_ratio_base(alipile_t *ap, const char *nt, int pos);
 
 // Remove alignments from haplotype B
-void removehapB_read(alipile_t *ap, char* str, int pos, hash_t* readname);
+void removehapB_read(alipile_t *ap, const char* str, int pos, hash_t* readname);
 
 // Get the corrected nucleotide at position current_pos
 void select_base(alipile_t *ap, alipile_t *allali, int current_pos, 
 		 polished_t* s, hash_t* readname);
 
+// Get the corrected nucleotides from start to end (excluded), no alignment
+// must start in between. Spans where the coverage is too low are copied from
+// the reference at once.
+void select_bases(alipile_t *ap, alipile_t *allali, int start, int end,
+		  polished_t* s, hash_t* readname);
+
 
 #endif
@@ -36,10 +36,11 @@
 
 #include "hash.h"
 
-const int INIT_SIZE = 268288;
+const int INIT_SIZE = 1024;
 const int EXPAND = 2;
 const float MAX_LOAD_FACTOR = 0.7;
-const int HASH_FN_OFFSET = 85;
+const uint64_t HASH_FN_OFFSET = 14695981039346656037ULL;
+const uint64_t HASH_FN_PRIME = 1099511628211ULL;
 
 
 hash_t* hash_init() { 
@@ -48,111 +49,149 @@ hash_t* hash_init() {
 
 hash_t* hash_init1(int size) {
   hash_t* h;
-  int i = 0;
+  int msize = 16;
+
+  // keep the table under the maximal load factor for size keys
+  while(msize * MAX_LOAD_FACTOR <= size) msize *= EXPAND;
     
   h = malloc(sizeof(hash_t));
   
   assert(h != 0);
   
-  h->msize = size;
+  h->msize = msize;
   h->size = 0;
-  h->htable = malloc(sizeof(elm_t) * h->msize);
+  h->htable = calloc(h->msize, sizeof(elm_t));
   
   assert(h->htable != 0);
-  
-  for( ; i < h->msize; i++) h->htable[i] = 0;
+
+  h->keys_size = 16 * msize;
+  h->keys_len = 0;
+  h->keys_live = 0;
+  h->keys = malloc(h->keys_size);
+
+  assert(h->keys != 0);
   
   return h;
 }
 
 void hash_free(hash_t* h) {
-  int i;
-  elm_t *current;
-  elm_t *next;
-  
-  for(i = 0; i < h->msize; i++) {
-    for(current = h->htable[i]; current != 0; current = next) {
-      next = current->next;
-      free(current->key);
-      free(current);
-    }
-  } 
   free(h->htable);
+  free(h->keys);
   free(h);
 }
 
-unsigned long hash_fn(const char *s) {
+uint64_t hash_fn(const char *s) {
   unsigned const char *it = (unsigned const char *) s;
-  unsigned long idx = 0;
+  uint64_t idx = HASH_FN_OFFSET;
   
-  for( ; *it; it++) idx = HASH_FN_OFFSET * idx + *it;
+  for( ; *it; it++) idx = (idx ^ *it) * HASH_FN_PRIME;
+  idx ^= idx >> 32;
+
+  // 0 marks the empty slots
+  return idx ? idx : 1;
+}
+
+int hash_find(hash_t* h, const char *key, uint64_t hv) {
+  int mask = h->msize - 1;
+  int i = hv & mask;
   
-  return idx;
+  for( ; h->htable[i].hash != 0; i = (i + 1) & mask)
+    if(h->htable[i].hash == hv && !strcmp(h->keys + h->htable[i].key, key)) return i;
+
+  return -1;
 }
 
-void grow(hash_t* h) {
-  hash_t* htmp = hash_init1(h->msize * EXPAND);;
-  struct hash swap;
+void hash_place(hash_t* h, elm_t e) {
+  int mask = h->msize - 1;
+  int i = e.hash & mask;
+
+  while(h->htable[i].hash != 0) i = (i + 1) & mask;
+  h->htable[i] = e;
+}
+
+void compact_keys(hash_t* h, size_t size) {
+  // copy the keys still in the table to a new arena
+  char *keys = malloc(size);
+  size_t len = 0;
   int i = 0;
-  elm_t* current;
-  
-  for( ; i < h->msize; i++)
-    for(current = h->htable[i]; current != 0; current = current->next)
-      hash_insert(htmp, current->key);
+
+  assert(keys != 0);
+
+  for( ; i < h->msize; i++) {
+    if(h->htable[i].hash == 0) continue;
+    size_t l = strlen(h->keys + h->htable[i].key) + 1;
+    memcpy(keys + len, h->keys + h->htable[i].key, l);
+    h->htable[i].key = len;
+    len += l;
+  }
+  free(h->keys);
+  h->keys = keys;
+  h->keys_size = size;
+  h->keys_len = len;
+}
+
+void grow(hash_t* h) {
+  elm_t *old = h->htable;
+  int i = 0, msize = h->msize;
+
+  h->msize *= EXPAND;
+  h->htable = calloc(h->msize, sizeof(elm_t));
   
-  swap = *h;
-  *h = *htmp;
-  *htmp = swap;
-  hash_free(htmp);
+  assert(h->htable != 0);
+
+  // the hash of each key is kept, keys are not hashed nor copied again
+  for( ; i < msize; i++)
+    if(old[i].hash != 0) hash_place(h, old[i]);
+  free(old);
 }
 
 void hash_insert(hash_t* h, const char *key) {
-  elm_t *ins;
-  unsigned long hkey;
+  uint64_t hv;
+  size_t l;
   
   assert(key);
   
-  ins = malloc(sizeof(elm_t));
-  
-  assert(ins);
+  hv = hash_fn(key);
+  if(hash_find(h, key, hv) != -1) return;
 
-  //printf("please delete read= %s\n", key);
-  
-  ins->key = strdup(key);
-  hkey = hash_fn(key) % h->msize;  
-  ins->next = h->htable[hkey];
-  h->htable[hkey] = ins;
+  if(h->size + 1 >= (int)(h->msize * MAX_LOAD_FACTOR)) grow(h);
+
+  l = strlen(key) + 1;
+  if(h->keys_len + l > h->keys_size) {
+    // erased keys are dropped when they fill half of the arena
+    size_t size = h->keys_size;
+    while(h->keys_live + l > size / 2) size *= EXPAND;
+    if(size == h->keys_size && h->keys_len - h->keys_live < h->keys_len / 2) size *= EXPAND;
+    compact_keys(h, size);
+  }
+
+  elm_t ins = {hv, h->keys_len};
+  memcpy(h->keys + h->keys_len, key, l);
+  h->keys_len += l;
+  h->keys_live += l;
+  hash_place(h, ins);
   h->size++;
-  
-  if(h->size >= (int)(h->msize * MAX_LOAD_FACTOR)) grow(h);
 }
 
 int hash_search(hash_t* h, const char *key) {
-  unsigned long hkey = hash_fn(key) % h->msize;
-  elm_t *se = h->htable[hkey];
-  
-  for( ; se != 0; se = se->next)
-    if(!strcmp(se->key, key)) return 1;
-
-  return 0;
+  return hash_find(h, key, hash_fn(key)) != -1;
 }
 
 void hash_delete(hash_t* h, const char *key) {
-  unsigned long hkey = hash_fn(key) % h->msize;
-  elm_t **prev = &(h->htable[hkey]);
-  elm_t *del;
-  
-  while(*prev != 0) {
-    if(!strcmp((*prev)->key, key)) {
-      del = *prev;
-      *prev = del->next;
-      
-      free(del->key);
-      free(del);
-      h->size--;
-      
-      return;
+  int mask = h->msize - 1;
+  int i = hash_find(h, key, hash_fn(key)), j = 0;
+
+  if(i == -1) return;
+  h->keys_live -= strlen(key) + 1;
+  h->size--;
+
+  // move back the next entries of the cluster instead of leaving a tombstone
+  for(j = (i + 1) & mask; h->htable[j].hash != 0; j = (j + 1) & mask) {
+    int k = h->htable[j].hash & mask;
+    if((j > i && (k <= i || k > j)) || (j < i && k <= i && k > j)) {
+      h->htable[i] = h->htable[j];
+      i = j;
     }
-    prev = &((*prev)->next);
   }
+  h->htable[i].hash = 0;
 }
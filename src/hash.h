@@ -41,38 +41,49 @@
 #include <stdlib.h> 
 #include <assert.h>
 #include <string.h>
+#include <stdint.h>
 
 /*! @typedef
  @abstract Structure for a hash entry
- @field  next         Next entry to manage colision
- @field  key          The key of the entry
+ @field  hash         Hash of the key, 0 for an empty slot
+ @field  key          Offset of the key in the arena of the table
  */
 typedef struct elm {
-    struct elm *next;
-    char *key;
+    uint64_t hash;
+    size_t key;
 } elm_t;
 
 /*! @typedef
- @abstract Structure for a hash table
- @field  m_size       Size of the table
+ @abstract Structure for a hash table with open addressing and linear probing
+ @field  m_size       Size of the table (a power of 2)
  @field  size         The number of entries
  @field  table        The hash table
+ @field  keys         Arena holding the keys, separated by '\0'
+ @field  keys_size    Allocated size of the arena
+ @field  keys_len     Used size of the arena, erased keys included
+ @field  keys_live    Size of the keys still in the table
  */
 typedef struct hash {
     int msize;
     int size;
-    elm_t **htable;
+    elm_t *htable;
+    char *keys;
+    size_t keys_size;
+    size_t keys_len;
+    size_t keys_live;
 } hash_t;
 
 
 /* create and initialize an empty hash table */
 hash_t* hash_init(void);
+/* the table is sized to hold the given number of keys without growing */
 hash_t* hash_init1(int);
 
 /* destroy a hash table */
 void hash_free(hash_t*);
 
 /* insert a new key into a hash table */
+/* if the key is already present, has no effect */
 void hash_insert(hash_t*, const char*);
 
 /* return 1 if the key is present, 0 otherwise */
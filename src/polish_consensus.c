@@ -5,10 +5,13 @@
 #include <assert.h>
 #include <ctype.h>
 #include <string.h>
+#include <pthread.h>
+#include <time.h>
 
 #include "htslib/hts.h"
 #include "htslib/sam.h"
 #include "htslib/faidx.h"
+#include "htslib/thread_pool.h"
 
 #include "alipile.h"
 #include "polished.h"
@@ -18,18 +21,100 @@ const unsigned int MAX_COV = 50;
 const unsigned int MIN_COV = 3;
 const unsigned int BUFFER = 1000;
 
+/*! @typedef
+ @abstract Counters reported at the end of a run.
+ @field  nb_removed   Number of reads skipped because their mate was in hapB
+ @field  nb_skipped   Number of reads evicted from the pile before being used
+ @field  nb_positions Number of reference positions polished
+ @field  decode_time  Seconds spent reading and decoding alignments
+ @field  select_time  Seconds spent in select_base
+ */
+typedef struct {
+  int tot_read;
+  int too_short;
+  int nb_changes;
+  int nb_hapB;
+  int nb_removed;
+  int nb_skipped;
+  long nb_positions;
+  double decode_time;
+  double select_time;
+} stats_t;
+
+/*! @typedef
+ @abstract Region of a reference sequence to polish.
+ @field  tid          Index of the reference sequence
+ @field  start        First position used to select reads (0-based)
+ @field  polish_start First position written to the output
+ @field  end          End of the region (excluded)
+ */
+typedef struct {
+  int tid;
+  int start;
+  int polish_start;
+  int end;
+} region_t;
+
+/*! @typedef
+ @abstract Polished sequence and changes of a region, kept in memory until
+           all previous regions have been written.
+ */
+typedef struct {
+  char* seq;
+  size_t seq_len;
+  char* changes;
+  size_t changes_len;
+  int done;
+} result_t;
+
+/*! @typedef
+ @abstract State shared by the polishing threads.
+ @field  next_region  Index of the next region to polish
+ @field  next_output  Index of the next region to write
+ @field  tpool        htslib thread pool used to decompress the BAM file
+ @field  filter       alignments with any of these flags are skipped
+ */
+typedef struct {
+  char* bam;
+  char* fa;
+  int filter;
+  region_t* regions;
+  int nb_regions;
+  int next_region;
+  int next_output;
+  result_t* results;
+  FILE* out;
+  FILE* changes;
+  stats_t* stats;
+  htsThreadPool tpool;
+  pthread_mutex_t lock;
+} workers_t;
+
 void usage();
-int parse_bam(char*, char*, char*, char*, int);
+int parse_bam(char*, char*, char*, char*, int, int, char*);
+int parse_regions(char*, char*, char*, int, int, char*, char*, int, int, char*);
+region_t* load_regions(char*, int, bam_hdr_t*, int*);
+void* polish_worker(void*);
+void polish_region(samFile*, hts_idx_t*, bam_hdr_t*, faidx_t*, int, int, int, int,
+		   FILE*, FILE*, int, int, stats_t*);
+polished_t* select_region(alipile_t*, alipile_t*, int, int, int, int, polished_t*, hash_t*,
+			  FILE*, FILE*);
+polished_t* end_warmup(alipile_t*, polished_t*, FILE*, FILE*);
+void print_stats(stats_t*, double, char*);
+double now();
 void print_step(int, int);
 void error(char*, ...);
 
 int main(int argc, char* argv[]) {
   char *BAMfile = NULL, *outfile = NULL, *changefile = NULL, *FAfile = NULL;
-  int silent = 0;
+  char *BEDfile = NULL, *metricsfile = NULL;
+  int silent = 0, warmup = 0, threads = 1;
+  // unmapped reads are always skipped
+  int filter = BAM_FUNMAP;
   int c;
 
   // Invokes member function `int operator ()(void);'
-  while ((c = getopt(argc, argv, "f:b:c:o:hs")) != -1) {
+  while ((c = getopt(argc, argv, "f:b:c:o:r:w:t:m:F:hs")) != -1) {
     switch (c) {
     case 'b':
       BAMfile = optarg;
@@ -43,6 +128,21 @@ int main(int argc, char* argv[]) {
     case 'f':
       FAfile = optarg;
       break;
+    case 'r':
+      BEDfile = optarg;
+      break;
+    case 'w':
+      warmup = atoi(optarg);
+      break;
+    case 't':
+      threads = atoi(optarg);
+      break;
+    case 'm':
+      metricsfile = optarg;
+      break;
+    case 'F':
+      filter |= strtol(optarg, NULL, 0);
+      break;
       /*    case 'u':
       unmasked_len = atoi(optarg);
       break;
@@ -63,7 +163,10 @@ int main(int argc, char* argv[]) {
   if (FAfile==NULL) error("Could not load faidx: %s\n", FAfile);
   if (outfile==NULL) error("Could not open output fasta file: %s\n", outfile);
   if (changefile==NULL) error("Could not open output changes file: %s\n", changefile);
-  return parse_bam(BAMfile, FAfile, outfile, changefile, silent);
+  if (BEDfile != NULL || threads > 1)
+    return parse_regions(BAMfile, FAfile, BEDfile, warmup, threads, outfile, changefile, silent,
+			 filter, metricsfile);
+  return parse_bam(BAMfile, FAfile, outfile, changefile, silent, filter, metricsfile);
 }
 
 void error(char* message, ...) {
@@ -74,8 +177,10 @@ void error(char* message, ...) {
   exit(-1);
 }
 
-int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
+int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent, int filter,
+	      char* metrics) {
   setvbuf(stdout, NULL, _IONBF, 0);
+  double start_time = now();
   
   //open BAM for reading
   samFile *in = sam_open(bam, "r");
@@ -97,7 +202,6 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
   bam_hdr_t *header = sam_hdr_read(in);
   //Initiate the alignment record
   bam1_t *aln = bam_init1();
-  bam1_t *aln2 = bam_init1();
   int ret=0, i=0;
   int current_position = 0, previous_position = 0;
   alipile_t* ap = alipile_init(changes);
@@ -106,11 +210,14 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
   hash_t* readname = hash_init();
   int tot_read = 0, added_read = 0, too_short = 0;
   int current_seq = -1, progress = 0, nb_changes = 0, nb_hapB = 0;
+  stats_t stats;
+  memset(&stats, 0, sizeof(stats_t));
+  double t = now(), t_select = 0;
   
   while ((ret = sam_read1(in, header, aln)) >= 0) { 
-    bam_copy1(aln2, aln);
-    // exclude unmapped reads
-    if (aln->core.tid < 0 || (aln->core.flag&BAM_FUNMAP)) continue;
+    stats.decode_time += now() - t;
+    // exclude unmapped reads and filtered alignments
+    if (aln->core.tid < 0 || (aln->core.flag&filter)) continue;
     //printf("Read: %s\t%s\t%i\n", bam_get_qname(aln), get_bamseq(aln), aln->core.l_qseq);
     
     if(current_seq != aln->core.tid) {
@@ -121,11 +228,14 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
 	  printf("\n");
 	}
 	int i = 0;
-	for(i = previous_position ; i < ap->len_seq ; i++) 
-	  select_base(ap, allali, i, s, readname);
+	t_select = now();
+	select_bases(ap, allali, previous_position, ap->len_seq, s, readname);
+	stats.select_time += now() - t_select;
+	stats.nb_positions += ap->len_seq - previous_position;
 	print_seq(s, out);
 	nb_changes += ap->nb_changes;
 	nb_hapB += ap->nbhapB;
+	stats.nb_skipped += ap->nb_skipped;
 	alipile_free(ap);
 	alipile_free(allali);
 	polished_free(s);
@@ -141,6 +251,7 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
       ap->name_seq = header->target_name[aln->core.tid];
       s->name_seq = header->target_name[aln->core.tid];
       ap->len_seq = header->target_len[aln->core.tid];
+      polished_stream(s, out);
       int len = 0;
       ap->seq = faidx_fetch_seq(ref, ap->name_seq, 0, ap->len_seq, &len);
     }
@@ -151,30 +262,37 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
     //if(!strcmp(header->target_name[aln->core.tid], "HS_assemblymutate") && current_position > 96300 && current_position < 96400) ap->debug = 1;
     //else ap->debug = 0;
     //ap->debug = 1;
-    int i;
-    for(i = previous_position ; i < current_position ; i++)
-      select_base(ap, allali, i, s, readname);
+    t_select = now();
+    select_bases(ap, allali, previous_position, current_position, s, readname);
+    stats.select_time += now() - t_select;
+    if(current_position > previous_position) stats.nb_positions += current_position - previous_position;
     
     // exclude too short alignments
     if(get_lseqali(aln) >= 31) {
+      // both piles share the same alignment
+      ali_t *a = ali_init(aln);
       if(!hash_search(readname, bam_get_qname(aln))) {
-	add(ap, aln); 
+	add(ap, a); 
 	added_read++;
       }
       else {
 	//printf("======> hapremove %s\n", bam_get_qname(aln));
 	hash_delete(readname, bam_get_qname(aln));
-	bam_destroy1(aln);
+	stats.nb_removed++;
       }
-      add(allali, aln2);
+      add(allali, a);
+      ali_release(a);
       aln = bam_init1();
-      aln2 = bam_init1();
       tot_read++;
     } else too_short++;
     previous_position = current_position;
+    t = now();
   }
-  for(i = previous_position ; i < ap->len_seq ; i++) 
-    select_base(ap, allali, i, s, readname);
+  stats.decode_time += now() - t;
+  t_select = now();
+  select_bases(ap, allali, previous_position, ap->len_seq, s, readname);
+  stats.select_time += now() - t_select;
+  if(ap->len_seq > previous_position) stats.nb_positions += ap->len_seq - previous_position;
   
   if(ap->len_seq != 0) {
     print_seq(s, out);
@@ -182,10 +300,12 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
   }
   nb_changes += ap->nb_changes;
   nb_hapB += ap->nbhapB;
-  printf("\n\nNumber of reads               : %i\n", tot_read);
-  printf("Number of too short alignment : %i\n", too_short);
-  printf("Number of hapB reads found    : %i\n", nb_hapB*2);
-  printf("Number of changes             : %i\n", nb_changes);
+  stats.nb_skipped += ap->nb_skipped;
+  stats.tot_read = tot_read;
+  stats.too_short = too_short;
+  stats.nb_changes = nb_changes;
+  stats.nb_hapB = nb_hapB;
+  print_stats(&stats, now() - start_time, metrics);
 
   fai_destroy(ref);
   bam_hdr_destroy(header);
@@ -194,13 +314,362 @@ int parse_bam(char* bam, char* fa, char* outfa, char *changefile, int silent) {
   polished_free(s);
   hash_free(readname);
   bam_destroy1(aln);
-  bam_destroy1(aln2);
   sam_close(in);
   fclose(changes);
   fclose(out);
   return 0;
 }
 
+int parse_regions(char* bam, char* fa, char* bed, int warmup, int threads,
+		  char* outfa, char *changefile, int silent, int filter, char* metrics) {
+  setvbuf(stdout, NULL, _IONBF, 0);
+  double start_time = now();
+
+  //open BAM and its index for reading
+  samFile *in = sam_open(bam, "r");
+  if(in == NULL) error("Unable to open BAM/SAM file: %s\n", bam);
+  hts_idx_t *idx = sam_index_load(in, bam);
+  if(idx == NULL) error("Unable to load the index of BAM/SAM file: %s\n", bam);
+  bam_hdr_t *header = sam_hdr_read(in);
+
+  // open fasta file and index
+  faidx_t *ref = fai_load(fa);
+  if (ref == NULL) error("Could not load faidx: %s\n", fa);
+
+  // open output fasta file
+  FILE* out = fopen(outfa,"w");
+  if (out == NULL) error("Could not open output fasta file: %s\n", outfa);
+
+  // open output changes file
+  FILE* changes = fopen(changefile,"w");
+  if (changes == NULL) error("Could not open output changes file: %s\n", changefile);
+
+  int nb_regions = 0;
+  region_t* regions = load_regions(bed, warmup, header, &nb_regions);
+  stats_t stats;
+  memset(&stats, 0, sizeof(stats_t));
+  int i = 0;
+
+  if(threads <= 1) {
+    for(i = 0 ; i < nb_regions ; i++) {
+      region_t *r = &regions[i];
+      polish_region(in, idx, header, ref, r->tid, r->start, r->polish_start, r->end,
+		    out, changes, silent, filter, &stats);
+    }
+  } else {
+    // each thread polishes whole regions with its own readers, results are
+    // written in the order of the regions
+    workers_t w;
+    memset(&w, 0, sizeof(workers_t));
+    w.bam = bam;
+    w.fa = fa;
+    w.filter = filter;
+    w.regions = regions;
+    w.nb_regions = nb_regions;
+    w.out = out;
+    w.changes = changes;
+    w.stats = &stats;
+    w.results = calloc(nb_regions, sizeof(result_t));
+    pthread_mutex_init(&w.lock, NULL);
+
+    // decompression threads shared by all readers
+    w.tpool.pool = hts_tpool_init(threads);
+    if(w.tpool.pool == NULL) error("Could not create a pool of %i threads\n", threads);
+
+    pthread_t *tids = malloc(threads * sizeof(pthread_t));
+    for(i = 0 ; i < threads ; i++)
+      if(pthread_create(&tids[i], NULL, polish_worker, &w) != 0)
+	error("Could not create thread %i\n", i);
+    for(i = 0 ; i < threads ; i++) pthread_join(tids[i], NULL);
+
+    pthread_mutex_destroy(&w.lock);
+    hts_tpool_destroy(w.tpool.pool);
+    free(w.results);
+    free(tids);
+  }
+  print_stats(&stats, now() - start_time, metrics);
+
+  free(regions);
+  fai_destroy(ref);
+  hts_idx_destroy(idx);
+  bam_hdr_destroy(header);
+  sam_close(in);
+  fclose(changes);
+  fclose(out);
+  return 0;
+}
+
+region_t* load_regions(char* bed, int warmup, bam_hdr_t* header, int* nb_regions) {
+  int max_regions = 0, start = 0, end = 0, tid = 0;
+  region_t* regions = NULL;
+  *nb_regions = 0;
+
+  // without BED file, every reference sequence is polished
+  if(bed == NULL) {
+    regions = malloc((header->n_targets + 1) * sizeof(region_t));
+    for(tid = 0 ; tid < header->n_targets ; tid++) {
+      region_t r = {tid, 0, 0, header->target_len[tid]};
+      regions[(*nb_regions)++] = r;
+    }
+    return regions;
+  }
+
+  FILE* f = fopen(bed, "r");
+  if (f == NULL) error("Could not open BED file: %s\n", bed);
+  char line[BUFFER], name[BUFFER];
+  while(fgets(line, BUFFER, f) != NULL) {
+    if(sscanf(line, "%999s %i %i", name, &start, &end) != 3) continue;
+    tid = bam_name2id(header, name);
+    if(tid < 0) error("Sequence %s of %s not found in BAM header\n", name, bed);
+    if(end > header->target_len[tid]) end = header->target_len[tid];
+    if(start >= end) continue;
+
+    // the first bases only select the reads, except at the start of the sequence
+    int polish_start = start;
+    if(start > 0) polish_start = (start + warmup < end) ? start + warmup : end;
+
+    if(*nb_regions == max_regions) {
+      max_regions = max_regions ? 2 * max_regions : 64;
+      regions = realloc(regions, max_regions * sizeof(region_t));
+      if(regions == NULL) error("Could not allocate regions\n");
+    }
+    region_t r = {tid, start, polish_start, end};
+    regions[(*nb_regions)++] = r;
+  }
+  fclose(f);
+  return regions;
+}
+
+void* polish_worker(void* arg) {
+  workers_t *w = (workers_t*) arg;
+  samFile *in = sam_open(w->bam, "r");
+  if(in == NULL) error("Unable to open BAM/SAM file: %s\n", w->bam);
+  hts_set_opt(in, HTS_OPT_THREAD_POOL, &w->tpool);
+  hts_idx_t *idx = sam_index_load(in, w->bam);
+  if(idx == NULL) error("Unable to load the index of BAM/SAM file: %s\n", w->bam);
+  bam_hdr_t *header = sam_hdr_read(in);
+  faidx_t *ref = fai_load(w->fa);
+  if (ref == NULL) error("Could not load faidx: %s\n", w->fa);
+  stats_t stats;
+  memset(&stats, 0, sizeof(stats_t));
+
+  while(1) {
+    pthread_mutex_lock(&w->lock);
+    int i = w->next_region++;
+    pthread_mutex_unlock(&w->lock);
+    if(i >= w->nb_regions) break;
+
+    // polish the region in memory
+    region_t *r = &w->regions[i];
+    result_t res = {NULL, 0, NULL, 0, 0};
+    FILE* seq = open_memstream(&res.seq, &res.seq_len);
+    FILE* changes = open_memstream(&res.changes, &res.changes_len);
+    if(seq == NULL || changes == NULL) error("Could not allocate output buffers\n");
+    polish_region(in, idx, header, ref, r->tid, r->start, r->polish_start, r->end,
+		  seq, changes, 1, w->filter, &stats);
+    fclose(seq);
+    fclose(changes);
+    res.done = 1;
+
+    // write all the regions that are ready, in order
+    pthread_mutex_lock(&w->lock);
+    w->results[i] = res;
+    while(w->next_output < w->nb_regions && w->results[w->next_output].done) {
+      result_t *o = &w->results[w->next_output];
+      fwrite(o->seq, 1, o->seq_len, w->out);
+      fwrite(o->changes, 1, o->changes_len, w->changes);
+      free(o->seq);
+      free(o->changes);
+      o->seq = o->changes = NULL;
+      w->next_output++;
+    }
+    pthread_mutex_unlock(&w->lock);
+  }
+
+  pthread_mutex_lock(&w->lock);
+  w->stats->tot_read += stats.tot_read;
+  w->stats->too_short += stats.too_short;
+  w->stats->nb_changes += stats.nb_changes;
+  w->stats->nb_hapB += stats.nb_hapB;
+  w->stats->nb_removed += stats.nb_removed;
+  w->stats->nb_skipped += stats.nb_skipped;
+  w->stats->nb_positions += stats.nb_positions;
+  w->stats->decode_time += stats.decode_time;
+  w->stats->select_time += stats.select_time;
+  pthread_mutex_unlock(&w->lock);
+
+  fai_destroy(ref);
+  hts_idx_destroy(idx);
+  bam_hdr_destroy(header);
+  sam_close(in);
+  return NULL;
+}
+
+void polish_region(samFile* in, hts_idx_t* idx, bam_hdr_t* header, faidx_t* ref, int tid,
+		   int start, int polish_start, int end, FILE* out, FILE* changes, int silent, int filter,
+		   stats_t* stats) {
+  bam1_t *aln = bam_init1();
+  alipile_t* ap = alipile_init(polish_start == start ? changes : NULL);
+  alipile_t* allali = alipile_init(NULL);
+  polished_t* s = polished_init1(end - polish_start);
+  hash_t* readname = NULL;
+  int current_position = start, previous_position = start, nb_read = 0, i = 0, len = 0;
+  uint64_t mapped = 0, unmapped = 0;
+  char desc[BUFFER];
+
+  // at most half of the reads of the region are expected to come from hapB
+  if(hts_idx_get_stat(idx, tid, &mapped, &unmapped) == 0 && header->target_len[tid] > 0)
+    readname = hash_init1(mapped * (end - start) / header->target_len[tid] / 2);
+  else readname = hash_init();
+
+  ap->name_seq = header->target_name[tid];
+  s->name_seq = header->target_name[tid];
+  ap->len_seq = header->target_len[tid];
+  ap->seq_start = start;
+  ap->seq = faidx_fetch_seq(ref, ap->name_seq, start, end - 1, &len);
+  if(ap->seq == NULL || len != end - start)
+    error("Could not fetch %s:%i-%i from fasta file\n", ap->name_seq, start + 1, end);
+
+  // sub-sequences are named after the polished region
+  if(start != 0 || end != ap->len_seq) {
+    snprintf(desc, BUFFER, "%s:%i-%i", ap->name_seq, polish_start + 1, end);
+    s->desc = desc;
+  }
+  if(!silent) printf("Reference sequence : %s:%i-%i\n", ap->name_seq, start + 1, end);
+
+  hts_itr_t *iter = sam_itr_queryi(idx, tid, start, end);
+  if(iter == NULL) error("Could not query %s:%i-%i in BAM file\n", ap->name_seq, start + 1, end);
+  double t = now(), t_select = 0;
+
+  while (sam_itr_next(in, iter, aln) >= 0) {
+    stats->decode_time += now() - t;
+    // exclude unmapped reads and filtered alignments
+    if (aln->core.tid < 0 || (aln->core.flag&filter)) continue;
+    nb_read++;
+    // the region will be written, stream it once the warm-up is over
+    if(polish_start == start || previous_position > polish_start) polished_stream(s, out);
+
+    current_position = aln->core.pos;
+    if(current_position < start) current_position = start;
+    if(stats->tot_read%10000 == 0 && !silent) print_step(current_position, ap->len_seq);
+
+    t_select = now();
+    s = select_region(ap, allali, previous_position, current_position, start, polish_start, s,
+		      readname, changes, nb_read > 0 ? out : NULL);
+    stats->select_time += now() - t_select;
+
+    // exclude too short alignments
+    if(get_lseqali(aln) >= 31) {
+      // both piles share the same alignment
+      ali_t *a = ali_init(aln);
+      if(!hash_search(readname, bam_get_qname(aln))) add(ap, a);
+      else {
+	hash_delete(readname, bam_get_qname(aln));
+	stats->nb_removed++;
+      }
+      add(allali, a);
+      ali_release(a);
+      aln = bam_init1();
+      stats->tot_read++;
+    } else stats->too_short++;
+    previous_position = current_position;
+    t = now();
+  }
+  stats->decode_time += now() - t;
+
+  t_select = now();
+  s = select_region(ap, allali, previous_position, end, start, polish_start, s,
+		    readname, changes, nb_read > 0 ? out : NULL);
+  stats->select_time += now() - t_select;
+  stats->nb_positions += end - start;
+
+  // regions without reads are left unpolished
+  if(nb_read > 0) {
+    print_seq(s, out);
+    if(!silent) {
+      print_step(end, ap->len_seq);
+      printf("\n");
+    }
+  }
+  stats->nb_changes += ap->nb_changes;
+  stats->nb_hapB += ap->nbhapB;
+  stats->nb_skipped += ap->nb_skipped;
+
+  hts_itr_destroy(iter);
+  alipile_free(ap);
+  alipile_free(allali);
+  polished_free(s);
+  hash_free(readname);
+  bam_destroy1(aln);
+}
+
+// Polish positions from to to (excluded) of a region, the warm-up ends at
+// polish_start. Returns the polished sequence, a new one when the warm-up ended.
+polished_t* select_region(alipile_t* ap, alipile_t* allali, int from, int to, int start,
+			  int polish_start, polished_t* s, hash_t* readname, FILE* changes,
+			  FILE* out) {
+  if(polish_start == start || polish_start < from || polish_start >= to) {
+    select_bases(ap, allali, from, to, s, readname);
+    return s;
+  }
+  select_bases(ap, allali, from, polish_start, s, readname);
+  s = end_warmup(ap, s, changes, out);
+  select_bases(ap, allali, polish_start, to, s, readname);
+  return s;
+}
+
+// End of the warm-up: start writing the polished sequence and changes
+polished_t* end_warmup(alipile_t* ap, polished_t* s, FILE* changes, FILE* out) {
+  polished_t* polished = polished_init1(s->size_alloc);
+  polished->name_seq = s->name_seq;
+  polished->desc = s->desc;
+  polished_free(s);
+  ap->changes = changes;
+  // reads were found, the region will be written
+  if(out != NULL) polished_stream(polished, out);
+  return polished;
+}
+
+double now() {
+  struct timespec t;
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec + t.tv_nsec / 1e9;
+}
+
+// Print the counters, and write them to the metrics file when given. Times of
+// the threads are added up.
+void print_stats(stats_t* stats, double wall_time, char* metrics) {
+  double reads_per_second = wall_time > 0 ? stats->tot_read / wall_time : 0;
+  double positions_per_second = wall_time > 0 ? stats->nb_positions / wall_time : 0;
+  printf("\n\nNumber of reads               : %i\n", stats->tot_read);
+  printf("Number of too short alignment : %i\n", stats->too_short);
+  printf("Number of hapB reads found    : %i\n", stats->nb_hapB*2);
+  printf("Number of hapB reads removed  : %i\n", stats->nb_removed);
+  printf("Number of reads evicted early : %i\n", stats->nb_skipped);
+  printf("Number of changes             : %i\n", stats->nb_changes);
+  printf("Number of positions           : %li\n", stats->nb_positions);
+  printf("Reads per second              : %.0f\n", reads_per_second);
+  printf("Positions per second          : %.0f\n", positions_per_second);
+  printf("Time reading alignments       : %.3f s\n", stats->decode_time);
+  printf("Time selecting bases          : %.3f s\n", stats->select_time);
+  if(metrics == NULL) return;
+
+  FILE* f = fopen(metrics, "w");
+  if(f == NULL) error("Could not open metrics file: %s\n", metrics);
+  fprintf(f, "reads\t%i\n", stats->tot_read);
+  fprintf(f, "too_short\t%i\n", stats->too_short);
+  fprintf(f, "hapB_reads\t%i\n", stats->nb_hapB*2);
+  fprintf(f, "hapB_removed\t%i\n", stats->nb_removed);
+  fprintf(f, "skipped_reads\t%i\n", stats->nb_skipped);
+  fprintf(f, "changes\t%i\n", stats->nb_changes);
+  fprintf(f, "positions\t%li\n", stats->nb_positions);
+  fprintf(f, "reads_per_second\t%.1f\n", reads_per_second);
+  fprintf(f, "positions_per_second\t%.1f\n", positions_per_second);
+  fprintf(f, "decode_time\t%.6f\n", stats->decode_time);
+  fprintf(f, "select_time\t%.6f\n", stats->select_time);
+  fclose(f);
+}
+
 void print_step(int pos, int len_seq) {	   
   int p = (int)((pos * 100)/ len_seq);
   if(p == 99) p = 100;
@@ -218,11 +687,19 @@ void print_step(int pos, int len_seq) {
 void usage() {
   fprintf(stderr, "--------------------------------------------------------------------------------------------\n");
   fprintf(stderr, "\n");
-  fprintf(stderr, "Usage:   polish_consensus -b <in.bam> -f <in.fasta> -o <out.fasta> -c <out.changes>\n\n");
+  fprintf(stderr, "Usage:   polish_consensus -b <in.bam> -f <in.fasta> -o <out.fasta> -c <out.changes> [-r <regions.bed> -w <int>] [-t <int>] [-m <metrics.tsv>] [-F <flags>]\n\n");
   fprintf(stderr, "Parameters: -b FILE : input BAM file\n");
   fprintf(stderr, "            -f FILE : input fasta file\n");
   fprintf(stderr, "            -o FILE : output fasta file\n");
   fprintf(stderr, "            -c FILE : output file that describes the corrections made.\n");
+  fprintf(stderr, "            -r FILE : only polish the regions of this BED file (the BAM file must be indexed)\n");
+  fprintf(stderr, "            -w INT  : number of bases at the start of each region used to select reads\n");
+  fprintf(stderr, "                      and not written to the output, unless the region starts at 0 [0]\n");
+  fprintf(stderr, "            -t INT  : number of threads, sequences are polished in parallel\n");
+  fprintf(stderr, "                      (the BAM file must be indexed) [1]\n");
+  fprintf(stderr, "            -m FILE : write performance counters to this file (name and value per line)\n");
+  fprintf(stderr, "            -F INT  : skip alignments with any of these flags, e.g. 0x900 for secondary and\n");
+  fprintf(stderr, "                      supplementary alignments (unmapped reads are always skipped) [0x4]\n");
   fprintf(stderr, "            -h      : this help\n");
   fprintf(stderr, "\n");
   fprintf(stderr, "--------------------------------------------------------------------------------------------\n");
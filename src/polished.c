@@ -36,14 +36,25 @@
 
 #include "polished.h"
 
+const int LINE_SIZE = 60;
+const int FLUSH_SIZE = 1 << 20;
+
 polished_t *polished_init(void) {
+  return polished_init1(1000);
+}
+
+polished_t *polished_init1(int size) {
   polished_t* s = (polished_t*) calloc(1, sizeof(polished_t));
+  // while streaming, the sequence never grows much beyond FLUSH_SIZE
+  if(size > FLUSH_SIZE + 1000) size = FLUSH_SIZE + 1000;
+  if(size < 1000) size = 1000;
   s->chunk = 1000;
-  s->size_alloc = s->chunk;
-  s->seq = (char *) malloc((s->chunk + 1) * sizeof(char));
-  s->seq[s->chunk]='\0';
+  s->size_alloc = size;
+  s->seq = (char *) malloc((s->size_alloc + 1) * sizeof(char));
+  s->seq[0]='\0';
   s->pos_seq = 0;
   s->buffer_level = 0;
+  s->out = NULL;
   return s;
 }
 
@@ -70,22 +81,74 @@ void add_base(polished_t *s, char base) {
   //s->seq[strlen(s->seq)] = '\0';
 }
 
-void add_str(polished_t *s, char *str) {
-  assert(str != NULL && s->seq != NULL);
-  int len = strlen(str);
+// Make room for len more bases
+static void reserve(polished_t *s, int len) {
   if(s->pos_seq + len >= s->size_alloc) {
-    int extend = s->chunk;
-    while(len >= extend) { extend += s->chunk; }
-    void* tmpseq = (char *) realloc(s->seq, (s->size_alloc + extend) * sizeof(char));  
+    int size = s->size_alloc * 2;
+    while(s->pos_seq + len >= size) size *= 2;
+    void* tmpseq = (char *) realloc(s->seq, (size + 1) * sizeof(char));  
     assert(tmpseq);
     s->seq = tmpseq;
-    s->size_alloc += extend;
+    s->size_alloc = size;
   }
-  int i = 0;
-  for(i = 0 ; i < len ; i++)
-    s->seq[s->pos_seq + i ] = str[i];
+}
+
+void add_str(polished_t *s, char *str) {
+  assert(str != NULL && s->seq != NULL);
+  int len = strlen(str);
+  reserve(s, len);
+  memcpy(s->seq + s->pos_seq, str, len);
   s->pos_seq += len;
   s->seq[s->pos_seq]='\0';
+  if(s->out != NULL && s->pos_seq >= FLUSH_SIZE) flush_seq(s, 0);
+}
+
+void add_upper(polished_t *s, const char *seq, int len) {
+  assert(seq != NULL && s->seq != NULL);
+  // by blocks of FLUSH_SIZE bases, so that a streamed sequence stays small
+  while(len > 0) {
+    int i = 0, l = (len < FLUSH_SIZE) ? len : FLUSH_SIZE;
+    reserve(s, l);
+    for(i = 0 ; i < l ; i++) s->seq[s->pos_seq + i] = toupper(seq[i]);
+    s->pos_seq += l;
+    s->seq[s->pos_seq]='\0';
+    if(s->out != NULL && s->pos_seq >= FLUSH_SIZE) flush_seq(s, 0);
+    seq += l;
+    len -= l;
+  }
+}
+
+void polished_stream(polished_t *s, FILE* fo) {
+  if(s->out != NULL) return;
+  if(s->desc != NULL) fprintf(fo, ">%s_polished %s\n", s->name_seq, s->desc);
+  else fprintf(fo, ">%s_polished\n", s->name_seq);
+  s->out = fo;
+  if(s->pos_seq >= FLUSH_SIZE) flush_seq(s, 0);
+}
+
+void flush_seq(polished_t *s, int last) {
+  // wrap the complete lines (and the last partial line at the end of the
+  // sequence) in one buffer written with a single fwrite
+  int nb_lines = s->pos_seq / LINE_SIZE;
+  int len = nb_lines * LINE_SIZE;
+  if(last && len < s->pos_seq) { nb_lines++; len = s->pos_seq; }
+  if(nb_lines == 0) return;
+
+  char *wrapped = malloc(len + nb_lines);
+  assert(wrapped);
+  int i = 0, w = 0;
+  for(i = 0 ; i < len ; i += LINE_SIZE) {
+    int l = (len - i < LINE_SIZE) ? len - i : LINE_SIZE;
+    memcpy(wrapped + w, s->seq + i, l);
+    w += l;
+    wrapped[w++] = '\n';
+  }
+  fwrite(wrapped, 1, w, s->out);
+  free(wrapped);
+
+  memmove(s->seq, s->seq + len, s->pos_seq - len);
+  s->pos_seq -= len;
+  s->seq[s->pos_seq] = '\0';
 }
 
 /*void addBase(polished_t *s, char base) {
@@ -106,23 +169,8 @@ void add_str(polished_t *s, char *str) {
   }*/
 
 void print_seq(polished_t *s, FILE* fo) {
-  if(s->seq != NULL) {
-    char *cs = s->seq;
-    fprintf(fo, ">%s_polished\n", s->name_seq);
-    int linesize = 60;
-    int len = strlen(s->seq);
-    int write = len;
-    while(len>0) {
-      write = len;
-      if(len > linesize) write = linesize;
-      char* line = _substr(s->seq, 0, write);
-      fprintf(fo, "%s\n", line);
-      free(line);
-      s->seq += write;
-      len -= write;
-    }
-    s->seq = cs;
-  }
+  polished_stream(s, fo);
+  flush_seq(s, 1);
 }
 
 char* _substr(const char *src, int pos, int len) {
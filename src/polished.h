@@ -41,6 +41,7 @@
 #include <stdio.h>
 #include <stdlib.h> 
 #include <string.h>
+#include <ctype.h>
 
 #include "htslib/hts.h"
 #include "htslib/sam.h"
@@ -58,13 +59,18 @@
  @field  name_seq     Name of the reference sequence
  @field  seq          Reference sequence
  @field  nb_ali       Number of alignment
+ @field  desc         Optional description written after the sequence name
+ @field  out          FILE receiving the sequence as it is polished, NULL while
+                      the sequence is kept in memory
  */
 typedef struct {
   char* name_seq;
+  char* desc;
   char* seq;
   int size_alloc;
   int pos_seq;
   int chunk;
+  FILE* out;
 
   char buffer[1000+1];
   int buffer_level;
@@ -77,6 +83,9 @@ typedef struct {
  */
 polished_t *polished_init(void);
 
+// Create a polished_t structure for a sequence of about size bases
+polished_t *polished_init1(int size);
+
 // Free a alipile_t structure
 /**
    @param b structure to free
@@ -90,6 +99,16 @@ void add_base(polished_t *s, char base);
 // Add string str to the polished sequence
 void add_str(polished_t *s, char* str);
 
+// Add len bases of seq, in uppercase, to the polished sequence
+void add_upper(polished_t *s, const char *seq, int len);
+
+// Write the header of the sequence in FILE, the sequence is then written
+// by blocks of complete lines as it is polished
+void polished_stream(polished_t *s, FILE* fo);
+
+// Write the complete lines of the sequence, and the last partial line if last
+void flush_seq(polished_t *s, int last);
+
 // Print polished sequence in FILE
 void print_seq(polished_t *s, FILE* fo);
 
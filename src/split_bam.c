@@ -0,0 +1,248 @@
+/// @file split_bam.c
+/// Split a BAM file into one BAM file per chunk in a single pass
+
+/*
+################################################################################
+# * Copyright Jean-Marc Aury / Genoscope / DRF / CEA
+# *           <jmaury@genoscope.cns.fr>
+# *
+# * This software is governed by the CeCILL license under French law and
+# * abiding by the rules of distribution of free software.  You can  use,
+# * modify and/ or redistribute the software under the terms of the CeCILL
+# * license as circulated by CEA, CNRS and INRIA at the following URL
+# * "http://www.cecill.info".
+# *
+# * As a counterpart to the access to the source code and  rights to copy,
+# * modify and redistribute granted by the license, users are provided only
+# * with a limited warranty  and the software's author,  the holder of the
+# * economic rights,  and the successive licensors  have only  limited
+# * liability.
+# *
+# * In this respect, the user's attention is drawn to the risks associated
+# * with loading,  using,  modifying and/or developing or reproducing the
+# * software by the user in light of its specific status of free software,
+# * that may mean  that it is complicated to manipulate,  and  that  also
+# * therefore means  that it is reserved for developers  and  experienced
+# * professionals having in-depth computer knowledge. Users are therefore
+# * encouraged to load and test the software's suitability as regards their
+# * requirements in conditions enabling the security of their systems and/or
+# * data to be ensured and,  more generally, to use and operate it in the
+# * same conditions as regards security.
+# *
+# * The fact that you are presently reading this means that you have had
+# * knowledge of the CeCILL license and that you accept its terms.
+################################################################################
+*/
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdarg.h>
+#include <unistd.h>
+#include <string.h>
+#include <libgen.h>
+
+#include "htslib/hts.h"
+#include "htslib/sam.h"
+#include "htslib/thread_pool.h"
+
+const unsigned int LINE_SIZE = 1000;
+
+/*! @typedef
+ @abstract Region of a reference sequence sent to a chunk.
+ @field  start        Start of the region (0-based)
+ @field  end          End of the region (excluded)
+ @field  chunk        Index of the output BAM file
+ */
+typedef struct {
+  int start;
+  int end;
+  int chunk;
+} region_t;
+
+/*! @typedef
+ @abstract Regions of one reference sequence.
+ */
+typedef struct {
+  region_t* regions;
+  int nb_regions;
+  int max_regions;
+} target_t;
+
+void usage();
+void error(char*, ...);
+void load_bed(char*, int, bam_hdr_t*, target_t*);
+
+int main(int argc, char* argv[]) {
+  char *BAMfile = NULL, *outdir = ".";
+  int threads = 1, write_index = 0;
+  // unmapped reads are always skipped
+  int filter = BAM_FUNMAP;
+  char *mode = "wb";
+  int c, i, j;
+
+  while ((c = getopt(argc, argv, "b:o:@:F:xuh")) != -1) {
+    switch (c) {
+    case 'b':
+      BAMfile = optarg;
+      break;
+    case 'o':
+      outdir = optarg;
+      break;
+    case '@':
+      threads = atoi(optarg);
+      break;
+    case 'F':
+      filter |= strtol(optarg, NULL, 0);
+      break;
+    case 'x':
+      write_index = 1;
+      break;
+    case 'u':
+      mode = "wbu";
+      break;
+    case 'h':
+      usage();
+    default :
+      abort();
+    }
+  }
+  if (BAMfile == NULL) error("Could not load bam: %s\n", BAMfile);
+  int nb_chunks = argc - optind;
+  if (nb_chunks <= 0) error("No BED file given\n");
+
+  // one thread pool shared by the reader and all writers
+  hts_tpool *pool = NULL;
+  htsThreadPool tpool = {NULL, 0};
+  if (threads > 1) {
+    pool = hts_tpool_init(threads);
+    if (pool == NULL) error("Could not create a pool of %i threads\n", threads);
+    tpool.pool = pool;
+  }
+
+  samFile *in = sam_open(BAMfile, "r");
+  if (in == NULL) error("Unable to open BAM/SAM file: %s\n", BAMfile);
+  if (pool) hts_set_opt(in, HTS_OPT_THREAD_POOL, &tpool);
+  bam_hdr_t *header = sam_hdr_read(in);
+  if (header == NULL) error("Unable to read header of %s\n", BAMfile);
+
+  // reference sequence -> chunk regions
+  target_t* targets = calloc(header->n_targets, sizeof(target_t));
+  samFile **out = malloc(nb_chunks * sizeof(samFile*));
+  char **outnames = malloc(nb_chunks * sizeof(char*));
+  char **idxnames = malloc(nb_chunks * sizeof(char*));
+  for (i = 0; i < nb_chunks; i++) {
+    char *bed = argv[optind + i];
+    load_bed(bed, i, header, targets);
+
+    char *bedcopy = strdup(bed);
+    char *name = basename(bedcopy);
+    char *ext = strrchr(name, '.');
+    if (ext != NULL) *ext = '\0';
+    outnames[i] = malloc(strlen(outdir) + strlen(name) + 6);
+    sprintf(outnames[i], "%s/%s.bam", outdir, name);
+    idxnames[i] = malloc(strlen(outnames[i]) + 5);
+    sprintf(idxnames[i], "%s.bai", outnames[i]);
+    free(bedcopy);
+
+    out[i] = sam_open(outnames[i], mode);
+    if (out[i] == NULL) error("Could not open output BAM file: %s\n", outnames[i]);
+    if (pool) hts_set_opt(out[i], HTS_OPT_THREAD_POOL, &tpool);
+    if (sam_hdr_write(out[i], header) < 0) error("Could not write header of %s\n", outnames[i]);
+    if (write_index && sam_idx_init(out[i], header, 0, idxnames[i]) < 0)
+      error("Could not initialise index of %s\n", outnames[i]);
+  }
+
+  // send each alignment to every chunk with an overlapping region
+  bam1_t *aln = bam_init1();
+  int *written = calloc(nb_chunks, sizeof(int));
+  long nb_reads = 0, nb_written = 0;
+  int ret = 0;
+  while ((ret = sam_read1(in, header, aln)) >= 0) {
+    if (aln->core.tid < 0 || (aln->core.flag&filter)) continue;
+    nb_reads++;
+    target_t *t = &targets[aln->core.tid];
+    if (t->nb_regions == 0) continue;
+
+    int start = aln->core.pos;
+    int end = bam_endpos(aln);
+    for (j = 0; j < t->nb_regions; j++) {
+      region_t *r = &t->regions[j];
+      if (r->start >= end || r->end <= start || written[r->chunk]) continue;
+      if (sam_write1(out[r->chunk], header, aln) < 0)
+	error("Could not write to %s\n", outnames[r->chunk]);
+      written[r->chunk] = 1;
+      nb_written++;
+    }
+    for (j = 0; j < t->nb_regions; j++) written[t->regions[j].chunk] = 0;
+  }
+  if (ret < -1) error("Error while reading %s\n", BAMfile);
+
+  for (i = 0; i < nb_chunks; i++) {
+    if (write_index && sam_idx_save(out[i]) < 0) error("Could not write index of %s\n", outnames[i]);
+    if (sam_close(out[i]) < 0) error("Could not close %s\n", outnames[i]);
+    free(outnames[i]);
+    free(idxnames[i]);
+  }
+  printf("Number of reads   : %li\n", nb_reads);
+  printf("Number of records : %li\n", nb_written);
+
+  for (i = 0; i < header->n_targets; i++) free(targets[i].regions);
+  free(targets);
+  free(written);
+  free(out);
+  free(outnames);
+  free(idxnames);
+  bam_destroy1(aln);
+  bam_hdr_destroy(header);
+  sam_close(in);
+  if (pool) hts_tpool_destroy(pool);
+  return 0;
+}
+
+void load_bed(char* bed, int chunk, bam_hdr_t* header, target_t* targets) {
+  char line[LINE_SIZE], name[LINE_SIZE];
+  int start = 0, end = 0;
+  FILE* f = fopen(bed, "r");
+  if (f == NULL) error("Could not open BED file: %s\n", bed);
+
+  while (fgets(line, LINE_SIZE, f) != NULL) {
+    if (sscanf(line, "%999s %i %i", name, &start, &end) != 3) continue;
+    int tid = bam_name2id(header, name);
+    if (tid < 0) error("Sequence %s of %s not found in BAM header\n", name, bed);
+
+    target_t *t = &targets[tid];
+    if (t->nb_regions == t->max_regions) {
+      t->max_regions = t->max_regions ? 2 * t->max_regions : 4;
+      t->regions = realloc(t->regions, t->max_regions * sizeof(region_t));
+      if (t->regions == NULL) error("Could not allocate regions\n");
+    }
+    region_t r = {start, end, chunk};
+    t->regions[t->nb_regions++] = r;
+  }
+  fclose(f);
+}
+
+void error(char* message, ...) {
+  va_list argp;
+  va_start(argp, message);
+  vprintf(message, argp);
+  va_end(argp);
+  exit(-1);
+}
+
+void usage() {
+  fprintf(stderr, "--------------------------------------------------------------------------------------------\n");
+  fprintf(stderr, "\n");
+  fprintf(stderr, "Usage:   hapog_split -b <in.bam> -o <out_dir> [-@ <threads>] [-F <flags>] [-x] [-u] <chunk_1.bed> [<chunk_2.bed> ...]\n\n");
+  fprintf(stderr, "Parameters: -b FILE : input BAM/SAM file, '-' for standard input (must be sorted with -x)\n");
+  fprintf(stderr, "            -o DIR  : output directory, chunk_N.bed is written to DIR/chunk_N.bam\n");
+  fprintf(stderr, "            -@ INT  : number of compression/decompression threads [1]\n");
+  fprintf(stderr, "            -F INT  : skip alignments with any of these flags, e.g. 0x900 for secondary and\n");
+  fprintf(stderr, "                      supplementary alignments (unmapped reads are always skipped) [0x4]\n");
+  fprintf(stderr, "            -x      : index the output BAM files\n");
+  fprintf(stderr, "            -u      : write uncompressed BAM files (when they are piped to another tool)\n");
+  fprintf(stderr, "            -h      : this help\n");
+  fprintf(stderr, "\n");
+  fprintf(stderr, "--------------------------------------------------------------------------------------------\n");
+  exit(0);
+}